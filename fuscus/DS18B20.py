@@ -19,12 +19,122 @@
 #
 
 
+import logging
+import os
 import threading
 import time
 
 # How many times to try reading a stuck sensor before giving up.
 RETRY_LIMIT = 10
 
+# Where the 1-wire devices are found.  Can be changed for testing.
+W1_ROOT = "/sys/bus/w1/devices"
+
+
+# Devices without the 'temperature' attribute (older kernels), which are
+# read through w1_slave instead
+_noTemperatureAttribute = set()
+
+# Conversion time in seconds for each resolution in bits
+CONVERSION_TIME = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+
+
+def _readRaw(root, deviceID):
+    """Return the temperature in degrees C, or None if the reading failed
+    its CRC check.  Raises OSError if the device can not be opened."""
+    noAttribute = deviceID in _noTemperatureAttribute
+    if not noAttribute:
+        # The temperature attribute holds only the value, in millidegrees
+        try:
+            with open(os.path.join(root, deviceID, "temperature")) as f:
+                return int(f.read()) / 1000
+        except FileNotFoundError:
+            noAttribute = True
+        except (OSError, ValueError):
+            return None  # The driver returns an error on a CRC failure
+
+    # w1_slave holds two lines of scratchpad, like
+    # 72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+    # 72 01 4b 46 7f ff 0e 10 57 t=23125
+    with open(os.path.join(root, deviceID, "w1_slave")) as f:
+        text = f.read()
+    # Only now that w1_slave could be opened is the device known to lack
+    # the attribute.  An unplugged device has neither, and may well have
+    # the attribute once it is back.
+    if noAttribute:
+        _noTemperatureAttribute.add(deviceID)
+    end = text.find("\n")
+    if not text.startswith("YES", end - 3):
+        return None
+    return int(text[text.rindex("t=") + 2:]) / 1000
+
+
+# Why a single read failed
+OPEN_ERROR = 'open'  # The device could not be opened: unplugged, or no driver
+CRC_ERROR = 'crc'  # The scratchpad failed its CRC check
+POWER_ON_RESET = '85'  # 85.0, the power-on value: the conversion did not happen
+
+
+def readOnce(deviceID, w1Root=None):
+    """Read a sensor once, without retrying.  Return (temperature, None),
+    or (None, error) with error one of OPEN_ERROR, CRC_ERROR or
+    POWER_ON_RESET.  w1Root defaults to W1_ROOT."""
+    try:
+        temperature = _readRaw(w1Root or W1_ROOT, deviceID)
+    except (OSError, ValueError):
+        return None, OPEN_ERROR
+    if temperature is None:
+        return None, CRC_ERROR
+    if temperature == 85.0:
+        # A common error condition.  If your application
+        # encounters this temperature genuinely in your
+        # environment consider removing this test.
+        return None, POWER_ON_RESET
+    return temperature, None
+
+
+def read(deviceID, w1Root=None):
+    """Read a sensor, retrying a bad reading up to RETRY_LIMIT times.
+    Return the temperature in degrees C, or None if deviceID is None or
+    the sensor can not be read.
+
+    This blocks while the sensor converts (750ms at 12 bit resolution),
+    and for every retry.  w1Poller reads with readOnce() instead, and
+    retries later, so the other sensors on the bus are not held up."""
+
+    # If deviceID is None, don't bother reading it.
+    if deviceID is None:
+        return None
+
+    for attempt in range(RETRY_LIMIT + 1):  # Sometimes the sensor gets 'stuck'
+        temperature, error = readOnce(deviceID, w1Root)
+        if error is None:
+            return temperature
+        if error == OPEN_ERROR:
+            logging.warning("Could not read '%s'", deviceID)
+            return None
+        logging.info("Sensor '%s' returned a bad reading (%s).  Attempt %s of %s.",
+                     deviceID, error, attempt + 1, RETRY_LIMIT + 1)
+
+    logging.warning("Sensor '%s' did not return a good reading after %s retries.  Giving up.",
+                    deviceID, RETRY_LIMIT)
+    return None
+
+
+def setResolution(deviceID, bits, w1Root=None):
+    """Set the resolution of a sensor to 9, 10, 11 or 12 bits.  Returns
+    False if the sensor does not allow it."""
+    if bits not in CONVERSION_TIME:
+        raise ValueError("Resolution must be 9 to 12 bits, not %s" % bits)
+    filename = os.path.join(w1Root or W1_ROOT, deviceID, "resolution")
+    try:
+        with open(filename, "w") as f:
+            f.write("%d\n" % bits)
+    except OSError:
+        logging.warning("Could not set resolution of '%s'", deviceID)
+        return False
+    return True
+
 
 class DS18B20(threading.Thread):
     """Threaded class to read DS18B20 sensor.
@@ -53,6 +163,7 @@ class DS18B20(threading.Thread):
 
         # Initialise temperature to None, meaning no reading is available
         self.temperature = None
+        self.captured = None  # time.monotonic() of the latest reading
 
         self.running = False
 
@@ -60,65 +171,20 @@ class DS18B20(threading.Thread):
 
         self.running = True
 
+        # Read on absolute deadlines, so the time a read takes does not
+        # add to the period
+        deadline = time.monotonic()
         while (self.running):
             # update temperature every time around this loop
-
-            retries = 0  # Sometimes the sensor gets 'stuck'
-
-            temperature = None  # Default temperature until we get a new one
-
-            # If deviceID is None, don't bother reading it.
-            while self.deviceID is not None:
-                # Attempt to read the sensor, and deal with common errors.
-
-                filename = "/sys/bus/w1/devices/%s/w1_slave" % self.deviceID
-
-                try:
-                    tfile = open(filename)
-                    text = tfile.read()
-                    tfile.close
-                except:
-                    print("Could not open '%s'" % filename)
-                    break
-
-                if text.split("\n")[0][-3:] == "YES":
-                    # New data is available.  Extract it from the string.
-                    new_temperature = float(text.split("\n")[1].split(" ")[9][2:]) / 1000
-                else:
-                    # Reading the sensor did not return "YES".
-                    # Let's try again a few times.
-                    print("Sensor '%s' did not return 'YES'" % self.deviceID)
-                    print("Sensor returned '%s'" % text)
-                    if retries < RETRY_LIMIT:
-                        retries += 1
-                        print("Re-reading '%s'.  Attempt %s of %s." % (self.deviceID, retries, RETRY_LIMIT))
-                        continue
-                    else:
-                        print("Sensor '%s' did not return 'YES' after %s retries.  Giving up." % (
-                        self.deviceID, RETRY_LIMIT))
-                        break
-
-                if new_temperature == 85.0:
-                    # A common error condition.  If your application
-                    # encounters this temperature genuinely in your
-                    # environment consider removing this test.
-                    if retries < RETRY_LIMIT:
-                        retries += 1
-                        print("Discarding 85.0 reading.  Re-reading '%s'.  Attempt %s of %s." % (
-                        self.deviceID, retries, RETRY_LIMIT))
-                        continue
-                    else:
-                        print("Sensor '%s' stuck on 85.0 after %s retries.  Giving up." % (self.deviceID, RETRY_LIMIT))
-                        break
-                else:
-                    # new temperature is acceptable
-                    temperature = new_temperature + self.calibrationOffset
-
-                break
+            temperature = read(self.deviceID)
+            if temperature is not None:
+                temperature += self.calibrationOffset
 
             self.temperature = temperature
+            self.captured = time.monotonic()
 
-            time.sleep(self.samplePeriod)
+            deadline = max(deadline + self.samplePeriod, self.captured)
+            time.sleep(deadline - self.captured)
 
     def stop(self):
         self.running = False
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Run the cascaded filters of many sensors as one vectorized update."""
+
+#
+# Copyright 2012-2013 BrewPi/Elco Jacobs.
+# Copyright 2015 Andrew Errington
+#
+# This file is part of BrewPi.
+#
+# BrewPi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BrewPi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Each channel (sensor) has three cascaded filters
+FAST_FILTER = 0
+SLOW_FILTER = 1
+SLOPE_FILTER = 2
+NUM_FILTERS = 3
+
+
+class FilterBank:
+    """Hold the state of many CascadedFilters in contiguous arrays.
+
+    The state is stored as xv[channel, filter, section, tap] and likewise
+    for yv, with the same difference equation as FilterFixed.FixedFilter.
+    Multiplying by a power of two is exact in floating point, so the
+    results match the Decimal filter to within float precision.
+
+    Sensors register a channel and use FilterBankView objects in place of
+    their CascadedFilters.  Calling add() on a view only stages the input.
+    All staged inputs are filtered together by step(), and the outputs
+    read from the views change at step().  tempController steps the bank
+    twice per tick: once after the sensors have added their samples to the
+    fast and slow filters, so the sensors read this tick's outputs as with
+    a CascadedFilter, and once more for the slope filters they then feed.
+
+    Staged inputs and the outputs of the last section are kept as Python
+    lists, which the views read and write much faster than numpy elements.
+    """
+
+    def __init__(self, NUM_SECTIONS=3, capacity=4):
+        if numpy is None:
+            raise RuntimeError("FilterBank requires numpy")
+
+        self.NUM_SECTIONS = NUM_SECTIONS
+        self.numChannels = 0
+
+        self.xv = numpy.full((capacity, NUM_FILTERS, NUM_SECTIONS, 3), numpy.nan)
+        self.yv = numpy.full((capacity, NUM_FILTERS, NUM_SECTIONS, 3), numpy.nan)
+
+        # Coefficients are held as multipliers, 2^-b and 2^-a, and as the
+        # multipliers of y[1] and y[2] in the difference equation
+        self.b = numpy.full((capacity, NUM_FILTERS), 2, dtype=int)
+        self.gainB = numpy.full((capacity, NUM_FILTERS), 2.0 ** -2)
+        self.gainA = numpy.full((capacity, NUM_FILTERS), 2.0 ** -8)
+        self.gainY1 = 2 - self.gainB
+        self.gainY2 = self.gainB - 1 - 4 * self.gainA
+
+        # The filters are numbered by row, channel * NUM_FILTERS + filterIndex,
+        # as in the arrays flattened over channel and filter
+        self.staged = {}  # Row -> input for the next step()
+        self.outputs = []  # Row -> output taps of the last section
+
+    def _grow(self):
+        """Double the number of channels the arrays can hold."""
+        def grow(array, fill):
+            bigger = numpy.full((array.shape[0] * 2,) + array.shape[1:], fill, dtype=array.dtype)
+            bigger[:array.shape[0]] = array
+            return bigger
+
+        self.xv = grow(self.xv, numpy.nan)
+        self.yv = grow(self.yv, numpy.nan)
+        self.b = grow(self.b, 2)
+        self.gainB = grow(self.gainB, 2.0 ** -2)
+        self.gainA = grow(self.gainA, 2.0 ** -8)
+        self.gainY1 = grow(self.gainY1, 2 - 2.0 ** -2)
+        self.gainY2 = grow(self.gainY2, 2.0 ** -2 - 1 - 4 * 2.0 ** -8)
+
+    def register(self):
+        """Allocate a channel and return its index."""
+        if self.numChannels == self.xv.shape[0]:
+            self._grow()
+        channel = self.numChannels
+        self.numChannels += 1
+        self.outputs.extend(self.yv[channel, :, -1].tolist())
+        return channel
+
+    def view(self, channel, filterIndex):
+        """Return an object which behaves like a CascadedFilter."""
+        return FilterBankView(self, channel, filterIndex)
+
+    def setCoefficients(self, channel, filterIndex, b):
+        self.b[channel, filterIndex] = b
+        self.gainB[channel, filterIndex] = 2.0 ** -b
+        self.gainA[channel, filterIndex] = 2.0 ** -(b * 2 + 4)
+        # Both are exact, as 2^-b and 4 * 2^-a are powers of two down to 2^-28
+        self.gainY1[channel, filterIndex] = 2 - 2.0 ** -b
+        self.gainY2[channel, filterIndex] = 2.0 ** -b - 1 - 4 * 2.0 ** -(b * 2 + 4)
+
+    def init(self, channel, filterIndex, val):
+        self.xv[channel, filterIndex] = val
+        self.yv[channel, filterIndex] = val
+        row = channel * NUM_FILTERS + filterIndex
+        self.staged.pop(row, None)
+        self.outputs[row] = self.yv[channel, filterIndex, -1].tolist()
+
+    def setState(self, channel, filterIndex, state):
+        for section, (xv, yv) in enumerate(state):
+            self.xv[channel, filterIndex, section] = xv
+            self.yv[channel, filterIndex, section] = yv
+        self.outputs[channel * NUM_FILTERS + filterIndex] = self.yv[channel, filterIndex, -1].tolist()
+
+    def stage(self, channel, filterIndex, val):
+        """Queue an input for the next step().  A later value replaces an earlier one."""
+        self.staged[channel * NUM_FILTERS + filterIndex] = val
+
+    def step(self):
+        """Filter all staged inputs.  Returns the number of filters updated."""
+        if not self.staged:
+            return 0
+        count = len(self.staged)
+        keys = list(self.staged)
+        rows = numpy.fromiter(keys, int, count)
+        val = numpy.fromiter(self.staged.values(), float, count)
+        self.staged.clear()
+
+        sections = self.NUM_SECTIONS
+        xvAll = self.xv.reshape(-1, sections, 3)
+        yvAll = self.yv.reshape(-1, sections, 3)
+        xv = xvAll[rows]
+        yv = yvAll[rows]
+        gainA = self.gainA.reshape(-1)[rows]
+        gainY1 = self.gainY1.reshape(-1)[rows]
+        gainY2 = self.gainY2.reshape(-1)[rows]
+
+        # Move all values "up" in the pipeline, for every section at once
+        xv[:, :, 1:] = xv[:, :, :2].copy()
+        yv[:, :, 1:] = yv[:, :, :2].copy()
+
+        # The input of each section is the output of the previous one.
+        # y0 = y1 + (y1 - y2) - (y1 - y2) 2^-b + (x0 + 2 x1 + x2) 2^-a - 4 y2 2^-a,
+        # with the multipliers of y1 and y2 gathered.
+        for section in range(sections):
+            x = xv[:, section]
+            y = yv[:, section]
+            x[:, 0] = val
+            val = (gainY1 * y[:, 1] + gainY2 * y[:, 2] +
+                   gainA * (val + 2 * x[:, 1] + x[:, 2]))
+            y[:, 0] = val
+
+        xvAll[rows] = xv
+        yvAll[rows] = yv
+
+        outputs = self.outputs
+        for row, taps in zip(keys, yv[:, -1].tolist()):
+            outputs[row] = taps
+
+        return count
+
+
+class FilterBankView:
+    """One cascaded filter of a FilterBank, with the CascadedFilter interface.
+
+    add() only stages the value, and returns None: its output is
+    calculated when the bank is stepped.
+    """
+
+    def __init__(self, bank, channel, filterIndex):
+        self.bank = bank
+        self.channel = channel
+        self.filterIndex = filterIndex
+        self.row = channel * NUM_FILTERS + filterIndex
+
+    def setCoefficients(self, bValue):
+        self.bank.setCoefficients(self.channel, self.filterIndex, bValue)
+
+    def init(self, val):
+        self.bank.init(self.channel, self.filterIndex, val)
+
+    def add(self, val):
+        self.bank.staged[self.row] = val  # bank.stage(), without the call
+
+    addDoublePrecision = add
+
+    def _yv(self):
+        """Return the output taps of the last section, as of the last step()."""
+        return self.bank.outputs[self.row]
+
+    def readInput(self):
+        """Returns the most recent filter input."""
+        return float(self.bank.xv[self.channel, self.filterIndex, 0, 0])
+
+    def readOutput(self):
+        """Return output of last section."""
+        return self._yv()[0]
+
+    def readPrevOutput(self):
+        """Return previous output of last section."""
+        return self._yv()[1]
+
+    def detectPosPeak(self):
+        """Detect peaks in last section."""
+        yv = self._yv()
+        if (yv[0] < yv[1] and yv[1] >= yv[2]):
+            return yv[1]
+        else:
+            return None
+
+    def detectNegPeak(self):
+        """Detect peaks in last section."""
+        yv = self._yv()
+        if (yv[0] > yv[1] and yv[1] <= yv[2]):
+            return yv[1]
+        else:
+            return None
+
+    def getState(self):
+        """Return the state of every section, in the same form as CascadedFilter."""
+        xv = self.bank.xv[self.channel, self.filterIndex]
+        yv = self.bank.yv[self.channel, self.filterIndex]
+        return [(xv[section].tolist(), yv[section].tolist())
+                for section in range(self.bank.NUM_SECTIONS)]
+
+    def setState(self, state):
+        self.bank.setState(self.channel, self.filterIndex, state)
+
+
+if __name__ == "__main__":
+
+    # Compare the bank against individual CascadedFilters
+    import random
+    import FilterCascaded
+
+    random.seed(1)
+    bank = FilterBank()
+    filters = []
+    views = []
+    for channel in range(10):
+        bank.register()
+        for filterIndex in range(NUM_FILTERS):
+            b = random.randint(0, 6)
+            cascaded = FilterCascaded.CascadedFilter()
+            cascaded.setCoefficients(b)
+            cascaded.init(20.0)
+            view = bank.view(channel, filterIndex)
+            view.setCoefficients(b)
+            view.init(20.0)
+            filters.append(cascaded)
+            views.append(view)
+
+    worst = 0.0
+    for i in range(1000):
+        for cascaded, view in zip(filters, views):
+            val = 20.0 + random.uniform(-1, 1)
+            cascaded.add(val)
+            view.add(val)
+        bank.step()
+        for cascaded, view in zip(filters, views):
+            worst = max(worst, abs(cascaded.readOutput() - view.readOutput()))
+
+    print("Max difference between FilterBank and CascadedFilter: %.3g" % worst)
+    assert worst < 1e-9
@@ -33,15 +33,23 @@ import FilterFixed
 # attenuation in dB.
 # The delay is also tripled.
 
+# Filter sections can use Decimal arithmetic (the original Python port)
+# or the integer fixed-point engine used by the BrewPi firmware, which
+# is much cheaper to run.
+FILTER_BACKENDS = {'decimal': FilterFixed.FixedFilter,
+                   'integer': FilterFixed.IntegerFixedFilter,
+                   }
+
 
 class CascadedFilter:
     """CascadedFilter implements a filter consisting of multiple second order sections."""
 
-    def __init__(self, NUM_SECTIONS=3):
+    def __init__(self, NUM_SECTIONS=3, backend='decimal'):
         self.NUM_SECTIONS = NUM_SECTIONS
+        self.backend = backend
         self.sections = []
         for i in range(self.NUM_SECTIONS):
-            self.sections.append(FilterFixed.FixedFilter(b=2))
+            self.sections.append(FILTER_BACKENDS[backend](b=2))
 
     def setCoefficients(self, bValue):
         for section in self.sections:
@@ -54,13 +62,87 @@ class CascadedFilter:
     def add(self, val):
         # adds a value and returns the most recent filter output
         # val is input for next section, which is the output of the previous section
-        # Internally we use Decimal, but other callers expect float.
+        # Internally we use Decimal or fixed point, but other callers expect float.
+        if self.backend == 'integer':
+            val = FilterFixed.toFixed(val)
+            for section in self.sections:
+                val = section.addFixed(val)
+
+            return FilterFixed.fromFixed(val)
+
         val = Decimal(val)
         for section in self.sections:
             val = section.add(val)
 
         return float(val)
 
+    def addDoublePrecision(self, val):
+        """Add a value the firmware calculates in the filter format, like
+        the slope, so the integer backend does not round it to fixed7_9."""
+        if self.backend == 'integer':
+            val = FilterFixed.toFixedPrecise(val)
+            for section in self.sections:
+                val = section.addFixed(val)
+
+            return FilterFixed.fromFixed(val)
+
+        return self.add(val)
+
+    def getState(self):
+        """Return the state of every section, as a list."""
+        return [section.getState() for section in self.sections]
+
+    def setState(self, state):
+        for section, sectionState in zip(self.sections, state):
+            section.setState(sectionState)
+
+    def filter_array(self, samples, initial_state=None, exact=False):
+        """Filter a whole sequence of samples in one call.
+
+        Returns the outputs of the last section, and the state after the
+        last sample in the same form as getState().  If initial_state is
+        None the filter starts settled at the first sample, as after
+        init().  The results match calling add() for every sample, but
+        the filter itself is not changed.
+
+        The integer backend can only be run exactly sample by sample, in
+        Python, which takes about 2 s per million samples.  So unless
+        exact is set (or numpy is missing) its input is rounded to fixed7_9
+        as add() does and then filtered like the decimal backend, by FFT.
+        Without the truncation of each shift, that output is higher than
+        add() by up to NUM_SECTIONS * 2^(a-1) units of the filter format,
+        3e-3 degrees for b=6.
+        """
+        if initial_state is None:
+            initial_state = [None] * self.NUM_SECTIONS
+
+        state = []
+        if self.backend == 'integer' and (exact or FilterFixed.numpy is None):
+            values = [FilterFixed.toFixed(val) for val in samples]
+            for section, sectionState in zip(self.sections, initial_state):
+                values, sectionState = section.filter_array_fixed(values, sectionState)
+                state.append(sectionState)
+
+            return [FilterFixed.fromFixed(val) for val in values], state
+
+        if self.backend == 'integer':
+            values = FilterFixed.roundToTemperatures(samples)
+            for section, sectionState in zip(self.sections, initial_state):
+                if sectionState is not None:
+                    sectionState = [[FilterFixed.fromFixed(val) for val in taps] for taps in sectionState]
+                values, sectionState = FilterFixed.FixedFilter(section.b).filter_array(values, sectionState)
+                state.append(([FilterFixed.toFixedPrecise(val) for val in sectionState[0]],
+                              [FilterFixed.toFixedPrecise(val) for val in sectionState[1]]))
+
+            return values, state
+
+        values = samples
+        for section, sectionState in zip(self.sections, initial_state):
+            values, sectionState = section.filter_array(values, sectionState)
+            state.append(sectionState)
+
+        return values, state
+
     def readInput(self):
         """Returns the most recent filter input."""
         return self.sections[0].readInput()  # return input of first section
@@ -80,3 +162,46 @@ class CascadedFilter:
     def detectNegPeak(self):
         """Detect peaks in last section."""
         return self.sections[-1].detectNegPeak()
+
+
+if __name__ == "__main__":
+
+    # Check that filter_array() matches the streaming add() path
+    import random
+    import time
+
+    random.seed(1)
+    samples = [20.0]
+    for i in range(20000):
+        samples.append(round((samples[-1] + random.uniform(-0.1, 0.1)) * 16) / 16)
+    half = len(samples) // 2
+
+    for backend, exact in (('decimal', False), ('integer', True), ('integer', False)):
+        for b in range(7):
+            streaming = CascadedFilter(backend=backend)
+            streaming.setCoefficients(b)
+            streaming.init(samples[0])
+            expected = [streaming.add(val) for val in samples]
+
+            batch = CascadedFilter(backend=backend)
+            batch.setCoefficients(b)
+            first, state = batch.filter_array(samples[:half], exact=exact)
+            second, state = batch.filter_array(samples[half:], state, exact=exact)
+            outputs = list(first) + list(second)
+
+            worst = max(abs(x - y) for x, y in zip(expected, outputs))
+            if backend == 'decimal':
+                tolerance = 1e-9
+            elif exact:
+                tolerance = 0
+            else:
+                tolerance = FilterFixed.fromFixed(batch.NUM_SECTIONS * 2 ** (b * 2 + 3)) + 1e-9
+            print("%s%s b=%s: max difference %.3g" % (backend, " exact" if exact else "", b, worst))
+            assert worst <= tolerance
+
+    samples = [20.0 + random.uniform(-0.5, 0.5) for i in range(1000000)]
+    for backend, exact in (('decimal', False), ('integer', True), ('integer', False)):
+        batch = CascadedFilter(backend=backend)
+        start = time.time()
+        batch.filter_array(samples, exact=exact)
+        print("%s%s: %s samples in %.2f s" % (backend, " exact" if exact else "", len(samples), time.time() - start))
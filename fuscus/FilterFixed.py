@@ -24,6 +24,11 @@
 
 from decimal import Decimal
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class FixedFilter:
     """
@@ -138,3 +143,340 @@ of cascades.
             return float(self.yv[1])
         else:
             return None
+
+    def getState(self):
+        """Return the filter history as floats, (xv, yv), newest first."""
+        return ([float(x) for x in self.xv], [float(y) for y in self.yv])
+
+    def setState(self, state):
+        xv, yv = state
+        self.xv = [Decimal(x) for x in xv]
+        self.yv = [Decimal(y) for y in yv]
+
+    def filter_array(self, samples, initial_state=None):
+        """Filter a whole sequence of samples in one call.
+
+        Returns the outputs, and the filter state after the last sample
+        in the same form as getState().  If initial_state is None the
+        filter starts settled at the first sample, as after init().
+        The filter itself is not changed.
+
+        When numpy is available long sequences are filtered by FFT
+        convolution and the outputs are returned as a numpy array,
+        otherwise a direct-form recurrence is used and a list returned.
+        """
+        if initial_state is None:
+            start = float(samples[0]) if len(samples) else float('nan')
+            initial_state = ([start] * 3, [start] * 3)
+        xv, yv = initial_state
+
+        if numpy is not None and len(samples) > 4 * len(_impulseResponse(self.b)):
+            outputs = _filterFFT(numpy.asarray(samples, dtype=float), self.b, xv, yv)
+        else:
+            outputs = _filterRecurrence([float(val) for val in samples], self.b, xv, yv)
+
+        state = ([float(x) for x in _taps(xv, samples)], [float(y) for y in _taps(yv, outputs)])
+        return outputs, state
+
+
+def _taps(history, values):
+    """Return the three most recent values, newest first, after adding values to history."""
+    taps = list(values[-3:])[::-1]
+    return taps + list(history[:3 - len(taps)])
+
+
+def _filterRecurrence(samples, b, xv, yv):
+    """Run the FixedFilter difference equation over a list of floats."""
+    gainB = 2.0 ** -b
+    gainA = 2.0 ** -(b * 2 + 4)
+    c1 = 2 - gainB
+    c2 = gainB - 1 - 4 * gainA
+
+    x1, x2 = xv[0], xv[1]
+    y1, y2 = yv[0], yv[1]
+    outputs = []
+    append = outputs.append
+    for x0 in samples:
+        y0 = c1 * y1 + c2 * y2 + gainA * (x0 + x1 + x1 + x2)
+        append(y0)
+        x2 = x1
+        x1 = x0
+        y2 = y1
+        y1 = y0
+
+    return outputs
+
+
+_impulseResponses = {}
+
+
+def _impulseResponse(b):
+    """Return the impulse response of a filter section, truncated once it has decayed."""
+    if b not in _impulseResponses:
+        gainA = 2.0 ** -(b * 2 + 4)
+        # For a = 2b+4 the section has a double pole at p.
+        p = 1 - 2.0 ** -(b + 1)
+        length = 16
+        while length * (1 - p) < 1 or gainA * (length + 1) * p ** length > 1e-18:
+            length *= 2
+
+        if numpy is None:
+            _impulseResponses[b] = [None] * (length + 2)  # Only the length is used
+        else:
+            n = numpy.arange(length)
+            poles = (n + 1) * p ** n
+            response = numpy.zeros(length + 2)
+            response[:length] += poles
+            response[1:length + 1] += 2 * poles
+            response[2:] += poles
+            _impulseResponses[b] = response * gainA
+
+    return _impulseResponses[b]
+
+
+def _filterFFT(samples, b, xv, yv):
+    """Filter a numpy array by FFT convolution with the section impulse response."""
+    response = _impulseResponse(b)
+
+    # The DC gain is exactly 1, so filter around the first sample to keep
+    # the numbers small.
+    offset = samples[0]
+    size = 1 << (len(samples) + len(response) - 2).bit_length()
+    spectrum = numpy.fft.rfft(samples - offset, size) * numpy.fft.rfft(response, size)
+    outputs = numpy.fft.irfft(spectrum, size)[:len(samples)] + offset
+
+    # Add the response to the initial state, which dies away within the
+    # length of the impulse response.
+    settle = _filterRecurrence([0.0] * min(len(samples), len(response)), b,
+                               [x - offset for x in xv], [y - offset for y in yv])
+    outputs[:len(settle)] += settle
+
+    return outputs
+
+
+# The BrewPi firmware stores temperatures as fixed7_9 in an int16
+# (temperature) and the filters add another 16 fraction bits in an int32
+# (temperature_precise), so the integer engine works with 25 fraction bits.
+TEMP_FRACTION_BITS = 9
+PRECISE_EXTRA_BITS = 16
+FIXED_FRACTION_BITS = TEMP_FRACTION_BITS + PRECISE_EXTRA_BITS
+FIXED_ONE = 1 << FIXED_FRACTION_BITS
+
+INT16_MIN, INT16_MAX = -(1 << 15), (1 << 15) - 1
+INT32_MIN, INT32_MAX = -(1 << 31), (1 << 31) - 1
+
+
+def wrapInt32(val):
+    """Wrap an integer around like an int32 on the AVR."""
+    return ((val - INT32_MIN) & 0xFFFFFFFF) + INT32_MIN
+
+
+def toTemperature(val):
+    """Convert a float to fixed7_9, rounded and limited to the int16 range
+    like the firmware's constrainTemp16()."""
+    return max(INT16_MIN, min(INT16_MAX, int(round(val * (1 << TEMP_FRACTION_BITS)))))
+
+
+def regularToPrecise(val):
+    """tempRegularToPrecise(): fixed7_9 to the filter format."""
+    return val << PRECISE_EXTRA_BITS
+
+
+def preciseToRegular(val):
+    """tempPreciseToRegular(): the filter format to fixed7_9, rounded."""
+    return (val + (1 << (PRECISE_EXTRA_BITS - 1))) >> PRECISE_EXTRA_BITS
+
+
+def toFixed(val):
+    """Convert a float temperature to the integer filter format the way
+    the firmware gets its filter input: as a fixed7_9 temperature."""
+    return regularToPrecise(toTemperature(val))
+
+
+def toFixedPrecise(val):
+    """Convert a float to the integer filter format at full precision,
+    limited to the int32 range.  For inputs the firmware calculates in
+    the filter format, like the slope."""
+    return max(INT32_MIN, min(INT32_MAX, int(round(val * FIXED_ONE))))
+
+
+def fromFixed(val):
+    """Convert a value in integer filter format back to a float."""
+    return val / FIXED_ONE
+
+
+def roundToTemperatures(samples):
+    """Round a numpy array of floats to fixed7_9 like toTemperature(),
+    but keep them as floats."""
+    scale = 1 << TEMP_FRACTION_BITS
+    return numpy.clip(numpy.round(numpy.asarray(samples, dtype=float) * scale), INT16_MIN, INT16_MAX) / scale
+
+
+class IntegerFixedFilter:
+    """Integer fixed-point version of FixedFilter.
+
+    This follows the arithmetic of the BrewPi firmware step by step:
+    temperatures go in as fixed7_9 (init() and add()), or in the 32 bit
+    filter format (initFixed() and addFixed(), the firmware's
+    addDoublePrecision()), the same shifts are done in the same order,
+    and the sum wraps around at 32 bits.  Python's >> is an arithmetic
+    (flooring) shift, like on the AVR.  So given the same inputs the
+    filter state matches the firmware's after every sample.
+
+    Unlike the firmware, add(), readOutput() and friends return the
+    output at full precision (readOutputDoublePrecision()), not rounded
+    to fixed7_9.
+
+    Compared with the Decimal FixedFilter the output is lower by up to
+    2^(a-1) units of the filter format, as every shift truncates (2.5e-4
+    degrees at b=6 on a random walk), plus up to 1/1024 degree for
+    inputs that are not a multiple of 1/512, from the rounding to fixed7_9.
+
+    The shift amounts are calculated once in setCoefficients() and the
+    history is kept in fixed slots, so add() does no allocation apart
+    from the resulting integers.
+    """
+
+    def __init__(self, b=2):
+        # The firmware filters are zero-initialised, not NaN.
+        self.x0 = self.x1 = self.x2 = 0
+        self.y0 = self.y1 = self.y2 = 0
+
+        self.setCoefficients(b)
+
+    def setCoefficients(self, b):
+        self.a = b * 2 + 4
+        self.b = b
+        self._a1 = self.a - 1
+        self._a2 = self.a - 2
+
+    def init(self, val):
+        self.initFixed(toFixed(val))
+
+    def initFixed(self, val):
+        self.x0 = self.x1 = self.x2 = val
+        self.y0 = self.y1 = self.y2 = val
+
+    def add(self, val):
+        return fromFixed(self.addFixed(toFixed(val)))
+
+    def addFixed(self, val):
+        """Add a value in integer filter format and return the new output."""
+        x2 = self.x2 = self.x1
+        x1 = self.x1 = self.x0
+        self.x0 = val
+        y2 = self.y2 = self.y1
+        y1 = self.y1 = self.y0
+        a = self.a
+        b = self.b
+
+        # Same order of operations as the firmware, to prevent overflow.
+        # Where it does overflow, the int32 wraps around.
+        y0 = (((y1 - y2) + y1) -
+              (y1 >> b) + (y2 >> b) +
+              (val >> a) + (x1 >> self._a1) + (x2 >> a) -
+              (y2 >> self._a2))
+        if not INT32_MIN <= y0 <= INT32_MAX:
+            y0 = wrapInt32(y0)
+        self.y0 = y0
+
+        return y0
+
+    def readInput(self):
+        return fromFixed(self.x0)
+
+    def readOutput(self):
+        return fromFixed(self.y0)
+
+    def readPrevOutput(self):
+        return fromFixed(self.y1)
+
+    def detectPosPeak(self):
+        if (self.y0 < self.y1 and self.y1 >= self.y2):
+            return fromFixed(self.y1)
+        else:
+            return None
+
+    def detectNegPeak(self):
+        if (self.y0 > self.y1 and self.y1 <= self.y2):
+            return fromFixed(self.y1)
+        else:
+            return None
+
+    def getState(self):
+        """Return the filter history in integer format, (xv, yv), newest first."""
+        return ([self.x0, self.x1, self.x2], [self.y0, self.y1, self.y2])
+
+    def setState(self, state):
+        (self.x0, self.x1, self.x2), (self.y0, self.y1, self.y2) = state
+
+    def filter_array(self, samples, initial_state=None):
+        """Filter a whole sequence of float samples in one call.
+
+        Returns a list of outputs and the final state, see filter_array_fixed().
+        """
+        outputs, state = self.filter_array_fixed([toFixed(val) for val in samples], initial_state)
+        return [fromFixed(val) for val in outputs], state
+
+    def filter_array_fixed(self, samples, initial_state=None):
+        """Filter a list of values in integer format in one call.
+
+        Returns the outputs, and the filter state after the last sample
+        in the same form as getState().  If initial_state is None the
+        filter starts settled at the first sample.  The results are
+        identical to calling addFixed() for each sample, but the filter
+        itself is not changed.
+        """
+        if initial_state is None:
+            start = samples[0] if samples else 0
+            initial_state = ([start] * 3, [start] * 3)
+        xv, yv = initial_state
+
+        a = self.a
+        a1 = self._a1
+        a2 = self._a2
+        b = self.b
+        x1, x2 = xv[0], xv[1]
+        y1, y2 = yv[0], yv[1]
+        outputs = []
+        append = outputs.append
+        for x0 in samples:
+            y0 = ((((y1 - y2) + y1) -
+                   (y1 >> b) + (y2 >> b) +
+                   (x0 >> a) + (x1 >> a1) + (x2 >> a) -
+                   (y2 >> a2) - INT32_MIN) & 0xFFFFFFFF) + INT32_MIN
+            append(y0)
+            x2 = x1
+            x1 = x0
+            y2 = y1
+            y1 = y0
+
+        return outputs, (_taps(xv, samples), _taps(yv, outputs))
+
+
+if __name__ == "__main__":
+
+    # Compare the integer engine against the Decimal implementation.
+    # The firmware truncates on every shift, so the integer output is
+    # biased low by up to 2^(a-1) LSB.  The samples are DS18B20 readings,
+    # which fixed7_9 holds exactly.
+    import random
+
+    random.seed(1)
+    samples = [20.0]
+    for i in range(5000):
+        samples.append(round((samples[-1] + random.uniform(-0.1, 0.1)) * 16) / 16)
+
+    for b in range(7):
+        decimalFilter = FixedFilter(b)
+        integerFilter = IntegerFixedFilter(b)
+        decimalFilter.init(samples[0])
+        integerFilter.init(samples[0])
+
+        tolerance = fromFixed(2 ** (integerFilter.a - 2) * 2)
+        worst = 0.0
+        for sample in samples:
+            worst = max(worst, abs(decimalFilter.add(sample) - integerFilter.add(sample)))
+
+        print("b=%s: max difference %.3g (tolerance %.3g)" % (b, worst, tolerance))
+        assert worst <= tolerance
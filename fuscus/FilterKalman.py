@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Kalman filter estimating temperature and its rate of change."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Readings further than this many standard deviations from the prediction
+# are rejected.  After MAX_REJECTS in a row the temperature is taken to
+# have really changed (the door was opened), and the filter restarts from
+# the reading.
+GATE_SIGMAS = 4
+MAX_REJECTS = 5
+
+
+class KalmanFilter:
+    """Track temperature T and rate r (degrees per second).
+
+    The model is a constant rate with random changes of rate: processNoise
+    is the spectral density of the rate changes, in degrees^2/s^3.  Each
+    reading is T plus noise with standard deviation measurementNoise.
+
+    The state is two numbers and the covariance three (it is symmetric),
+    kept as plain floats, so each step costs the same small amount.
+    Readings from several probes measuring the same temperature can be
+    fused by calling update() once for each after a single predict().
+    """
+
+    def __init__(self, processNoise=1e-12, measurementNoise=0.05, samplePeriod=1.0):
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.samplePeriod = samplePeriod
+        self.rejectedCount = 0
+        self.init(None)
+
+    def init(self, val):
+        self.temperature = val
+        self.rate = 0.0
+        # Start uncertain, so the first readings are followed quickly
+        self.pTT = self.measurementNoise ** 2
+        self.pTr = 0.0
+        self.prr = (1.0 / 3600) ** 2  # 1 degree per hour
+        self.rejects = 0
+
+    def predict(self):
+        """Advance the state by one sample period."""
+        if self.temperature is None:
+            return
+        dt = self.samplePeriod
+        q = self.processNoise
+        self.temperature += self.rate * dt
+        # P = F P F' + Q, with F = [[1, dt], [0, 1]]
+        self.pTT += dt * (2 * self.pTr + dt * self.prr) + q * dt ** 3 / 3
+        self.pTr += dt * self.prr + q * dt ** 2 / 2
+        self.prr += q * dt
+
+    def update(self, val, measurementNoise=None):
+        """Correct the state with a reading.  Returns False if it was rejected."""
+        if self.temperature is None:
+            self.init(val)
+            return True
+
+        r = (measurementNoise if measurementNoise is not None else self.measurementNoise) ** 2
+        innovation = val - self.temperature
+        s = self.pTT + r
+        if innovation * innovation > GATE_SIGMAS ** 2 * s:
+            if self.rejects < MAX_REJECTS:
+                self.rejects += 1
+                self.rejectedCount += 1
+                return False
+            self.init(val)
+            return True
+        self.rejects = 0
+
+        kT = self.pTT / s
+        kr = self.pTr / s
+        self.temperature += kT * innovation
+        self.rate += kr * innovation
+        # P = (I - K H) P
+        self.prr -= kr * self.pTr
+        self.pTr -= kr * self.pTT
+        self.pTT -= kT * self.pTT
+        return True
+
+    def add(self, val):
+        """Predict and update with one reading.  Returns the temperature."""
+        self.predict()
+        self.update(val)
+        return self.temperature
+
+    def readOutput(self):
+        return self.temperature
+
+    def readSlope(self):
+        """Return slope per hour."""
+        return self.rate * 3600
+
+    def getState(self):
+        return [self.temperature, self.rate, self.pTT, self.pTr, self.prr]
+
+    def setState(self, state):
+        self.temperature, self.rate, self.pTT, self.pTr, self.prr = state
+        self.rejects = 0
+
+
+if __name__ == "__main__":
+
+    # Compare against the cascaded filter on a noisy ramp
+    import random
+    import FilterCascaded
+
+    random.seed(1)
+    kalman = KalmanFilter()
+    cascaded = FilterCascaded.CascadedFilter()
+    cascaded.setCoefficients(2)
+    kalman.init(20.0)
+    cascaded.init(20.0)
+
+    slope = 1.0 / 3600  # 1 degree per hour
+    kalmanError = cascadedError = 0.0
+    slopes = []
+    for i in range(7200):
+        true = 20.0 + slope * i
+        val = round((true + random.gauss(0, 0.03)) * 16) / 16
+        if i == 5000:
+            val = 85.0
+        kalman.add(val)
+        cascaded.add(val)
+        if i > 3600 and i != 5000:
+            kalmanError = max(kalmanError, abs(kalman.readOutput() - true))
+            cascadedError = max(cascadedError, abs(cascaded.readOutput() - true))
+            slopes.append(kalman.readSlope())
+
+    print("Max error, Kalman: %.3f  cascaded: %.3f" % (kalmanError, cascadedError))
+    meanSlope = sum(slopes) / len(slopes)
+    print("Kalman mean slope: %.3f /h, %d rejected" % (meanSlope, kalman.rejectedCount))
+    assert kalmanError < cascadedError
+    assert abs(meanSlope - 1.0) < 0.1
+    assert kalman.rejectedCount >= 1
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Reject single bad readings before they reach the filters."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import heapq
+
+
+class MedianOutlierFilter:
+    """Running median filter over the last `window` samples.
+
+    A sample further than `threshold` degrees from the median of the
+    window is replaced by the median.
+
+    Every sample still enters the window, rejected or not, so a real step
+    in temperature is passed through once it fills half the window.
+
+    The window is kept in arrival order (a ring buffer) and in two heaps,
+    the lower half as a max-heap and the upper half as a min-heap, so the
+    median is on top of them.  A sample leaving the window is only marked
+    as removed, and dropped once it reaches the top of its heap, so each
+    sample costs O(log window).  Marked samples deep in a heap would pile
+    up if the temperature keeps rising or falling, so the heaps are rebuilt
+    from the window when they reach twice its size, which adds O(1) per
+    sample on average.
+    """
+
+    def __init__(self, window=5, threshold=1.0):
+        self.window = window
+        self.threshold = threshold
+        self.rejectedCount = 0
+        self.init()
+
+    def init(self):
+        self.values = []  # Ring buffer, in arrival order
+        self.index = 0  # Where the next sample goes once the window is full
+        self.low = []  # Lower half, negated for a max-heap
+        self.high = []  # Upper half
+        self.lowSize = 0  # Samples in each half, without those marked as removed
+        self.highSize = 0
+        self.removed = {}  # Sample -> how many of it are marked as removed
+
+    def prune(self, heap, sign):
+        """Drop the samples marked as removed from the top of a heap."""
+        while heap:
+            val = sign * heap[0]
+            count = self.removed.get(val)
+            if not count:
+                return
+            if count == 1:
+                del self.removed[val]
+            else:
+                self.removed[val] = count - 1
+            heapq.heappop(heap)
+
+    def balance(self):
+        """Keep the lower half the same size as the upper, or one larger."""
+        if self.lowSize > self.highSize + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.lowSize -= 1
+            self.highSize += 1
+            self.prune(self.low, -1)
+        elif self.lowSize < self.highSize:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.lowSize += 1
+            self.highSize -= 1
+            self.prune(self.high, 1)
+
+    def insert(self, val):
+        if not self.low or val <= -self.low[0]:
+            heapq.heappush(self.low, -val)
+            self.lowSize += 1
+        else:
+            heapq.heappush(self.high, val)
+            self.highSize += 1
+        self.balance()
+
+    def remove(self, val):
+        self.removed[val] = self.removed.get(val, 0) + 1
+        if val <= -self.low[0]:
+            self.lowSize -= 1
+            self.prune(self.low, -1)
+        else:
+            self.highSize -= 1
+            self.prune(self.high, 1)
+        self.balance()
+
+    def rebuild(self):
+        """Rebuild the heaps from the window, without the removed samples."""
+        ordered = sorted(self.values)
+        half = (len(ordered) + 1) // 2
+        self.low = [-val for val in ordered[:half]]
+        heapq.heapify(self.low)
+        self.high = ordered[half:]  # A sorted list is a heap
+        self.lowSize = half
+        self.highSize = len(ordered) - half
+        self.removed.clear()
+
+    def median(self):
+        if self.lowSize == 0:
+            return None
+        if self.lowSize > self.highSize:
+            return -self.low[0]
+        return (-self.low[0] + self.high[0]) / 2
+
+    def add(self, val):
+        """Add a sample and return it, or the median if it is an outlier."""
+        if len(self.values) < self.window:
+            self.values.append(val)
+        else:
+            self.remove(self.values[self.index])
+            self.values[self.index] = val
+            self.index = (self.index + 1) % self.window
+        self.insert(val)
+        if len(self.low) + len(self.high) > 2 * self.window:
+            self.rebuild()
+
+        # Need a few samples before the median means anything
+        if len(self.values) < 3:
+            return val
+
+        median = self.median()
+        if abs(val - median) > self.threshold:
+            self.rejectedCount += 1
+            return median
+        return val
+
+
+if __name__ == "__main__":
+
+    outlierFilter = MedianOutlierFilter(window=5, threshold=0.5)
+    samples = [20.0, 20.1, 20.0, 20.1, 85.0, 20.0, 20.1, -127.0, 20.0, 25.0, 25.0, 25.0, 25.0]
+    output = [outlierFilter.add(val) for val in samples]
+    print(output)
+    assert max(output[:9]) < 21.0 and min(output[:9]) > 19.0
+    assert output[-1] == 25.0  # A real step gets through
+    assert outlierFilter.rejectedCount == 4  # Two spikes, and the step is held for two samples
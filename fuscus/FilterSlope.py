@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Streaming least squares slope estimator."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+class RegressionSlope:
+    """Slope of a least squares line through the last `window` samples.
+
+    This is an alternative to taking differences of the slow filter and
+    filtering them again.  A straight line fit over a window of W samples
+    lags by W/2, and suppresses noise well, so the slope is available much
+    sooner for the same noise level.
+
+    The samples are kept in a ring buffer, and the sums needed for the fit
+    are updated as samples enter and leave the window, so add() costs the
+    same however long the window is.  To stop rounding errors building up
+    the sums are recalculated from the buffer once per window length.
+    """
+
+    def __init__(self, window=300, samplePeriod=1.0):
+        """window is the number of samples to fit.  samplePeriod is the
+        time between samples in seconds."""
+        self.window = window
+        self.samplePeriod = samplePeriod
+        self.init()
+
+    def init(self):
+        self.values = [0.0] * self.window  # Ring buffer
+        self.index = 0  # Where the next sample goes (and the oldest is)
+        self.count = 0
+        # x is 0 for the oldest sample in the window and count-1 for the newest
+        self.sumY = 0.0
+        self.sumXY = 0.0
+        self.addsSinceRecalculate = 0
+
+    def add(self, val):
+        """Add a sample and return the slope in degrees per hour."""
+        if self.count < self.window:
+            self.sumXY += self.count * val
+            self.sumY += val
+            self.count += 1
+        else:
+            # The oldest sample leaves, and every other x is one less
+            oldest = self.values[self.index]
+            self.sumXY += (self.window - 1) * val - (self.sumY - oldest)
+            self.sumY += val - oldest
+
+        self.values[self.index] = val
+        self.index += 1
+        if self.index == self.window:
+            self.index = 0
+
+        self.addsSinceRecalculate += 1
+        if self.addsSinceRecalculate >= self.window:
+            self._recalculate()
+
+        return self.readSlope()
+
+    def _recalculate(self):
+        if self.count < self.window:
+            ordered = self.values[:self.count]
+        else:
+            ordered = self.values[self.index:] + self.values[:self.index]
+        self.sumY = sum(ordered)
+        self.sumXY = sum(x * y for x, y in enumerate(ordered))
+        self.addsSinceRecalculate = 0
+
+    def readSlope(self):
+        """Return slope per hour."""
+        n = self.count
+        if n < 2:
+            return 0.0
+        sumX = n * (n - 1) / 2
+        sumXX = (n - 1) * n * (2 * n - 1) / 6
+        slope = (n * self.sumXY - sumX * self.sumY) / (n * sumXX - sumX * sumX)
+        return slope * 3600 / self.samplePeriod
+
+    def getState(self):
+        if self.count < self.window:
+            return self.values[:self.count]
+        return self.values[self.index:] + self.values[:self.index]
+
+    def setState(self, state):
+        self.init()
+        for val in state[-self.window:]:
+            self.add(val)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Detect peaks in a stream of filtered temperatures."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+
+
+class PeakDetector:
+    """Find maxima and minima over the last `lookback` samples.
+
+    FixedFilter.detectPosPeak() only compares the last three outputs, so
+    a peak is missed if it is flat or noisy.  This class keeps the
+    maximum and minimum of a sliding window in monotonic deques, which
+    costs amortized O(1) per sample and never holds more than lookback
+    entries.
+
+    A positive peak must rise at least `prominence` above the lowest
+    point before it, and is reported once the signal has fallen at least
+    `prominence` below it.  Negative peaks are the same, upside down.
+    Each peak is reported once.
+    """
+
+    def __init__(self, lookback=1800, prominence=0.1):
+        self.lookback = lookback
+        self.prominence = prominence
+
+        self.maxima = collections.deque()  # (index, value), values decreasing
+        self.minima = collections.deque()  # (index, value), values increasing
+        self.index = 0
+        self.latest = None
+        self.reset()
+
+    def add(self, val):
+        index = self.index
+
+        while self.maxima and self.maxima[-1][1] <= val:
+            self.maxima.pop()
+        self.maxima.append((index, val))
+        if self.maxima[0][0] <= index - self.lookback:
+            self.maxima.popleft()
+
+        while self.minima and self.minima[-1][1] >= val:
+            self.minima.pop()
+        self.minima.append((index, val))
+        if self.minima[0][0] <= index - self.lookback:
+            self.minima.popleft()
+
+        # Arm detection of a positive peak once the signal has risen far
+        # enough from its lowest point, and forget any maxima before that.
+        if not self.posArmed:
+            if self.lowest is None or val < self.lowest:
+                self.lowest = val
+                self.lowestIndex = index
+            elif val >= self.lowest + self.prominence:
+                self.posArmed = True
+                self._discard(self.maxima, self.lowestIndex)
+
+        if not self.negArmed:
+            if self.highest is None or val > self.highest:
+                self.highest = val
+                self.highestIndex = index
+            elif val <= self.highest - self.prominence:
+                self.negArmed = True
+                self._discard(self.minima, self.highestIndex)
+
+        self.latest = val
+        self.index += 1
+
+    def reset(self):
+        """Ignore any peaks up to the most recent sample."""
+        self.posArmed = False
+        self.lowest = self.latest
+        self.lowestIndex = self.index - 1
+
+        self.negArmed = False
+        self.highest = self.latest
+        self.highestIndex = self.index - 1
+
+    @staticmethod
+    def _discard(extrema, upto):
+        """Drop entries up to and including index upto, keeping the newest."""
+        while len(extrema) > 1 and extrema[0][0] <= upto:
+            extrema.popleft()
+
+    def detectPosPeak(self):
+        """Return the value of a new positive peak, or None."""
+        if not self.posArmed:
+            return None
+        peak = self.maxima[0][1]
+        if self.latest <= peak - self.prominence:
+            self.posArmed = False
+            self.lowest = self.latest
+            self.lowestIndex = self.index - 1
+            return peak
+        return None
+
+    def detectNegPeak(self):
+        """Return the value of a new negative peak, or None."""
+        if not self.negArmed:
+            return None
+        peak = self.minima[0][1]
+        if self.latest >= peak + self.prominence:
+            self.negArmed = False
+            self.highest = self.latest
+            self.highestIndex = self.index - 1
+            return peak
+        return None
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Fixed size history of timestamped sensor samples."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import array
+
+# Timestamps are stored in tenths of a second, temperatures in 1/128 degree
+TIME_SCALE = 10
+TEMP_SCALE = 128
+
+# Stored in place of a missing reading, as in BrewPi
+INVALID_TEMP = -32768
+
+
+def toStored(temp):
+    if temp is None:
+        return INVALID_TEMP
+    return max(-32767, min(32767, round(temp * TEMP_SCALE)))
+
+
+def fromStored(val):
+    if val == INVALID_TEMP:
+        return None
+    return val / TEMP_SCALE
+
+
+def toSeconds(stored):
+    return stored / TIME_SCALE
+
+
+class SampleHistory:
+    """Ring buffer of (time, raw, filtered) samples.
+
+    Each sample takes 8 bytes in three arrays: the time as an unsigned 32
+    bit count of tenths of a second, and the raw and filtered temperatures
+    as 16 bit counts of 1/128 degree (the DS18B20 resolution is 1/16).
+    A day at one sample per second is 86400 samples, or 675 KiB.
+
+    Times must not go backwards (use ticks.monotonic()), so the samples are
+    in time order and a time range is found by binary search.  query()
+    returns memoryviews of the arrays, so nothing is copied.
+    """
+
+    def __init__(self, capacity=86400):
+        self.capacity = capacity
+        self.times = array.array('I', bytes(4 * capacity))
+        self.raw = array.array('h', bytes(2 * capacity))
+        self.filtered = array.array('h', bytes(2 * capacity))
+        self.start = 0  # Index of the oldest sample
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, t, raw, filtered):
+        """Record a sample.  t is in seconds, temperatures in degrees (or None)."""
+        if self.count < self.capacity:
+            index = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[index] = int(t * TIME_SCALE) & 0xffffffff
+        self.raw[index] = toStored(raw)
+        self.filtered[index] = toStored(filtered)
+
+    def _time(self, i):
+        """Return the stored time of the i'th oldest sample."""
+        return self.times[(self.start + i) % self.capacity]
+
+    def _bisect(self, stored):
+        """Return how many samples are older than the stored time."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time(mid) < stored:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, t0, t1):
+        """Return the samples with t0 <= t < t1 (in seconds).
+
+        The result is a list of up to two (times, raw, filtered) tuples of
+        memoryviews, as the range may wrap around the end of the buffer.
+        Use toSeconds() and fromStored() to convert the values."""
+        first = self._bisect(int(t0 * TIME_SCALE))
+        last = self._bisect(int(t1 * TIME_SCALE))
+        if first >= last:
+            return []
+
+        a = (self.start + first) % self.capacity
+        b = (self.start + last) % self.capacity
+        if a < b:
+            spans = [(a, b)]
+        else:
+            spans = [(a, self.capacity), (0, b)]
+            if b == 0:
+                spans.pop()
+
+        times = memoryview(self.times)
+        raw = memoryview(self.raw)
+        filtered = memoryview(self.filtered)
+        return [(times[i:j], raw[i:j], filtered[i:j]) for i, j in spans]
+
+    def latest(self):
+        """Return the time of the newest sample in seconds, or None."""
+        if self.count == 0:
+            return None
+        return toSeconds(self._time(self.count - 1))
+
+
+if __name__ == "__main__":
+
+    history = SampleHistory(capacity=100)
+    for i in range(250):
+        history.add(1000 + i, 20 + i / 100, None if i % 10 == 0 else 20.0)
+    assert len(history) == 100
+    print("%d samples, %d bytes" % (len(history), sum(
+        a.itemsize * len(a) for a in (history.times, history.raw, history.filtered))))
+
+    # A range which wraps around the end of the buffer
+    spans = history.query(1170, 1240)
+    times = [toSeconds(t) for span in spans for t in span[0]]
+    assert times == list(range(1170, 1240)), times
+    assert len(spans) == 2
+    raw = [fromStored(v) for span in spans for v in span[1]]
+    assert abs(raw[0] - 21.7) < 1 / TEMP_SCALE
+    assert fromStored(spans[0][2][0]) is None  # i = 170 had no reading
+    assert history.query(0, 1150) == []
+    assert history.latest() == 1249
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the filter and sensor update hot path.
+
+Runs the filters and the sensor update with synthetic temperatures, so
+no hardware is needed.  For 1, 10 and 100 channels it reports the time
+per sample, the throughput, and the memory use of the hot path:
+
+- peak transient bytes per tick: the peak of memory allocated within a
+  tick, over what was allocated before it, from tracemalloc.  This is
+  where the short-lived numbers and lists of the filters show up, which
+  are freed again by the end of the tick.  It is not a count of
+  allocations: CPython keeps none, and a tracemalloc snapshot only holds
+  the blocks which are still allocated.  A tick updates every channel,
+  and what one channel frees the next reuses, so this grows less than
+  in proportion to the channels.
+- retained blocks per sample: the change in sys.getallocatedblocks()
+  over the run, so objects which are allocated and kept (should be zero).
+- retained bytes per sample: the same, in bytes, from tracemalloc.
+
+Results are written as JSON so that runs of different versions can be
+compared with --compare.
+"""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import FilterBank
+import FilterCascaded
+import FilterFixed
+import tempSensor
+import w1Poller
+
+CHANNEL_COUNTS = (1, 10, 100)
+
+
+def makeSamples(count, seed=1):
+    """Return a random walk in 1/16 degree steps, like a DS18B20."""
+    rng = random.Random(seed)
+    samples = [20.0]
+    for i in range(count - 1):
+        samples.append(round((samples[-1] + rng.uniform(-0.1, 0.1)) * 16) / 16)
+    return samples
+
+
+def makeSensors(count, filterBackend, filterBank=None):
+    """Build sensors without hardware, reading from a poller which is never
+    started.  Readings are given to poller.store()."""
+    poller = w1Poller.w1Poller()
+    sensors = [tempSensor.sensor('bench-%d' % i, filterBackend=filterBackend, filterBank=filterBank,
+                                 poller=poller)
+               for i in range(count)]
+
+    for sensor in sensors:
+        poller.store(sensor.deviceID, 20.0)
+        sensor.init()
+    return poller, sensors
+
+
+def stopSensors(sensors):
+    for sensor in sensors:
+        sensor.stop()
+    for sensor in sensors:
+        sensor.join()
+
+
+def measure(name, channels, ticks, tick):
+    """Time tick(i) for i in range(ticks), where each tick processes one
+    sample on every channel."""
+    tick(0)  # Warm up
+
+    start = time.perf_counter_ns()
+    for i in range(ticks):
+        tick(i)
+    elapsed = time.perf_counter_ns() - start
+
+    blocks = sys.getallocatedblocks()
+    for i in range(ticks):
+        tick(i)
+    blocks = sys.getallocatedblocks() - blocks
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    peakTransient = 0
+    for i in range(ticks):
+        tracemalloc.reset_peak()
+        tickStart = tracemalloc.get_traced_memory()[0]
+        tick(i)
+        peakTransient += tracemalloc.get_traced_memory()[1] - tickStart
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    samples = ticks * channels
+    result = {'name': name,
+              'channels': channels,
+              'samples': samples,
+              'nsPerSample': elapsed / samples,
+              'samplesPerSecond': samples * 1e9 / elapsed,
+              'peakTransientBytesPerTick': peakTransient / ticks,
+              'retainedBlocksPerSample': blocks / samples,
+              'retainedBytesPerSample': (current - before) / samples,
+              }
+    print("%-28s %4d ch  %10.0f ns/sample  %10.0f samples/s  %8.0f peak transient B/tick"
+          "  %5.2f retained blocks/sample  %6.2f retained B/sample" % (
+              name, channels, result['nsPerSample'], result['samplesPerSecond'],
+              result['peakTransientBytesPerTick'], result['retainedBlocksPerSample'],
+              result['retainedBytesPerSample']))
+    return result
+
+
+def benchFilters(samples, results):
+    for backend, filterClass in FilterCascaded.FILTER_BACKENDS.items():
+        for channels in CHANNEL_COUNTS:
+            filters = [filterClass(b=4) for i in range(channels)]
+            for fixedFilter in filters:
+                fixedFilter.init(samples[0])
+
+            def tick(i):
+                val = samples[i]
+                for fixedFilter in filters:
+                    fixedFilter.add(val)
+
+            results.append(measure("FixedFilter.add/%s" % backend, channels, len(samples), tick))
+
+        for channels in CHANNEL_COUNTS:
+            filters = [FilterCascaded.CascadedFilter(backend=backend) for i in range(channels)]
+            for cascadedFilter in filters:
+                cascadedFilter.setCoefficients(4)
+                cascadedFilter.init(samples[0])
+
+            def tick(i):
+                val = samples[i]
+                for cascadedFilter in filters:
+                    cascadedFilter.add(val)
+
+            results.append(measure("CascadedFilter.add/%s" % backend, channels, len(samples), tick))
+
+    # The same filters as CascadedFilter.add, stepped together
+    if FilterBank.numpy is not None:
+        for channels in CHANNEL_COUNTS:
+            filterBank = FilterBank.FilterBank()
+            views = [filterBank.view(filterBank.register(), FilterBank.SLOW_FILTER) for i in range(channels)]
+            for view in views:
+                view.setCoefficients(4)
+                view.init(samples[0])
+
+            def tick(i):
+                val = samples[i]
+                for view in views:
+                    view.add(val)
+                filterBank.step()
+
+            results.append(measure("FilterBank.step", channels, len(samples), tick))
+
+
+def benchSensors(samples, results):
+    backends = list(FilterCascaded.FILTER_BACKENDS)
+    if FilterBank.numpy is not None:
+        backends.append('bank')
+
+    for backend in backends:
+        for channels in CHANNEL_COUNTS:
+            filterBank = FilterBank.FilterBank() if backend == 'bank' else None
+            poller, sensors = makeSensors(channels, backend, filterBank)
+
+            def tick(i):
+                val = samples[i]
+                for sensor in sensors:
+                    poller.store(sensor.deviceID, val)
+                if filterBank is None:
+                    for sensor in sensors:
+                        sensor.update()
+                    return
+                # As tempController.updateTemperatures() does
+                for sensor in sensors:
+                    sensor.addSample()
+                filterBank.step()
+                for sensor in sensors:
+                    sensor.updateDerived()
+                filterBank.step()
+
+            def slopeTick(i):
+                # Force the slope filter to update on every sample
+                for sensor in sensors:
+                    sensor.updateCounter = 1
+                tick(i)
+
+            results.append(measure("sensor.update/%s" % backend, channels, len(samples), tick))
+            results.append(measure("sensor.update+slope/%s" % backend, channels, len(samples), slopeTick))
+            stopSensors(sensors)
+
+
+def compare(results, previousFile):
+    """Print the change in ns/sample against an earlier results file."""
+    with open(previousFile) as f:
+        previous = {(r['name'], r['channels']): r for r in json.load(f)['results']}
+
+    print()
+    print("Change in ns/sample against %s:" % previousFile)
+    for result in results:
+        old = previous.get((result['name'], result['channels']))
+        if old is not None:
+            change = (result['nsPerSample'] / old['nsPerSample'] - 1) * 100
+            print("%-28s %4d ch  %+7.1f%%" % (result['name'], result['channels'], change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', '-n', type=int, default=2000,
+                        help='samples per channel')
+    parser.add_argument('--output', '-o', default='benchmark.json',
+                        help='file to write the results to')
+    parser.add_argument('--compare', '-c', default=None,
+                        help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    samples = makeSamples(args.samples)
+    results = []
+    benchFilters(samples, results)
+    benchSensors(samples, results)
+
+    with open(args.output, 'w') as f:
+        json.dump({'time': time.time(),
+                   'python': sys.version,
+                   'platform': platform.platform(),
+                   'samplesPerChannel': args.samples,
+                   'results': results,
+                   }, f, indent=1)
+    print("Results written to '%s'" % args.output)
+
+    if args.compare:
+        compare(results, args.compare)
@@ -21,7 +21,7 @@
 
 import requests
 import logging
-import paho.mqtt.client as mqtt
+import mqttBroker
 
 class BrewfatherStream():
     def __init__(self, streamId, name, tempController, MQTT_broker=None, MQTT_gravity=None):
@@ -32,11 +32,7 @@ class BrewfatherStream():
         self.gravityTopic = MQTT_gravity
         self.gravity = 1.0
         if self.gravityTopic is not None:
-            self._connection = mqtt.Client()
-            self._connection.connect(str(MQTT_broker))
-            self._connection.message_callback_add(self.gravityTopic, self.topicUpdate)
-            result, self.mid = self._connection.subscribe(MQTT_gravity, 0)
-            self._connection.loop_start()
+            mqttBroker.getBroker(MQTT_broker).subscribe(self.gravityTopic, self.topicUpdate)
     
     def topicUpdate(self, client, userdata, message):
         self.gravity = float(message.payload.decode("utf-8"))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Host several fermentation chambers in one process."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import select
+import time
+
+# How often to save the warm restart snapshot, in seconds
+SNAPSHOT_INTERVAL = 30
+
+# How often to push to Brewfather, in seconds
+BREWFATHER_INTERVAL = 900
+
+
+class chamber:
+    """A temperature controller with its relays, door, settings files,
+    piLink port, and optionally a Brewfather stream and a trace recorder.
+
+    What is not particular to a chamber is shared by all of them: the
+    one-wire poller, the MQTT connections, the sensor registry, and the
+    main loop, which calls tick() on every chamber once a second and
+    waits for piLink commands of all chambers at once with receive().
+    """
+
+    def __init__(self, name, tempControl, eepromManager, piLink, heater, cooler, brewfather=None,
+                 recorder=None):
+        self.name = name
+        self.tempControl = tempControl
+        self.eepromManager = eepromManager
+        self.piLink = piLink
+        self.heater = heater
+        self.cooler = cooler
+        self.brewfather = brewfather
+        self.recorder = recorder
+
+        self.lastSnapshot = time.time()
+        self.lastBrewfatherPush = -1  # initialise at -1 to update immediately
+
+    def setup(self):
+        # This loads the settings if saved (and the defaults, if not)
+        self.eepromManager.applySettings()  # NOTE - This replaces settingsManager.loadSettings()
+
+        # Pick up the filters and timers from before a restart, if recent
+        if self.tempControl.loadSnapshot():
+            print("Chamber %s: restored state from warm restart snapshot" % self.name)
+
+        # Record the controller from here on, if a trace file is configured
+        if self.recorder is not None:
+            self.recorder.attach(self.tempControl)
+
+    def tick(self):
+        """Run the controller once."""
+        tempControl = self.tempControl
+        if self.recorder is not None:
+            self.recorder.beginTick()
+        tempControl.updateTemperatures()
+        tempControl.detectPeaks()
+        tempControl.updatePID()
+        oldState = tempControl.getState()
+        tempControl.updateState()
+        tempControl.updateSampleRates()
+
+        if (oldState != tempControl.getState()):
+            print("Chamber %s: state changed from %s to %s" % (self.name, oldState, tempControl.getState()))
+            self.piLink.printTemperatures()  # add a data point at every state transition
+
+        tempControl.updateOutputs()
+        if self.recorder is not None:
+            self.recorder.endTick()
+
+    def service(self):
+        """Push to Brewfather and save the snapshot, when they are due."""
+        if self.brewfather is not None and time.time() - self.lastBrewfatherPush > BREWFATHER_INTERVAL:
+            self.brewfather.push()
+            self.lastBrewfatherPush = round(time.time())
+
+        if (time.time() - self.lastSnapshot >= SNAPSHOT_INTERVAL):
+            self.tempControl.storeSnapshot()
+            self.lastSnapshot = time.time()
+
+    def stop(self):
+        """Save the snapshot, switch the relays off and stop the sensors."""
+        self.tempControl.storeSnapshot()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.piLink.cleanup()
+        self.heater.off()
+        self.cooler.off()
+        for sensor in (self.tempControl.beerSensor, self.tempControl.ambientSensor,
+                       self.tempControl.fridgeSensor):
+            sensor.stop()
+
+    def join(self):
+        for sensor in (self.tempControl.beerSensor, self.tempControl.ambientSensor,
+                       self.tempControl.fridgeSensor):
+            sensor.join()
+
+
+def receive(chambers, timeout):
+    """Wait up to timeout seconds for a connection or command on the
+    piLink of any chamber, and handle it.  A piLink is only asked to
+    receive when it has something, so no chamber holds up the others."""
+    links = {}
+    for hosted in chambers:
+        for sock in hosted.piLink.sockets():
+            links[sock] = hosted.piLink
+    if not links:
+        time.sleep(timeout)
+        return
+    try:
+        readable, writable, failed = select.select(list(links), [], [], timeout)
+    except (OSError, ValueError) as e:  # A connection closed under us
+        logging.warning("Waiting for piLink commands failed: %s", e)
+        return
+    for link in {links[sock] for sock in readable}:
+        link.receive()
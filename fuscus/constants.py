@@ -23,6 +23,7 @@
 
 import argparse
 import configparser
+import os
 
 import EepromManager
 import Menu
@@ -32,9 +33,15 @@ import ui
 import piLink
 import relay
 import mqttRelay
+import mqttJsonSource
 import rotaryEncoder
 import tempControl
+import traceRecorder
+import chamber
 import brewfatherStream
+import DS18B20
+import w1Poller
+import w1Registry
 
 running_on_pi = True
 try:
@@ -172,6 +179,12 @@ MQTT_ambient = config['mqtt'].get('ambient_topic', None)
 MQTT_fridge = config['mqtt'].get('fridge_topic', None)
 MQTT_beer = config['mqtt'].get('beer_topic', None)
 
+# One topic with a JSON payload carrying several probes, e.g. the SENSOR
+# message of a Tasmota device, and the path of each role's reading in it
+MQTT_json_topic = config['mqtt'].get('json_topic', None)
+MQTT_json_paths = {role: config['mqtt'].get('%s_path' % role, None)
+                   for role in ('fridge', 'beer', 'ambient')}
+
 # One-wire bus (implemented by external system) (1 GPIO + 3.3V + GND)
 one_wire = 7  # This number is for reference only
 
@@ -193,6 +206,24 @@ if ID_beer == '':
 if ID_ambient == '':
     ID_ambient = None
 
+# Where the one-wire devices are found.  Point this at a w1Simulator tree
+# to run without sensors.
+DS18B20.W1_ROOT = config['sensors'].get('w1_root', DS18B20.W1_ROOT)
+
+# The registry keeps track of the sensors on the bus.  If a probe has been
+# replaced, its role is now bound to the new probe.
+registry = w1Registry.w1Registry()
+ID_fridge = registry.configure('fridge', ID_fridge)
+ID_beer = registry.configure('beer', ID_beer)
+ID_ambient = registry.configure('ambient', ID_ambient)
+# And those of the other chambers before the first scan, or their probes
+# would look unused and could be taken for a missing probe of this one
+for section_name in config.sections():
+    if section_name.startswith('chamber:'):
+        for role in w1Registry.ROLES:
+            registry.configure(section_name[len('chamber:'):] + '.' + role, config[section_name].get(role) or None)
+registry.scan()
+
 if 'offset' in calibration:
     fridgeCalibrationOffset = calibration['offset'].getfloat(ID_fridge,0.0)
     if ID_beer:
@@ -204,6 +235,99 @@ print("Fridge sensor : %-15s (%+.2f)"%(ID_fridge,fridgeCalibrationOffset))
 print("Beer sensor   : %-15s (%+.2f)"%(ID_beer,beerCalibrationOffset))
 print("Ambient sensor: %-15s (%+.2f)"%(ID_ambient,ambientCalibrationOffset))
 
+# Resolution of the one-wire sensors, in bits (9 to 12).  Lower resolution
+# converts faster: 94ms at 9 bits, 750ms at 12 bits.
+def sensorResolutions(section, roleIDs):
+    """Return {deviceID: bits} from the <role>_resolution options of a section."""
+    resolutions = {}
+    for role, IDs in roleIDs:
+        resolution = section.getint('%s_resolution' % role, None)
+        if IDs and resolution is not None:
+            for ID in IDs.split(','):
+                resolutions[ID.strip()] = resolution
+            print("%s sensor resolution: %s bits" % (role.capitalize(), resolution))
+    return resolutions
+
+
+# Seconds between reads of the one-wire sensors while heating, cooling or
+# waiting for a peak (<role>_period), and while idle or off
+# (<role>_idle_period).  Periods under a second are averaged per tick.
+def sensorPeriods(section, roleIDs):
+    """Return {deviceID: (period, idle_period)} from the options of a section."""
+    periods = {}
+    for role, IDs in roleIDs:
+        period = section.getfloat('%s_period' % role, None)
+        idle_period = section.getfloat('%s_idle_period' % role, period)
+        if IDs and (period, idle_period) != (None, None):
+            for ID in IDs.split(','):
+                periods[ID.strip()] = (period, idle_period)
+            print("%s sensor period: %s s, %s s when idle" % (role.capitalize(), period or 1, idle_period or 1))
+    return periods
+
+
+role_IDs = (('fridge', ID_fridge), ('beer', ID_beer), ('ambient', ID_ambient))
+sensor_resolutions = sensorResolutions(config['sensors'], role_IDs)
+sensor_periods = sensorPeriods(config['sensors'], role_IDs)
+
+# Start conversions on all sensors of a bus at once, if the kernel supports it
+w1Poller.BULK_READ = config['sensors'].getboolean('bulk_read', True)
+
+# Temperature filter arithmetic: 'decimal' or 'integer' (fixed point, as
+# used by the BrewPi firmware)
+filter_backend = config['sensors'].get('filter', 'decimal')
+print("Filter backend: %s" % filter_backend)
+
+# Extra options for the temperature sensors
+sensor_options = {}
+
+# Estimate the slope with a least squares fit over this many seconds,
+# instead of the slope filter. 0 means use the slope filter.
+slope_window = config['sensors'].getint('slope_window', 0)
+if slope_window:
+    sensor_options['slopeWindow'] = slope_window
+    print("Slope estimated over %s seconds" % slope_window)
+
+# Find fridge temperature peaks over this many seconds, ignoring swings
+# smaller than peak_prominence degrees. 0 means compare the last three
+# filter outputs only.
+peak_lookback = config['sensors'].getint('peak_lookback', 0)
+if peak_lookback:
+    sensor_options['peakLookback'] = peak_lookback
+    sensor_options['peakProminence'] = config['sensors'].getfloat('peak_prominence', 0.1)
+    print("Peaks detected over %s seconds" % peak_lookback)
+
+# Replace readings further than outlier_threshold degrees from the median
+# of the last outlier_window readings. 0 means no outlier rejection.
+outlier_window = config['sensors'].getint('outlier_window', 0)
+if outlier_window:
+    sensor_options['outlierWindow'] = outlier_window
+    sensor_options['outlierThreshold'] = config['sensors'].getfloat('outlier_threshold', 1.0)
+    print("Outliers rejected over %s readings" % outlier_window)
+
+# Keep this many hours of raw and filtered readings of each sensor in
+# memory (about 675 KiB per sensor per day). 0 means keep none.
+history_hours = config['sensors'].getfloat('history_hours', 0)
+if history_hours:
+    sensor_options['historySize'] = int(history_hours * 3600)
+
+# Estimate the temperatures and slopes with the cascaded filters ('filter')
+# or a Kalman filter ('kalman'), which lags less. A role with several
+# probes, separated by commas, always uses the Kalman filter to fuse them.
+# The Kalman filter has noise settings tuned for each role, which
+# <role>_kalman_process_noise and kalman_measurement_noise override.
+estimator = config['sensors'].get('estimator', 'filter')
+estimator_options = {}
+for role in ('fridge', 'beer', 'ambient'):
+    options = {}
+    process_noise = config['sensors'].getfloat('%s_kalman_process_noise' % role, None)
+    if process_noise is not None:
+        options['processNoise'] = process_noise
+    measurement_noise = config['sensors'].getfloat('kalman_measurement_noise', None)
+    if measurement_noise is not None:
+        options['measurementNoise'] = measurement_noise
+    estimator_options[role] = options
+print("Estimator: %s" % estimator)
+
 # Door (1 GPIO + GND)
 # Best pin for this is pin 3 as it has a 1.8k pull-up on board
 door_pin = config['door'].getint('pin')
@@ -251,27 +375,138 @@ if relay_COLD >= 0:
 else:
     cooler = mqttRelay.mqttRelay(MQTT_broker, MQTT_cold_topic, MQTT_cold_message_ON, MQTT_cold_message_OFF)
 
+# The JSON sources by topic, so that chambers reading one topic share it
+json_sources = {}
+
+
+def jsonSource(topic):
+    if not topic:
+        return None
+    if topic not in json_sources:
+        json_sources[topic] = mqttJsonSource.mqttJsonSource(MQTT_broker, topic)
+    return json_sources[topic]
+
+
+json_source = jsonSource(MQTT_json_topic)
 
 # Nokia LCD has 17 chars by 6 lines, but original display and web display
 # show 20 chars by 4 lines, so make a buffer at least that big.
 LCD = lcd.lcd(lines=6, chars=20, hardware=LCD_hardware)
 
-tempControl = tempControl.tempController(ID_fridge, ID_beer, ID_ambient, MQTT_broker, MQTT_fridge, MQTT_beer, MQTT_ambient,
-                                         cooler=cooler, heater=heater, door=DOOR)
+# The first chamber's controller and piLink
+mainTempControl = tempControl.tempController(ID_fridge, ID_beer, ID_ambient, MQTT_broker, MQTT_fridge, MQTT_beer,
+                                             MQTT_ambient, cooler=cooler, heater=heater, door=DOOR,
+                                             filterBackend=filter_backend, sensorOptions=sensor_options,
+                                             estimator=estimator, estimatorOptions=estimator_options,
+                                             resolutions=sensor_resolutions, samplePeriods=sensor_periods,
+                                             jsonSource=json_source, jsonPaths=MQTT_json_paths)
 
-menu = Menu.Menu(encoder=encoder, tempControl=tempControl, piLink=piLink)
+menu = Menu.Menu(encoder=encoder, tempControl=mainTempControl, piLink=piLink)
 
 # Set the temperature calibration offsets (if available)
 # FIXME - This should be part of deviceManager & saved to/loaded from the eeprom
-tempControl.fridgeSensor.calibrationOffset = fridgeCalibrationOffset
-tempControl.beerSensor.calibrationOffset = beerCalibrationOffset
-tempControl.ambientSensor.calibrationOffset = ambientCalibrationOffset
+mainTempControl.fridgeSensor.calibrationOffset = fridgeCalibrationOffset
+mainTempControl.beerSensor.calibrationOffset = beerCalibrationOffset
+mainTempControl.ambientSensor.calibrationOffset = ambientCalibrationOffset
+
+# Fused sensors have a calibration offset for each probe
+if 'offset' in calibration:
+    for sensor in (mainTempControl.fridgeSensor, mainTempControl.beerSensor, mainTempControl.ambientSensor):
+        for probe in getattr(sensor, 'sensors', ()):
+            probe.calibrationOffset = calibration['offset'].getfloat(probe.deviceID, 0.0)
+
 
-eepromManager = EepromManager.eepromManager(tempControl=tempControl)
+def sensorRebinder(controller, prefix=''):
+    """Return a registry listener for the roles of one chamber, which
+    start with prefix."""
+    def rebindSensor(role, deviceID):
+        if not role.startswith(prefix) or role[len(prefix):] not in ('fridge', 'beer', 'ambient'):
+            return  # Another chamber's
+        offset = calibration['offset'].getfloat(deviceID, 0.0) if 'offset' in calibration else 0.0
+        controller.rebindSensor(role[len(prefix):], deviceID, offset)
+    return rebindSensor
 
-piLink = piLink.piLink(tempControl=tempControl, port=port, eepromManager=eepromManager, lcd=LCD)
+
+registry.listeners.append(sensorRebinder(mainTempControl))
+
+eepromManager = EepromManager.eepromManager(tempControl=mainTempControl)
+
+mainPiLink = piLink.piLink(tempControl=mainTempControl, port=port, eepromManager=eepromManager, lcd=LCD,
+                           registry=registry)
 
 brewfather_id = config['brewfather'].get('id', None)
 brewfather_name = config['brewfather'].get('name', None)
 gravity_topic = config['brewfather'].get('gravity_topic', None)
-brewfather = brewfatherStream.BrewfatherStream(brewfather_id, brewfather_name, tempControl, MQTT_broker, gravity_topic)
\ No newline at end of file
+brewfather = brewfatherStream.BrewfatherStream(brewfather_id, brewfather_name, mainTempControl, MQTT_broker, gravity_topic)
+
+# Optionally record a trace of the controller for traceRecorder.py to replay
+trace_file = config.get('trace', 'file', fallback=None)
+recorder = traceRecorder.traceRecorder(trace_file) if trace_file else None
+
+chambers = [chamber.chamber('main', mainTempControl, eepromManager, mainPiLink, heater, cooler, brewfather, recorder)]
+
+
+def makeChamber(name, section):
+    """Build a chamber from a [chamber:<name>] section.  Its sensors, relays,
+    door, piLink port and Brewfather stream are set in the section; the
+    sensor options and MQTT broker are those of the first chamber."""
+    prefix = name + '.'
+    roleIDs = tuple((role, registry.configure(prefix + role, section.get(role) or None))
+                    for role in ('fridge', 'beer', 'ambient'))
+    IDs = dict(roleIDs)
+    print("Chamber %s: fridge %s, beer %s, ambient %s" % (name, IDs['fridge'], IDs['beer'], IDs['ambient']))
+
+    hot = section.getint('hot', -1)
+    if hot >= 0:
+        chamberHeater = relay.relay(hot, invert=section.getboolean('invert_hot', False))
+    else:
+        chamberHeater = mqttRelay.mqttRelay(MQTT_broker, section.get('hot_topic'),
+                                            section.get('hot_message_on', MQTT_hot_message_ON),
+                                            section.get('hot_message_off', MQTT_hot_message_OFF))
+    cold = section.getint('cold', -1)
+    if cold >= 0:
+        chamberCooler = relay.relay(cold, invert=section.getboolean('invert_cold', False))
+    else:
+        chamberCooler = mqttRelay.mqttRelay(MQTT_broker, section.get('cold_topic'),
+                                            section.get('cold_message_on', MQTT_cold_message_ON),
+                                            section.get('cold_message_off', MQTT_cold_message_OFF))
+    chamberDoor = door.door(section.getint('door_pin', None), section.getboolean('door_open_state', True))
+
+    # The settings, constants and snapshot of each chamber in a directory of its own
+    stateDir = section.get('state_dir', os.path.join('./config', name))
+    os.makedirs(stateDir, exist_ok=True)
+
+    controller = tempControl.tempController(
+        IDs['fridge'], IDs['beer'], IDs['ambient'], MQTT_broker,
+        section.get('fridge_topic', None), section.get('beer_topic', None), section.get('ambient_topic', None),
+        cooler=chamberCooler, heater=chamberHeater, door=chamberDoor, filterBackend=filter_backend,
+        sensorOptions=sensor_options, estimator=estimator, estimatorOptions=estimator_options,
+        resolutions=sensorResolutions(section, roleIDs), samplePeriods=sensorPeriods(section, roleIDs),
+        jsonSource=jsonSource(section.get('json_topic', None)),
+        jsonPaths={role: section.get('%s_path' % role, None) for role in ('fridge', 'beer', 'ambient')},
+        stateDir=stateDir)
+
+    if 'offset' in calibration:
+        for sensor in (controller.fridgeSensor, controller.beerSensor, controller.ambientSensor):
+            for probe in getattr(sensor, 'sensors', (sensor,)):
+                if isinstance(probe.deviceID, str):
+                    probe.calibrationOffset = calibration['offset'].getfloat(probe.deviceID, 0.0)
+    registry.listeners.append(sensorRebinder(controller, prefix))
+
+    manager = EepromManager.eepromManager(tempControl=controller)
+    link = piLink.piLink(tempControl=controller, port=section.getint('port', None), eepromManager=manager,
+                         lcd=None, registry=registry, rolePrefix=prefix)
+
+    stream = None
+    if section.get('brewfather_id'):
+        stream = brewfatherStream.BrewfatherStream(section['brewfather_id'], section.get('brewfather_name', name),
+                                                   controller, MQTT_broker, section.get('gravity_topic', None))
+
+    traceFile = section.get('trace_file', None)
+    return chamber.chamber(name, controller, manager, link, chamberHeater, chamberCooler, stream,
+                           traceRecorder.traceRecorder(traceFile) if traceFile else None)
+
+
+for section_name in config.sections():
+    if section_name.startswith('chamber:'):
+        chambers.append(makeChamber(section_name[len('chamber:'):], config[section_name]))
@@ -73,7 +73,7 @@ def printDegreeUnit(x, y):
     """Print degree sign + temp unit."""
     LCD.cursor(x, y)
     LCD.print('°')
-    LCD.print(tempControl.cc.tempFormat)
+    LCD.print(mainTempControl.cc.tempFormat)
 
 
 def printMode():
@@ -81,22 +81,22 @@ def printMode():
     LCD.printat(7, 0, ' '*13)
     LCD.cursor(7,0)
 
-    if (tempControl.getMode() == MODES['MODE_FRIDGE_CONSTANT']):
+    if (mainTempControl.getMode() == MODES['MODE_FRIDGE_CONSTANT']):
         LCD.print(STR_Fridge_)
         LCD.print(STR_Const_)
 
-    elif (tempControl.getMode() == MODES['MODE_BEER_CONSTANT']):
+    elif (mainTempControl.getMode() == MODES['MODE_BEER_CONSTANT']):
         LCD.print(STR_Beer_)
         LCD.print(STR_Const_)
 
-    elif (tempControl.getMode() == MODES['MODE_BEER_PROFILE']):
+    elif (mainTempControl.getMode() == MODES['MODE_BEER_PROFILE']):
         LCD.print(STR_Beer_)
         LCD.print("Profile")
 
-    elif (tempControl.getMode() == MODES['MODE_OFF']):
+    elif (mainTempControl.getMode() == MODES['MODE_OFF']):
         LCD.print("Off")
 
-    elif (tempControl.getMode() == MODES['MODE_TEST']):
+    elif (mainTempControl.getMode() == MODES['MODE_TEST']):
         LCD.print("** Testing **")
 
     else:
@@ -111,7 +111,7 @@ def printState():
     global stateOnDisplay
 
     time = None
-    state = tempControl.getDisplayState()
+    state = mainTempControl.getDisplayState()
 
     if (state != stateOnDisplay):   # only print static text when state has changed
         stateOnDisplay = state
@@ -156,10 +156,10 @@ def printState():
         LCD.print(part2)
         #lcd.printSpacesToRestOfLine();
 
-    sinceIdleTime = tempControl.timeSinceIdle()
+    sinceIdleTime = mainTempControl.timeSinceIdle()
 
     if (state == STATES['IDLE']):
-        time = min(tempControl.timeSinceCooling(), tempControl.timeSinceHeating())
+        time = min(mainTempControl.timeSinceCooling(), mainTempControl.timeSinceHeating())
     elif state in (STATES['COOLING'], STATES['HEATING']):
         time = sinceIdleTime
     elif (state == STATES['COOLING_MIN_TIME']):
@@ -167,7 +167,7 @@ def printState():
     elif (state == STATES['HEATING_MIN_TIME']):
         time = MIN_HEAT_ON_TIME - sinceIdleTime
     elif state in (STATES['WAITING_TO_COOL'], STATES['WAITING_TO_HEAT']):
-        time = tempControl.getWaitTime()
+        time = mainTempControl.getWaitTime()
 
     if (time is not None):
         minutes = time / 60
@@ -192,9 +192,9 @@ def printAllTemperatures():
 
     # alternate between beer and room temp
     if (flags & LCD_FLAG_ALTERNATE_ROOM):
-    #   bool displayRoom = ((ticks.seconds()&0x08)==0) && !BREWPI_SIMULATE && tempControl.ambientSensor->isConnected()
+    #   bool displayRoom = ((ticks.seconds()&0x08)==0) && !BREWPI_SIMULATE && mainTempControl.ambientSensor->isConnected()
         displayRoom = (((int(ticks.seconds())&0x04)==0)
-                and (tempControl.ambientSensor.deviceID is not None or tempControl.ambientSensor.topic is not None))
+                and (mainTempControl.ambientSensor.deviceID is not None or mainTempControl.ambientSensor.topic is not None))
         if (displayRoom ^ ((flags & LCD_FLAG_DISPLAY_ROOM)!=0)):    # transition
             flags = (flags | LCD_FLAG_DISPLAY_ROOM) if displayRoom else (flags & ~LCD_FLAG_DISPLAY_ROOM)
             printStationaryText()
@@ -206,21 +206,21 @@ def printAllTemperatures():
 
 
 def printBeerTemp():
-    printTemperatureAt(6, 1, tempControl.temp_convert_to_external(tempControl.getBeerTemp()))
+    printTemperatureAt(6, 1, mainTempControl.temp_convert_to_external(mainTempControl.getBeerTemp()))
 
 
 def printBeerSet():
-    printTemperatureAt(12, 1, tempControl.temp_convert_to_external(tempControl.getBeerSetting()))
+    printTemperatureAt(12, 1, mainTempControl.temp_convert_to_external(mainTempControl.getBeerSetting()))
 
 
 def printFridgeTemp():
-    printTemperatureAt(6,2, tempControl.temp_convert_to_external(tempControl.ambientSensor.temperature)
+    printTemperatureAt(6,2, mainTempControl.temp_convert_to_external(mainTempControl.ambientSensor.temperature)
                     if (flags & LCD_FLAG_DISPLAY_ROOM)
-                    else tempControl.temp_convert_to_external(tempControl.getFridgeTemp()))
+                    else mainTempControl.temp_convert_to_external(mainTempControl.getFridgeTemp()))
 
 
 def printFridgeSet():
-    fridgeSet = tempControl.temp_convert_to_external(tempControl.getFridgeSetting())
+    fridgeSet = mainTempControl.temp_convert_to_external(mainTempControl.getFridgeSetting())
     if (flags & LCD_FLAG_DISPLAY_ROOM): # beer setting is not active
         fridgeSet = None
     printTemperatureAt(12, 2, fridgeSet)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Choose filter coefficients by running every setting over a recorded trace.
+
+Reads a CSV file of temperature readings, one per line, and runs it
+through the cascaded filter for every b value (0 to 6) and every number
+of sections (1 to 3), each section over the whole trace at once with
+filter_array().  Because the sections of a cascade are filtered one
+after the other, the output of section k
+of a three section filter is the output of a k section filter, so all
+section counts come out of the same run.
+
+For each setting it reports the lag and the noise left in the output:
+
+ - lag is the delay of a slowly changing temperature, in seconds.  Each
+   section delays by 2^(b+2)-1 samples.
+ - noise is the RMS difference between the output and a centred moving
+   average of the input (the reference), delayed by the lag.  The
+   reference still carries a little noise of its own, and changes faster
+   than its window are smoothed away, so compare settings rather than
+   reading the numbers as absolute.
+
+The fast and slow filters are evaluated on the readings themselves.  The
+slope filter is evaluated on the difference between readings 3 samples
+apart in degrees per hour, as fed by the sensors (without the lag of the
+slow filter in front of it).
+
+Only settings which are not beaten on both lag and noise by another
+setting are listed, unless --all is given.  The setting in
+ControlConstants is b; the sensors use 3 sections.
+"""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import csv
+
+import FilterFixed
+
+numpy = FilterFixed.numpy
+
+B_VALUES = range(7)
+NUM_SECTIONS = 3
+SLOPE_INTERVAL = 3  # The sensors update the slope filter every 3 samples
+
+
+def loadTrace(filename, column=1, timeColumn=None):
+    """Return (readings, sample period) from a CSV file.
+
+    Lines which do not have a number in the column, such as a header, are
+    skipped.  If timeColumn is given, the sample period is the median time
+    between readings, otherwise it is None."""
+    readings = []
+    times = []
+    with open(filename, newline='') as f:
+        for row in csv.reader(f):
+            try:
+                val = float(row[column])
+                t = float(row[timeColumn]) if timeColumn is not None else None
+            except (ValueError, IndexError):
+                continue
+            readings.append(val)
+            times.append(t)
+
+    period = None
+    if timeColumn is not None and len(times) > 1:
+        period = float(numpy.median(numpy.diff(times)))
+    return numpy.array(readings), period
+
+
+def sectionLag(b):
+    """Return the delay of one filter section, in samples."""
+    return 2 ** (b + 2) - 1
+
+
+def inputNoise(values):
+    """Estimate the standard deviation of white noise on a slowly changing signal."""
+    if len(values) < 3:
+        return float('nan')
+    # The second difference of white noise has 6 times its variance
+    return float(numpy.std(numpy.diff(values, 2)) / numpy.sqrt(6))
+
+
+def reference(values, window):
+    """Return the centred moving average, and the index of its first value."""
+    window = max(1, min(window, len(values)) | 1)  # Odd, so it can be centred
+    sums = numpy.cumsum(numpy.concatenate(([0.0], values)))
+    return (sums[window:] - sums[:-window]) / window, window // 2
+
+
+def residual(output, ref, refStart, lag, skip):
+    """Return the RMS of output[t] - ref[t - lag], for t from skip."""
+    start = max(skip, refStart + lag)
+    end = min(len(output), refStart + len(ref) + lag)
+    if end - start < 2:
+        return float('nan')
+    error = output[start:end] - ref[start - lag - refStart:end - lag - refStart]
+    return float(numpy.sqrt(numpy.mean(error ** 2)))
+
+
+def runFilters(inputs):
+    """Filter inputs with every b value, each over the whole trace at once
+    with filter_array().
+
+    Returns outputs[b, section, sample]."""
+    outputs = numpy.empty((len(B_VALUES), NUM_SECTIONS, len(inputs)))
+    for b in B_VALUES:
+        section = FilterFixed.FixedFilter(b)
+        values = inputs
+        for i in range(NUM_SECTIONS):
+            # Settled at the first input, as after init()
+            values, state = section.filter_array(values)
+            outputs[b, i] = values
+    return outputs
+
+
+def evaluate(role, inputs, period, referenceWindow, interval=1):
+    """Return a result for every setting, for inputs every interval samples.
+
+    referenceWindow is in samples of the inputs."""
+    outputs = runFilters(inputs)
+    ref, refStart = reference(inputs, referenceWindow)
+    results = []
+    for b in B_VALUES:
+        for sections in range(1, NUM_SECTIONS + 1):
+            lag = sections * sectionLag(b)
+            # Skip the start, where the output still depends on the init value
+            skip = min(3 * lag, len(inputs) // 2)
+            results.append({'role': role,
+                            'b': b,
+                            'sections': sections,
+                            'lag': lag * interval * period,
+                            'noise': residual(outputs[b, sections - 1], ref, refStart, lag, skip),
+                            })
+    return results
+
+
+def pareto(results):
+    """Return the results not beaten on both lag and noise by another."""
+    best = []
+    lowestNoise = float('inf')
+    for result in sorted(results, key=lambda r: (r['lag'], r['noise'])):
+        if result['noise'] < lowestNoise:
+            best.append(result)
+            lowestNoise = result['noise']
+    return best
+
+
+def report(role, rawNoise, results, unit):
+    print()
+    print("%s filter, input noise %.4f %s" % (role, rawNoise, unit))
+    print("   b  sections    lag (s)    noise (%s)  reduction" % unit)
+    for result in results:
+        print("%4d %9d %10.0f %12.4f %9.1fx" % (
+            result['b'], result['sections'], result['lag'], result['noise'],
+            rawNoise / result['noise'] if result['noise'] else float('inf')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('trace', help='CSV file with one reading per line')
+    parser.add_argument('--column', type=int, default=1,
+                        help='column with the temperature (from 0, default 1)')
+    parser.add_argument('--time-column', type=int, default=None,
+                        help='column with the time in seconds, to find the sample period')
+    parser.add_argument('--period', type=float, default=1.0,
+                        help='seconds between readings, if there is no time column')
+    parser.add_argument('--reference', type=float, default=600,
+                        help='seconds in the moving average the outputs are compared with')
+    parser.add_argument('--all', action='store_true',
+                        help='list every setting, not only the best trade-offs')
+    args = parser.parse_args()
+
+    if numpy is None:
+        parser.error("numpy is required")
+
+    readings, period = loadTrace(args.trace, args.column, args.time_column)
+    if len(readings) < 2:
+        parser.error("no readings found in '%s'" % args.trace)
+    if period is None:
+        period = args.period
+    print("%d readings, %.1f s apart" % (len(readings), period))
+
+    choose = (lambda results: results) if args.all else pareto
+
+    window = int(args.reference / period)
+    temperatures = evaluate('Temperature', readings, period, window)
+    report('Fast/slow', inputNoise(readings), choose(temperatures), 'C')
+
+    slopes = 3600 / (SLOPE_INTERVAL * period) * numpy.diff(readings[::SLOPE_INTERVAL])
+    if len(slopes) > 1:
+        slopeResults = evaluate('Slope', slopes, period, window // SLOPE_INTERVAL, SLOPE_INTERVAL)
+        report('Slope', inputNoise(slopes), choose(slopeResults), 'C/h')
@@ -33,6 +33,8 @@ import ui
 import displayLCD as display
 
 import AppConfigDefault  # FIXME is this needed?
+import chamber
+import mqttBroker
 
 # import piLink
 # piLink = piLink.piLink()
@@ -44,6 +46,9 @@ from constants import *
 
 keepRunning = True
 
+# How often to look for one-wire sensors added or removed, in seconds
+REGISTRY_SCAN_INTERVAL = 10
+
 
 # ValueActuator alarm;
 # UI UI;
@@ -68,8 +73,9 @@ def setup():
     logging.debug("started")
     # tempControl.init()
 
-    # This loads the settings if saved (and the defaults, if not)
-    eepromManager.applySettings()  # NOTE - This replaces settingsManager.loadSettings()
+    # Load the settings and snapshot of each chamber
+    for hosted in chambers:
+        hosted.setup()
 
     #start = time.time()
     #delay = ui.showStartupPage(piLink.portName)
@@ -85,9 +91,7 @@ def setup():
 def loop():
     '''Main loop.'''
     lastUpdate = -1  # initialise at -1 to update immediately
-    lastBrewfatherPush = -1 # initialise at -1 to update immediately
-
-    oldState = None
+    lastRegistryScan = time.time()
 
     spinner = '|/-\\'
     spinindex = 0
@@ -98,19 +102,11 @@ def loop():
             # round to nearest 1 second boundary to keep in sync with real time
             lastUpdate = round(time.time())
 
-            tempControl.updateTemperatures()
-            tempControl.detectPeaks()
-            tempControl.updatePID()
-            oldState = tempControl.getState()
-            tempControl.updateState()
-
-            if (oldState != tempControl.getState()):
-                print("State changed from %s to %s" % (oldState, tempControl.getState()))
-                piLink.printTemperatures()  # add a data point at every state transition
-
-            tempControl.updateOutputs()
+            for hosted in chambers:
+                hosted.tick()
             ui.update()
 
+            # The display shows the first chamber.
             # We have two lines free at the bottom of the display.
 
             # Show local time YYYY-MM-DD hh:mm (16 characters.)
@@ -123,16 +119,18 @@ def loop():
             #LCD.print("%s" % spinner[spinindex])
             #spinindex = (spinindex + 1) % 4
 
-        # listen for incoming serial connections while waiting to update
-        piLink.receive()
+        for hosted in chambers:
+            hosted.service()
 
-        if (time.time() - lastBrewfatherPush > 900):
-            brewfather.push()
-            lastBrewfatherPush = round(time.time())
+        if (time.time() - lastRegistryScan >= REGISTRY_SCAN_INTERVAL):
+            registry.scan()
+            lastRegistryScan = time.time()
 
-        time.sleep(0.05)  # Don't hog the processor
+        # listen for incoming connections and commands while waiting to update
+        chamber.receive(chambers, 0.05)
 
-    piLink.cleanup()
+    for hosted in chambers:
+        hosted.stop()
     LCD.printat(0, 5, "Shutting down.   ")
     ui.update()
 
@@ -148,18 +146,13 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, killhandle)
     setup()
     loop()  # loop() will exit if we get one of the above signals
-    heater.off()
-    cooler.off()
     print("Stopping threads")
-    tempControl.beerSensor.stop()
-    tempControl.ambientSensor.stop()
-    tempControl.fridgeSensor.stop()
     encoder.stop()
     print("Waiting for threads to finish.")
-    tempControl.beerSensor.join()
-    tempControl.ambientSensor.join()
-    tempControl.fridgeSensor.join()
+    for hosted in chambers:
+        hosted.join()
     encoder.join()
+    mqttBroker.stopAll()
     try:
         GPIO.cleanup()
     except:
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Temperature sensor which fuses one or more probes with a Kalman filter."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+
+import FilterKalman
+import PeakDetector
+import SampleHistory
+import sensorStats
+import ticks
+
+# Process noise of the Kalman filter for each role, in degrees^2/s^3, as
+# tuned with simulator.py.  The beer changes rate slowly, and its slope
+# feeds the D term of the PID: a beer rate which follows the noise moves
+# the fridge setting about, and the cooler and heater switch much more.
+# The fridge air changes rate whenever the cooler or heater switches, so
+# its rate may change faster, but following it closely starts and stops
+# the compressor more often.
+PROCESS_NOISE = {'fridge': 1e-10, 'beer': 1e-12, 'ambient': 1e-10}
+MEASUREMENT_NOISE = 0.05
+
+
+# This class has the same interface as tempSensor.sensor, so the
+# controller can use it for any role.  The probes are tempSensor or
+# mqttTempSensor objects, which are only used for their raw readings.
+# Their own filters are not updated.
+
+class sensor():
+    def __init__(self, sensors, role='beer', processNoise=None, measurementNoise=MEASUREMENT_NOISE,
+                 peakLookback=None, peakProminence=0.1, historySize=None, stats=True):
+        self.sensors = sensors
+        # MQTT probes are identified by their topic
+        self.deviceID = tuple(getattr(probe, 'topic', probe.deviceID) for probe in sensors)
+        self.calibrationOffset = 0.0  # Each probe has its own
+
+        self.failedReadCount = 255
+        self.stats = sensorStats.sensorStats()
+        # Count the reads of the fused value, unless turned off
+        self.collectStats = stats
+
+        if processNoise is None:
+            processNoise = PROCESS_NOISE[role]
+        self.kalman = FilterKalman.KalmanFilter(processNoise, measurementNoise)
+        self.rawSample = None  # The mean of the latest probe readings
+
+        # The filter output has no three-sample peak test, so always find
+        # peaks over a window.
+        self.peakDetector = PeakDetector.PeakDetector(peakLookback or 1800, peakProminence)
+
+        # Optionally keep the last historySize samples.  The raw value is
+        # the mean of the probe readings.
+        self.history = None
+        if historySize:
+            self.history = SampleHistory.SampleHistory(historySize)
+
+    @property
+    def temperature(self):
+        """Return the estimated temperature, or None if no probe can be read."""
+        if all(probe.temperature is None for probe in self.sensors):
+            return None
+        return self.kalman.readOutput()
+
+    def isConnected(self):
+        return any(probe.isConnected() for probe in self.sensors)
+
+    def init(self):
+        logging.debug("fusedTempSensor::init - begin %d", self.failedReadCount)
+        if (self.failedReadCount > 60):
+            readings = [probe.temperature for probe in self.sensors if probe.temperature is not None]
+            if readings:
+                self.kalman.init(sum(readings) / len(readings))
+                self.peakDetector.reset()
+                self.failedReadCount = 0
+
+    def sampleAge(self):
+        """Return the seconds since the newest probe reading, or None."""
+        ages = [age for age in (probe.sampleAge() for probe in self.sensors) if age is not None]
+        return min(ages, default=None)
+
+    def update(self):
+        if self.addSample():
+            self.updateDerived()
+
+    def addSample(self):
+        """Give the latest probe readings to the Kalman filter.  Returns
+        False if there were none to give."""
+        samples = [probe.readSample() for probe in self.sensors]
+        readings = [temp for temp, fresh in samples if temp is not None]
+        if not readings:
+            self.stats.failures += 1
+            if (self.failedReadCount < 255):  # limit
+                self.failedReadCount += 1
+            if self.history is not None:
+                self.history.add(ticks.monotonic(), None, None)
+            return False
+
+        if self.collectStats:
+            self.stats.reads += 1
+            self.stats.sampleAge.add(self.sampleAge())
+
+        # One prediction per tick, then one correction per new reading.  A
+        # probe without a new reading this tick adds nothing.
+        self.kalman.predict()
+        for temp, fresh in samples:
+            if fresh and temp is not None:
+                self.kalman.update(temp)
+        self.rawSample = sum(readings) / len(readings)
+        return True
+
+    def updateDerived(self):
+        """Update the peak detector and history from the Kalman filter."""
+        self.peakDetector.add(self.kalman.readOutput())
+        if self.history is not None:
+            self.history.add(ticks.monotonic(), self.rawSample, self.kalman.readOutput())
+
+    def readFastFiltered(self):
+        return self.kalman.readOutput()
+
+    def readSlowFiltered(self):
+        return self.kalman.readOutput()
+
+    def readSlope(self):
+        """Return slope per hour."""
+        return self.kalman.readSlope()
+
+    def detectPosPeak(self):
+        return self.peakDetector.detectPosPeak()
+
+    def detectNegPeak(self):
+        return self.peakDetector.detectNegPeak()
+
+    def resetPeakDetection(self):
+        self.peakDetector.reset()
+
+    def rejectedCount(self):
+        """Return the number of readings rejected as outliers."""
+        return self.kalman.rejectedCount
+
+    # The filter coefficients do not apply to the Kalman filter
+
+    def setFastFilterCoefficients(self, b):
+        pass
+
+    def setSlowFilterCoefficients(self, b):
+        pass
+
+    def setSlopeFilterCoefficients(self, b):
+        pass
+
+    def getState(self):
+        """Return the filter state, for a warm restart snapshot."""
+        return {'id': self.deviceID,
+                'kalman': self.kalman.getState(),
+                }
+
+    def setState(self, state):
+        """Restore the filter state saved by getState().
+
+        Returns False if the state belongs to a different sensor."""
+        if state['id'] != self.deviceID or 'kalman' not in state:
+            return False
+        self.kalman.setState(state['kalman'])
+        self.failedReadCount = 0
+        return True
+
+    def getStats(self):
+        """Return the statistics of the fused sensor, and of each probe."""
+        stats = self.stats.asDict()
+        stats['probes'] = {str(deviceID): probe.getStats()
+                           for deviceID, probe in zip(self.deviceID, self.sensors)}
+        return stats
+
+    def setActive(self, active):
+        for probe in self.sensors:
+            probe.setActive(active)
+
+    def stop(self):
+        for probe in self.sensors:
+            probe.stop()
+
+    def join(self):
+        for probe in self.sensors:
+            probe.join()
+
+    def hasSlowFilter(self):
+        return True
+
+    def hasFastFilter(self):
+        return True
+
+    def hasSlopeFilter(self):
+        return True
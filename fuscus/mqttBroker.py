@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""One MQTT connection per broker, shared by everything that uses it."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+
+import paho.mqtt.client as mqtt
+
+
+class mqttBroker:
+    """A connection to a broker, with its network thread.
+
+    Sensors, relays and the Brewfather stream of every chamber subscribe
+    and publish through it, rather than each opening a connection and a
+    thread of its own.  Several callbacks can subscribe to one topic.
+    Subscriptions and retained messages are sent again after a
+    reconnect, so a relay comes back in the state it was left in.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.lock = threading.Lock()
+        self.subscriptions = {}  # topic -> [callback]
+        self.retained = {}  # topic -> payload
+
+        # Connect in the background
+        self._connection = mqtt.Client()
+        self._connection.on_connect = self.onConnect
+        self._connection.connect_async(str(address))
+        self._connection.loop_start()
+
+    def onConnect(self, client, userdata, flags, rc):
+        with self.lock:
+            topics = list(self.subscriptions)
+            retained = list(self.retained.items())
+        for topic in topics:
+            client.subscribe(topic, 0)
+        for topic, payload in retained:
+            client.publish(topic, payload, 0, True)
+
+    def subscribe(self, topic, callback):
+        """Call callback(client, userdata, message) for each message on topic."""
+        with self.lock:
+            first = topic not in self.subscriptions
+            self.subscriptions.setdefault(topic, []).append(callback)
+        if first:
+            self._connection.message_callback_add(topic, self.dispatcher(topic))
+            self._connection.subscribe(topic, 0)
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            callbacks = self.subscriptions.get(topic, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            last = topic in self.subscriptions and not callbacks
+            if last:
+                del self.subscriptions[topic]
+        if last:
+            self._connection.message_callback_remove(topic)
+            self._connection.unsubscribe(topic)
+
+    def dispatcher(self, topic):
+        """Return the paho callback for a topic, which may have wildcards."""
+        def dispatch(client, userdata, message):
+            with self.lock:
+                callbacks = list(self.subscriptions.get(topic, ()))
+            for callback in callbacks:
+                callback(client, userdata, message)
+        return dispatch
+
+    def publish(self, topic, payload, retain=False):
+        if retain:
+            with self.lock:
+                self.retained[topic] = payload
+        self._connection.publish(topic, payload, 0, retain)
+
+    def stop(self):
+        self._connection.loop_stop()
+        self._connection.disconnect()
+
+
+_brokers = {}
+_brokersLock = threading.Lock()
+
+
+def getBroker(address):
+    """Return the shared connection to a broker, connecting if need be."""
+    with _brokersLock:
+        if address not in _brokers:
+            _brokers[address] = mqttBroker(address)
+        return _brokers[address]
+
+
+def stopAll():
+    """Close every shared connection."""
+    with _brokersLock:
+        for broker in _brokers.values():
+            broker.stop()
+        _brokers.clear()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Feed several temperature sensors from one MQTT topic with a JSON payload."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import logging
+import math
+
+import mqttBroker
+
+
+def compilePath(path):
+    """Return a function which looks up a dotted path in decoded JSON.
+
+    "DS18B20-1.Temperature" returns data["DS18B20-1"]["Temperature"].  A
+    numeric part indexes a list, so "temps.0" returns data["temps"][0].
+    The path is split once here, not for every message."""
+    keys = []
+    for part in path.split('.'):
+        if not part:
+            raise ValueError("Empty part in JSON path '%s'" % path)
+        keys.append((part, int(part) if part.isdigit() else None))
+    keys = tuple(keys)
+
+    def extract(data):
+        for key, index in keys:
+            if index is not None and isinstance(data, list):
+                data = data[index]
+            else:
+                data = data[key]
+        return data
+
+    return extract
+
+
+class mqttJsonSource:
+    """Subscribe once to a topic carrying several probes, such as the
+    SENSOR message of Tasmota or a JSON state topic of ESPHome:
+
+        {"Time": "2020-05-01T12:00:00",
+         "DS18B20-1": {"Id": "0316A27933FF", "Temperature": 19.6},
+         "DS18B20-2": {"Id": "01192F6A4B60", "Temperature": 4.1}}
+
+    Each payload is decoded once, and the reading of each sensor is picked
+    out by the extractor compiled from its path.  The sensors are
+    mqttTempSensor objects, which add themselves with addSensor().  A
+    sensor whose path is missing from a message keeps its last reading.
+    """
+
+    def __init__(self, broker, topic):
+        self.topic = topic
+        self.badPayloadCount = 0
+
+        # (extractor, sensor) pairs.  Replaced rather than changed, so the
+        # MQTT thread can loop over it while sensors are added.
+        self.sensors = ()
+        self.extractors = {}  # path -> extractor
+
+        self._broker = mqttBroker.getBroker(broker)
+        self._broker.subscribe(self.topic, self.topicUpdate)
+
+    def addSensor(self, path, sensor):
+        """Feed sensor with the value at path in each message."""
+        if path not in self.extractors:
+            self.extractors[path] = compilePath(path)
+        self.sensors = self.sensors + ((self.extractors[path], sensor),)
+
+    def removeSensor(self, sensor):
+        """Stop feeding a sensor.  The topic is unsubscribed with the last one."""
+        remaining = tuple(pair for pair in self.sensors if pair[1] is not sensor)
+        if len(remaining) == len(self.sensors):
+            return  # Already removed
+        self.sensors = remaining
+        if not self.sensors:
+            self.stop()
+
+    def topicUpdate(self, client, userdata, message):
+        try:
+            data = json.loads(message.payload)
+        except ValueError:  # UnicodeDecodeError is a ValueError too
+            self.badPayloadCount += 1
+            logging.warning("Bad JSON payload for %s: %r", self.topic, message.payload)
+            return
+        self.dispatch(data)
+
+    def dispatch(self, data):
+        """Hand the readings in a decoded message to the sensors."""
+        for extract, sensor in self.sensors:
+            try:
+                value = extract(data)
+                if isinstance(value, bool):  # float() would take true as 1.0
+                    raise TypeError(value)
+                temperature = float(value)
+                if not math.isfinite(temperature):  # JSON can have NaN and Infinity
+                    raise ValueError(value)
+            except (LookupError, TypeError, ValueError):
+                sensor.badPayloadCount += 1
+                logging.warning("No temperature for %s in payload of %s", sensor.topic, self.topic)
+                continue
+            sensor.setReading(temperature)
+
+    def stop(self):
+        self._broker.unsubscribe(self.topic, self.topicUpdate)
+
+
+if __name__ == "__main__":
+
+    data = json.loads('{"Time": "2020-05-01T12:00:00",'
+                      ' "DS18B20-1": {"Id": "0316A27933FF", "Temperature": 19.6},'
+                      ' "temps": [4.1, 12.5], "sensors": {"1": 3.5}}')
+    assert compilePath("DS18B20-1.Temperature")(data) == 19.6
+    assert compilePath("temps.1")(data) == 12.5
+    assert compilePath("sensors.1")(data) == 3.5  # A numeric key of an object
+    try:
+        compilePath("DS18B20-2.Temperature")(data)
+        assert False
+    except KeyError:
+        pass
+    print("JSON paths OK")
@@ -26,7 +26,7 @@ import FilterCascaded
 import time
 import logging
 
-import paho.mqtt.client as mqtt
+import mqttBroker
 
 
 # tempSensor class for BrewPi
@@ -43,11 +43,8 @@ class sensor():
         self.deviceID = -1
 
         if self.topic is not None:
-            self._connection = mqtt.Client()
-            self._connection.connect(str(broker))
-            self._connection.message_callback_add(self.topic, self.topicUpdate)
-            result, self.mid = self._connection.subscribe(topic, 0)
-            self._connection.loop_start()
+            self._broker = mqttBroker.getBroker(broker)
+            self._broker.subscribe(self.topic, self.topicUpdate)
 
         # An indication of how stale the data is in the filters
         # Each time a read fails, this value is incremented.
@@ -90,9 +87,7 @@ class sensor():
         
     def join(self):
         if self.topic is not None:
-            self._connection.unsubscribe(self.topic)
-            self._connection.loop_stop()
-            self._connection.disconnect()
+            self._broker.unsubscribe(self.topic, self.topicUpdate)
         return
 
     def update(self):
@@ -123,7 +118,7 @@ class sensor():
             #	diff = (-27l << 16);
             # }
 
-            self.slopeFilter.add(200 * diff)  # Multiply by 1200 (1h/4s), shift to single precision
+            self.slopeFilter.addDoublePrecision(200 * diff)  # Multiply by 1200 (1h/4s), shift to single precision
             self.prevOutputForSlope = slowFilterOutput
             self.updateCounter = 3
 
@@ -20,7 +20,7 @@
 #
 
 
-import paho.mqtt.client as mqtt
+import mqttBroker
 
 class mqttRelay:
     """Simple class for controlling a remote relay via MQTT (such as a Tasmota device)."""
@@ -33,15 +33,14 @@ class mqttRelay:
         self.state = bool(init)  # We can read this class variable to get
         # the current state
 
-        self._connection = mqtt.Client()
-        self._connection.connect(str(broker))
-        self._connection.loop_start()
-        self._connection.publish(self._topic, self._message_on if (self.state ^ self.inverted) else self._message_off, 0, True)
+        # Retained, and sent again by the shared connection after a reconnect
+        self._broker = mqttBroker.getBroker(broker)
+        self._broker.publish(self._topic, self._message_on if (self.state ^ self.inverted) else self._message_off, True)
 
     def set_output(self, state):
         """Set output pin based on desired state and hardware inversion."""
         self.state = bool(state)
-        self._connection.publish(self._topic, self._message_on if (self.state ^ self.inverted) else self._message_off, 0, True)
+        self._broker.publish(self._topic, self._message_on if (self.state ^ self.inverted) else self._message_off, True)
 
     def on(self):
         """Turn relay on."""
@@ -22,11 +22,18 @@
 #
 
 import FilterCascaded
-
-import time
+import FilterOutlier
+import FilterBank
+import FilterSlope
+import PeakDetector
+import SampleHistory
+import sensorStats
+import mqttBroker
+import ticks
+
+import threading
 import logging
-
-import paho.mqtt.client as mqtt
+import math
 
 
 # tempSensor class for BrewPi
@@ -36,18 +43,36 @@ import paho.mqtt.client as mqtt
 # This class adds filtering and other functions to the sensor.
 
 class sensor():
-    def __init__(self, broker, topic, calibrationOffset=0.0):
-
+    def __init__(self, broker, topic, calibrationOffset=0.0, filterBackend='decimal', filterBank=None,
+                 slopeWindow=None, peakLookback=None, peakProminence=0.1,
+                 outlierWindow=None, outlierThreshold=1.0, historySize=None,
+                 source=None, path=None, filters=True, stats=True):
+
+        # With a source (an mqttJsonSource), the reading is the value at
+        # path in the JSON messages of the source's topic.
+        self.source = source
+        self._broker = None
+        if source is not None:
+            topic = "%s:%s" % (source.topic, path)
         self.topic = topic
         self.temperature = None
+        self.captured = None  # ticks.monotonic() of the latest reading
+        self.taken = None  # captured, when readSample() was last called
+        self.badPayloadCount = 0
         self.deviceID = -1
 
-        if self.topic is not None:
-            self._connection = mqtt.Client()
-            self._connection.connect(str(broker))
-            self._connection.message_callback_add(self.topic, self.topicUpdate)
-            result, self.mid = self._connection.subscribe(topic, 0)
-            self._connection.loop_start()
+        # Set once the first reading has arrived
+        self.ready = threading.Event()
+
+        if source is not None:
+            source.addSensor(path, self)
+        elif self.topic is not None:
+            # Subscribe through the connection shared by everything using
+            # this broker, which resubscribes after a reconnect
+            self._broker = mqttBroker.getBroker(broker)
+            self._broker.subscribe(self.topic, self.topicUpdate)
+        else:
+            self.ready.set()
 
         # An indication of how stale the data is in the filters
         # Each time a read fails, this value is incremented.
@@ -57,16 +82,72 @@ class sensor():
         self.failedReadCount = 255
         self.updateCounter = 64
 
-        self.fastFilter = FilterCascaded.CascadedFilter()
-        self.slowFilter = FilterCascaded.CascadedFilter()
-        self.slopeFilter = FilterCascaded.CascadedFilter()
+        self.stats = sensorStats.sensorStats()
+        # Count every read and its age for getStats(), unless turned off
+        self.collectStats = stats
+
+        if not filters:
+            # A probe of a fused sensor only supplies raw readings
+            self.fastFilter = self.slowFilter = self.slopeFilter = None
+        elif filterBank is not None:
+            # The filters are views into a shared bank, which is stepped
+            # once per tick for all sensors.  Filter outputs only change
+            # when the bank is stepped, so the slope stage sees the slow
+            # filter output of the previous tick.
+            channel = filterBank.register()
+            self.fastFilter = filterBank.view(channel, FilterBank.FAST_FILTER)
+            self.slowFilter = filterBank.view(channel, FilterBank.SLOW_FILTER)
+            self.slopeFilter = filterBank.view(channel, FilterBank.SLOPE_FILTER)
+        else:
+            self.fastFilter = FilterCascaded.CascadedFilter(backend=filterBackend)
+            self.slowFilter = FilterCascaded.CascadedFilter(backend=filterBackend)
+            self.slopeFilter = FilterCascaded.CascadedFilter(backend=filterBackend)
         self.prevOutputForSlope = None
-
-        time.sleep(1)  # Wait for at least one reading to be ready.
+        self.rawSample = None  # The latest reading given to the filters, before outlier rejection
+
+        # Optionally replace single bad readings by the median of the last
+        # outlierWindow readings before they reach the filters.
+        self.outlierFilter = None
+        if outlierWindow:
+            self.outlierFilter = FilterOutlier.MedianOutlierFilter(outlierWindow, outlierThreshold)
+
+        # Optionally estimate the slope with a least squares fit over the
+        # last slopeWindow samples, instead of the slope filter.
+        self.slopeEstimator = None
+        if slopeWindow:
+            self.slopeEstimator = FilterSlope.RegressionSlope(slopeWindow)
+
+        # Optionally find peaks of the slow filter over the last
+        # peakLookback samples, instead of only the last three outputs.
+        self.peakDetector = None
+        if peakLookback:
+            self.peakDetector = PeakDetector.PeakDetector(peakLookback, peakProminence)
+
+        # Optionally keep the last historySize raw and filtered samples
+        self.history = None
+        if historySize:
+            self.history = SampleHistory.SampleHistory(historySize)
 
     def stop(self):
         self.join()
 
+    def readSample(self):
+        """Return (temperature, fresh): the latest reading, and whether it
+        arrived since the last call."""
+        fresh = self.captured != self.taken
+        self.taken = self.captured
+        return self.temperature, fresh
+
+    def sampleAge(self):
+        """Return the seconds since the latest reading arrived, or None."""
+        if self.captured is None:
+            return None
+        return ticks.monotonic() - self.captured
+
+    def setActive(self, active):
+        """The publisher sets the sample rate, so there is nothing to change."""
+        pass
+
     def isConnected(self):
         return self.topic is not None
 
@@ -81,29 +162,89 @@ class sensor():
                 self.slowFilter.init(temp)
                 self.slopeFilter.init(0)
                 self.prevOutputForSlope = self.slowFilter.readOutput()
+                if self.outlierFilter is not None:
+                    self.outlierFilter.init()
+                if self.slopeEstimator is not None:
+                    self.slopeEstimator.init()
                 self.failedReadCount = 0
 
     def topicUpdate(self, client, userdata, message):
         # if (!_sensor || (temp=_sensor->read())==TEMP_SENSOR_DISCONNECTED) {
-        print("Update for %s: %s" % (self.topic, message.payload.decode("utf-8")))
-        self.temperature = float(message.payload.decode("utf-8"))
-        
+        try:
+            payload = message.payload.decode("utf-8")
+            temperature = float(payload)
+            if not math.isfinite(temperature):  # float() takes "nan" and "inf"
+                raise ValueError(payload)
+        except ValueError:  # UnicodeDecodeError is a ValueError too
+            # Keep the previous reading rather than feed garbage to the filters
+            self.badPayloadCount += 1
+            logging.warning("Bad payload for %s: %r", self.topic, message.payload)
+            return
+        print("Update for %s: %s" % (self.topic, payload))
+        self.setReading(temperature)
+
+    def setReading(self, temperature):
+        now = ticks.monotonic()
+        if self.captured is not None:
+            self.stats.arrivalInterval.add(now - self.captured)
+        self.temperature = temperature
+        self.captured = now
+        self.ready.set()
+
+    def getStats(self):
+        """Return the statistics of this sensor."""
+        return self.stats.asDict()
+
     def join(self):
-        if self.topic is not None:
-            self._connection.unsubscribe(self.topic)
-            self._connection.loop_stop()
-            self._connection.disconnect()
+        if self.source is not None:
+            self.source.removeSensor(self)
+        elif self._broker is not None:
+            self._broker.unsubscribe(self.topic, self.topicUpdate)
+            self._broker = None
         return
 
     def update(self):
-        temp = self.temperature
+        if self.addSample():
+            self.updateDerived()
+
+    def addSample(self):
+        """Give the latest reading to the fast and slow filters.  Returns
+        False if there was none to give.
+
+        With a filter bank the filter outputs only change when the bank is
+        stepped, which tempController does before calling updateDerived()."""
+        # Readings arrive when the publisher sends them, so the filters
+        # hold the latest one to get one input per tick
+        temp, fresh = self.readSample()
         if (temp is None):
+            self.stats.failures += 1
             if (self.failedReadCount < 255):  # limit
                 self.failedReadCount += 1
-            return
+            if self.history is not None:
+                self.history.add(ticks.monotonic(), None, None)
+            return False
+        if self.collectStats:
+            self.stats.reads += 1
+            self.stats.sampleAge.add(self.sampleAge())
+
+        raw = temp
+        if self.outlierFilter is not None:
+            temp = self.outlierFilter.add(temp)
 
         self.fastFilter.add(temp)
         self.slowFilter.add(temp)
+        if self.slopeEstimator is not None:
+            self.slopeEstimator.add(temp)
+        self.rawSample = raw
+        return True
+
+    def updateDerived(self):
+        """Update the history, peak detector and slope filter from the
+        outputs of the fast and slow filters."""
+        if self.history is not None:
+            self.history.add(ticks.monotonic(), self.rawSample, self.fastFilter.readOutput())
+        if self.peakDetector is not None:
+            self.peakDetector.add(self.slowFilter.readOutput())
         # update slope filter every 3 samples.
         # averaged differences will give the slope. Use the slow filter as input
         self.updateCounter -= 1
@@ -123,7 +264,7 @@ class sensor():
             #	diff = (-27l << 16);
             # }
 
-            self.slopeFilter.add(300 * diff)  # Multiply by 1200 (1h/4s), shift to single precision
+            self.slopeFilter.addDoublePrecision(300 * diff)  # Multiply by 1200 (1h/4s), shift to single precision
             self.prevOutputForSlope = slowFilterOutput
             self.updateCounter = 3
 
@@ -136,14 +277,31 @@ class sensor():
 
     def readSlope(self):
         """Return slope per hour."""
+        if self.slopeEstimator is not None:
+            return self.slopeEstimator.readSlope()
         return self.slopeFilter.readOutput()
 
     def detectPosPeak(self):
+        if self.peakDetector is not None:
+            return self.peakDetector.detectPosPeak()
         return self.slowFilter.detectPosPeak()
 
     def detectNegPeak(self):
+        if self.peakDetector is not None:
+            return self.peakDetector.detectNegPeak()
         return self.slowFilter.detectNegPeak()
 
+    def resetPeakDetection(self):
+        """Forget peaks so far, when the controller starts waiting for a new one."""
+        if self.peakDetector is not None:
+            self.peakDetector.reset()
+
+    def rejectedCount(self):
+        """Return the number of readings rejected as outliers."""
+        if self.outlierFilter is None:
+            return 0
+        return self.outlierFilter.rejectedCount
+
     def setFastFilterCoefficients(self, b):
         self.fastFilter.setCoefficients(b)
 
@@ -153,6 +311,35 @@ class sensor():
     def setSlopeFilterCoefficients(self, b):
         self.slopeFilter.setCoefficients(b)
 
+    def getState(self):
+        """Return the filter state, for a warm restart snapshot."""
+        filters = self.fastFilter is not None  # A probe of a fused sensor has none
+        return {'id': self.topic,
+                'fastFilter': self.fastFilter.getState() if filters else None,
+                'slowFilter': self.slowFilter.getState() if filters else None,
+                'slopeFilter': self.slopeFilter.getState() if filters else None,
+                'prevOutputForSlope': self.prevOutputForSlope,
+                'updateCounter': self.updateCounter,
+                'slopeEstimator': self.slopeEstimator.getState() if self.slopeEstimator else None,
+                }
+
+    def setState(self, state):
+        """Restore the filter state saved by getState().
+
+        Returns False if the state belongs to a different sensor."""
+        if state['id'] != self.topic:
+            return False
+        if self.fastFilter is not None:
+            self.fastFilter.setState(state['fastFilter'])
+            self.slowFilter.setState(state['slowFilter'])
+            self.slopeFilter.setState(state['slopeFilter'])
+        self.prevOutputForSlope = state['prevOutputForSlope']
+        self.updateCounter = state['updateCounter']
+        if self.slopeEstimator is not None and state.get('slopeEstimator') is not None:
+            self.slopeEstimator.setState(state['slopeEstimator'])
+        self.failedReadCount = 0  # The filters are valid, so don't re-initialise them
+        return True
+
     def hasSlowFilter(self):
         return True
 
@@ -43,17 +43,25 @@ STR_FRIDGE_TEMP = "Fridge temp"
 STR_FMT_SET_TO = " set to %s "
 
 
+# BrewPi device functions and hardware types, for the hardware query
+DEVICE_FUNCTIONS = {'fridge': 5, 'ambient': 6, 'beer': 9}  # None is 0
+DEVICE_HARDWARE_ONEWIRE_TEMP = 2
+
+
 class piLink:
-    def __init__(self, tempControl, port, eepromManager, lcd):
+    def __init__(self, tempControl, port, eepromManager, lcd, registry=None, rolePrefix=''):
         # Set up a pty to accept serial input as if we are an Arduino
         # FIXME: Make this a socket interface.  The main brewpi code can send to a socket.
         # use port 25518 (beer 2 5 5 18)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind(("", port))
-        self.socket.listen()
-        self.socket.settimeout(0.5)
-
-        print("Listening on '%s'" % (port))
+        # With port None nothing listens, e.g. to apply the settings of a
+        # trace replay through applySettings().
+        self.socket = None
+        if port is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.bind(("", port))
+            self.socket.listen()
+            self.socket.settimeout(0.5)
+            print("Listening on '%s'" % (port))
         self.portName = ("TCP: %s" % str(port))
         self.buf = ''
         self.connection = None
@@ -62,6 +70,8 @@ class piLink:
         self.tempControl.piLink = self  # FIXME is this good practice?
         self.eepromManager = eepromManager
         self.LCD = lcd
+        self.registry = registry  # w1Registry, for the hardware query
+        self.rolePrefix = rolePrefix  # Of this chamber's roles in the registry
 
     def cleanup(self):
         # Close the socket
@@ -69,9 +79,19 @@ class piLink:
             self.connection.close()
         except:
             pass
-        self.socket.close()
+        if self.socket is not None:
+            self.socket.close()
+
+    def sockets(self):
+        """Return the sockets to wait on: the connection if there is one
+        (only one is served at a time), else the listening socket."""
+        if self.connection is not None:
+            return [self.connection]
+        return [self.socket] if self.socket is not None else []
 
     def acceptConnection(self):
+        if self.socket is None:
+            return False
         incoming_ready, write, err  = select.select([self.socket], [], [], 1)
         if self.connection is None and incoming_ready:
             self.connection, addr = self.socket.accept()
@@ -115,7 +135,9 @@ class piLink:
     def receive(self):
 
         if self.connection is None:
+            # Read once the client sends, not now, as recv() would wait for it
             self.acceptConnection()
+            return
 
         inByte = self.updateBuffer()
 
@@ -176,7 +198,9 @@ class piLink:
                 print("LCD content request.")
                 #print(json.dumps(self.LCD.buffer[:4]))
                 # Brewpi web interface has only 4 lines, so we don't send the whole buffer
-                self.connection.sendall(bytes('L:' + json.dumps(self.LCD.buffer[:4]) + '\r\n', 'UTF-8'))
+                # Only the first chamber has the display
+                lines = self.LCD.buffer[:4] if self.LCD is not None else []
+                self.connection.sendall(bytes('L:' + json.dumps(lines) + '\r\n', 'UTF-8'))
 
             elif inByte == 'j':  # Receive settings as json
                 print("Incoming JSON settings.")
@@ -200,11 +224,16 @@ class piLink:
                 pass
 
             elif inByte == 'h':  # hardware query
-                # FIXME not implemented
-                # openListResponse('h')
-                # deviceManager.enumerateHardwareToStream(piStream)
-                # closeListResponse()
-                pass
+                print("Hardware query.")
+                self.sendHardwareList()
+
+            elif inByte == 'w':  # one-wire read statistics
+                print("One-wire statistics request.")
+                self.sendBusStats()
+
+            elif inByte == 'q':  # sensor statistics
+                print("Sensor statistics request.")
+                self.sendSensorStats()
 
             elif inByte == 'R':  # reset
                 # FIXME not implemented
@@ -371,6 +400,56 @@ class piLink:
 
         self.connection.sendall(bytes('C:' + json.dumps(d) + '\r\n', 'UTF-8'))
 
+    def sendHardwareList(self):
+        """Send the one-wire sensors on the bus, with their roles."""
+        if self.connection is None:
+            return
+        devices = []
+        if self.registry is not None:
+            for deviceID in sorted(self.registry.devices):
+                role = self.registry.roleOf(deviceID)
+                if role is not None:
+                    if not role.startswith(self.rolePrefix) or role[len(self.rolePrefix):] not in DEVICE_FUNCTIONS:
+                        continue  # Another chamber's sensor
+                    role = role[len(self.rolePrefix):]
+                device = {"h": DEVICE_HARDWARE_ONEWIRE_TEMP,
+                          "a": deviceID,
+                          "f": DEVICE_FUNCTIONS.get(role, 0)}
+                if role is not None:
+                    temp = getattr(self.tempControl, role + 'Sensor').temperature
+                    if temp is not None:
+                        device["v"] = self.tempControl.temp_convert_to_external(temp)
+                devices.append(device)
+
+        self.connection.sendall(bytes('h:' + json.dumps(devices) + '\r\n', 'UTF-8'))
+
+    def sendBusStats(self):
+        """Send the read counters of each one-wire sensor, and the age of
+        its latest reading in seconds, by device ID."""
+        if self.connection is None:
+            return
+        stats = {}
+        for sensor in (self.tempControl.fridgeSensor, self.tempControl.beerSensor,
+                       self.tempControl.ambientSensor):
+            for probe in getattr(sensor, 'sensors', (sensor,)):
+                poller = getattr(probe, 'poller', None)
+                if poller is not None and probe.deviceID in poller.stats:
+                    stats[probe.deviceID] = poller.getStats()[probe.deviceID]
+                    age = probe.sampleAge()
+                    stats[probe.deviceID]['age'] = None if age is None else round(age, 3)
+
+        self.connection.sendall(bytes('w:' + json.dumps(stats) + '\r\n', 'UTF-8'))
+
+    def sendSensorStats(self):
+        """Send the histograms of read duration, sample age and MQTT arrival
+        interval of each sensor, with its read and failure counts, by role."""
+        if self.connection is None:
+            return
+        stats = {role: getattr(self.tempControl, role + 'Sensor').getStats()
+                 for role in ('fridge', 'beer', 'ambient')}
+
+        self.connection.sendall(bytes('q:' + json.dumps(stats) + '\r\n', 'UTF-8'))
+
     def sendControlVariables(self, cv):
         if self.connection is None:
             return
@@ -404,6 +483,12 @@ class piLink:
         newSettings = yaml.load(jsonBuf)
 
         print("New settings %s" % newSettings)
+        self.applySettings(newSettings)
+
+    def applySettings(self, newSettings):
+        """Apply a dict of settings and constants, keyed by JSONKEY_*."""
+        if self.tempControl.recorder is not None:
+            self.tempControl.recorder.settings(newSettings)
 
         # JSON_CONVERT(JSONKEY_mode, NULL, setMode),
         # JSON_CONVERT(JSONKEY_beerSetting, NULL, setBeerSetting),
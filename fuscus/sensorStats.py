@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Histograms and counters of how sensor readings are taken and used."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import array
+
+# Bucket 0 counts durations under 1ms, bucket i those from 2^(i-1) to
+# 2^i ms.  The last bucket also counts anything longer, from 2^19 ms
+# (about 9 minutes) up.
+UNIT = 0.001
+BUCKETS = 21
+
+
+class histogram:
+    """Counts of durations in seconds, in power-of-two buckets.
+
+    The buckets are a fixed array, so adding a value takes no allocation
+    and no lock.  Each histogram is added to by one thread only; another
+    thread reading it may see a count one behind, which does not matter
+    for statistics.
+    """
+
+    def __init__(self):
+        self.counts = array.array('L', bytes(array.array('L').itemsize * BUCKETS))
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        units = int(seconds / UNIT)
+        self.counts[min(units.bit_length(), BUCKETS - 1)] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        """Return the upper bound in seconds of the bucket holding the given
+        fraction of the values (at most the largest value), or None if
+        there are none."""
+        count = self.count()
+        if count == 0:
+            return None
+        rank = fraction * count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min((1 << i) * UNIT, self.max) if i < BUCKETS - 1 else self.max
+        return self.max
+
+    def asDict(self):
+        count = self.count()
+        return {'counts': list(self.counts),
+                'mean': round(self.total / count, 6) if count else None,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                'max': round(self.max, 6),
+                }
+
+
+class sensorStats:
+    """Statistics of one sensor, as seen by the controller.
+
+    sampleAge is the age of each reading when the filters use it, and
+    arrivalInterval the time between MQTT messages.  reads and failures
+    count the ticks with and without a reading.
+    """
+
+    def __init__(self):
+        self.sampleAge = histogram()
+        self.arrivalInterval = histogram()
+        self.reads = 0
+        self.failures = 0
+
+    def asDict(self):
+        return {'reads': self.reads,
+                'failures': self.failures,
+                'sampleAge': self.sampleAge.asDict(),
+                'arrivalInterval': self.arrivalInterval.asDict(),
+                }
+
+
+if __name__ == "__main__":
+
+    h = histogram()
+    for seconds in (0.0002, 0.0015, 0.003, 0.75, 0.76, 0.8, 1.2, 3600):
+        h.add(seconds)
+    print(h.asDict())
+    assert h.counts[0] == 1  # Under 1ms
+    assert h.counts[1] == 1  # 1ms
+    assert h.counts[2] == 1  # 2-4ms
+    assert h.counts[10] == 3  # 512-1024ms
+    assert h.counts[11] == 1  # 1024-2048ms
+    assert h.counts[BUCKETS - 1] == 1  # An hour
+    assert h.percentile(0.5) == 1.024
+    assert h.percentile(1.0) == 3600
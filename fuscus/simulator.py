@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""Run the temperature controller against a simulated fridge, faster than
+real time.
+
+The controller runs unchanged: the same updateTemperatures, detectPeaks,
+updatePID, updateState and updateOutputs sequence as the main loop, once
+per simulated second.  Only its surroundings are simulated:
+
+- ticks reads a virtual clock, which moves one second per tick
+- the relays drive a thermal model of the fridge instead of hardware
+- the sensors read the model through a poller which is never started
+- door openings come from a list of events
+- piLink and the EEPROM files are replaced by objects which do nothing
+
+The model is three heat capacities: the fridge air, the beer and the
+compressor's evaporator coil, coupled to each other and to the room by
+thermal conductances.  The cooler pulls heat from the coil, which cools
+the air with a lag, so cooling overshoots as in a real fridge.  An open
+door couples the air to the room much more strongly.
+
+At the end the compressor cycles, the heater and cooler duty, and the RMS
+and largest error of the beer temperature are reported.
+
+The controller's debug prints and the read statistics of the sensors
+are turned off.  Even so this is not fast enough to replay a
+fermentation in seconds: a tick takes about 60 us with the integer
+filters, so a simulated day takes about 5 seconds and 14 days over a
+minute.  Half of that is the six cascaded filters.  They cannot be run
+in batches, as the filter outputs of one tick switch the relays which
+drive the model in the next, and stepping the three sensors together in
+a FilterBank ('bank') takes twice as long as the integer filters.
+"""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import contextlib
+import math
+import os
+import random
+import time
+
+import ticks
+import tempControl
+import w1Poller
+
+FRIDGE_ID = "28-00000000000f"
+BEER_ID = "28-00000000000b"
+AMBIENT_ID = "28-00000000000a"
+
+# The virtual clock starts at this time.time(), 2020-01-01 00:00 UTC
+START_TIME = 1577836800
+
+
+class virtualClock:
+    """A clock which only moves when told to."""
+
+    def __init__(self, start=START_TIME):
+        self.start = start
+        self.elapsed = 0.0
+
+    def time(self):
+        return self.start + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance(self, seconds):
+        self.elapsed += seconds
+
+
+class thermalModel:
+    """Fridge air, beer and evaporator coil, as heat capacities (J/K)
+    coupled by conductances (W/K), stepped with Euler's method.
+
+    ambient is a function of the time in seconds, like the trajectories of
+    w1Simulator.  fermentationPower is the heat in W the yeast gives off at
+    the height of fermentation, fermentationPeak seconds in.
+    """
+
+    def __init__(self, beer=20.0, fridge=20.0, ambient=lambda t: 22.0,
+                 beerCapacity=84000, airCapacity=20000, coilCapacity=3000,
+                 wallConductance=1.5, doorConductance=30, beerConductance=5, coilConductance=20,
+                 coolingPower=100, heatingPower=60,
+                 fermentationPower=0.0, fermentationPeak=2 * 86400, fermentationWidth=86400):
+        self.beer = beer
+        self.fridge = fridge
+        self.coil = fridge
+        self.ambientTrajectory = ambient
+        self.ambient = ambient(0)
+
+        self.beerCapacity = beerCapacity
+        self.airCapacity = airCapacity
+        self.coilCapacity = coilCapacity
+        self.wallConductance = wallConductance
+        self.doorConductance = doorConductance
+        self.beerConductance = beerConductance
+        self.coilConductance = coilConductance
+        self.coolingPower = coolingPower
+        self.heatingPower = heatingPower
+        self.fermentationPower = fermentationPower
+        self.fermentationPeak = fermentationPeak
+        self.fermentationWidth = fermentationWidth
+
+    def fermentationHeat(self, t):
+        return self.fermentationPower * math.exp(-((t - self.fermentationPeak) / self.fermentationWidth) ** 2)
+
+    def step(self, t, dt, heating, cooling, doorOpen):
+        """Move the model on by dt seconds, to time t."""
+        self.ambient = self.ambientTrajectory(t)
+        wall = self.wallConductance + (self.doorConductance if doorOpen else 0)
+
+        toAir = (wall * (self.ambient - self.fridge)
+                 + self.beerConductance * (self.beer - self.fridge)
+                 + self.coilConductance * (self.coil - self.fridge)
+                 + (self.heatingPower if heating else 0))
+        toBeer = self.beerConductance * (self.fridge - self.beer) + self.fermentationHeat(t)
+        toCoil = self.coilConductance * (self.fridge - self.coil) - (self.coolingPower if cooling else 0)
+
+        self.fridge += toAir * dt / self.airCapacity
+        self.beer += toBeer * dt / self.beerCapacity
+        self.coil += toCoil * dt / self.coilCapacity
+
+
+class simulatedPoller(w1Poller.w1Poller):
+    """A poller which is never started.  sample() stores a reading of the
+    model for every sensor, with noise, at the 1/16 degree resolution of a
+    DS18B20.  Sample periods are ignored: every sensor is read every tick.
+    """
+
+    def __init__(self, model, noise=0.02, seed=None):
+        w1Poller.w1Poller.__init__(self)
+        self.model = model
+        self.noise = noise
+        self.random = random.Random(seed)
+
+    def temperature(self, deviceID):
+        value = {FRIDGE_ID: self.model.fridge,
+                 BEER_ID: self.model.beer,
+                 AMBIENT_ID: self.model.ambient}[deviceID]
+        if self.noise:
+            value += self.random.gauss(0, self.noise)
+        return round(value * 16) / 16
+
+    def add(self, deviceID, resolution=None, period=None):
+        w1Poller.w1Poller.add(self, deviceID, resolution, period)
+        self.store(deviceID, self.temperature(deviceID))  # Ready at once
+
+    def sample(self):
+        for deviceID in list(self.devices):
+            self.store(deviceID, self.temperature(deviceID))
+
+
+class simulatedRelay:
+    """A relay which counts how often and how long it is switched on."""
+
+    def __init__(self):
+        self.state = False
+        self.cycles = 0
+        self.onTime = 0.0
+
+    def set_output(self, state):
+        state = bool(state)
+        if state and not self.state:
+            self.cycles += 1
+        self.state = state
+
+
+class simulatedDoor:
+    """A door which is open during a list of (start, duration) seconds."""
+
+    def __init__(self, clock, events=()):
+        self.clock = clock
+        self.events = sorted(events)
+
+    @property
+    def isOpen(self):
+        t = self.clock.monotonic()
+        return any(start <= t < start + duration for start, duration in self.events)
+
+
+class nullPiLink:
+    """Takes the annotations and temperature reports of the controller."""
+
+    def printFridgeAnnotation(self, annotation):
+        pass
+
+    def printBeerAnnotation(self, annotation):
+        pass
+
+    def printTemperatures(self):
+        pass
+
+
+class nullEepromManager:
+    """Keeps the settings in memory only."""
+
+    def __init__(self, tempControl):
+        self.tempControl = tempControl
+        self.tempControl.eepromManager = self
+
+    def storeTempSettings(self):
+        self.tempControl.storedBeerSetting = self.tempControl.cs.beerSetting
+
+    def storeTempConstantsAndSettings(self):
+        self.storeTempSettings()
+
+
+class simulation:
+    """A controller and its surroundings, on a virtual clock.
+
+    mode is 'beer' or 'fridge', and settings is a list of (seconds,
+    temperature) changes of the beer or fridge setting, starting at 0.
+    doorEvents is a list of (start, duration) door openings in seconds.
+    estimator and estimatorOptions are passed to the controller.
+    Errors are measured from warmup seconds on, to leave out the first
+    approach to the setting.
+    """
+
+    def __init__(self, model=None, mode='beer', settings=((0, 20.0),), doorEvents=(),
+                 filterBackend='integer', noise=0.02, warmup=0, seed=None,
+                 estimator='filter', estimatorOptions=None):
+        self.model = model or thermalModel()
+        self.mode = mode
+        self.settings = sorted(settings)
+        self.warmup = warmup
+
+        self.clock = virtualClock()
+        ticks.setClock(self.clock.time, self.clock.monotonic)
+
+        self.poller = simulatedPoller(self.model, noise, seed)
+        self.cooler = simulatedRelay()
+        self.heater = simulatedRelay()
+        self.door = simulatedDoor(self.clock, doorEvents)
+
+        self.controller = tempControl.tempController(
+            FRIDGE_ID, BEER_ID, AMBIENT_ID, cooler=self.cooler, heater=self.heater, door=self.door,
+            filterBackend=filterBackend, sensorOptions={'poller': self.poller, 'stats': False},
+            estimator=estimator, estimatorOptions=estimatorOptions)
+        self.controller.verbose = False
+        self.controller.piLink = nullPiLink()
+        nullEepromManager(self.controller)
+        self.controller.loadDefaultConstants()
+        self.controller.loadDefaultSettings()
+        self.controller.setMode(tempControl.MODES['MODE_BEER_CONSTANT'] if mode == 'beer'
+                                else tempControl.MODES['MODE_FRIDGE_CONSTANT'])
+
+        self.nextSetting = 0
+        self.setting = None
+        self.ticks = 0
+        self.squaredError = 0.0
+        self.maxError = 0.0
+        self.errorTicks = 0
+
+    def applySettings(self):
+        t = self.clock.monotonic()
+        while self.nextSetting < len(self.settings) and self.settings[self.nextSetting][0] <= t:
+            self.setting = self.settings[self.nextSetting][1]
+            if self.mode == 'beer':
+                self.controller.setBeerTemp(self.setting)
+            else:
+                self.controller.setFridgeTemp(self.setting)
+            self.nextSetting += 1
+
+    def tick(self):
+        """Run one second: the model, the sensors, then the controller."""
+        self.applySettings()
+
+        self.clock.advance(1)
+        t = self.clock.monotonic()
+        self.model.step(t, 1, self.heater.state, self.cooler.state, self.door.isOpen)
+        self.poller.sample()
+
+        controller = self.controller
+        controller.updateTemperatures()
+        controller.detectPeaks()
+        controller.updatePID()
+        controller.updateState()
+        controller.updateSampleRates()
+        controller.updateOutputs()
+
+        self.ticks += 1
+        self.heater.onTime += self.heater.state
+        self.cooler.onTime += self.cooler.state
+        if t >= self.warmup:
+            error = (self.model.beer if self.mode == 'beer' else self.model.fridge) - self.setting
+            self.squaredError += error * error
+            self.maxError = max(self.maxError, abs(error))
+            self.errorTicks += 1
+
+    def run(self, seconds):
+        """Run for a number of simulated seconds.  The controller still
+        prints on door openings and state changes, which is thrown away."""
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for i in range(int(seconds)):
+                self.tick()
+
+    def results(self):
+        hours = self.ticks / 3600
+        return {'hours': round(hours, 2),
+                'compressorCycles': self.cooler.cycles,
+                'heaterCycles': self.heater.cycles,
+                'coolingDuty': round(self.cooler.onTime / max(1, self.ticks), 4),
+                'heatingDuty': round(self.heater.onTime / max(1, self.ticks), 4),
+                'rmsError': round(math.sqrt(self.squaredError / self.errorTicks), 4) if self.errorTicks else None,
+                'maxError': round(self.maxError, 4),
+                }
+
+    def close(self):
+        """Give ticks back the system clocks."""
+        ticks.setClock()
+
+
+def parseSettings(text):
+    """Parse "20" or "0:18,345600:21" (seconds:temperature, ...)."""
+    settings = []
+    for part in text.split(','):
+        if ':' in part:
+            seconds, temperature = part.split(':')
+            settings.append((float(seconds), float(temperature)))
+        else:
+            settings.append((0, float(part)))
+    return settings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=float, default=14, help='days to simulate')
+    parser.add_argument('--mode', choices=('beer', 'fridge'), default='beer', help='control mode')
+    parser.add_argument('--setting', default='20',
+                        help='temperature setting, or changes as seconds:temperature,... '
+                             '(e.g. 0:18,604800:21 for a rest after a week)')
+    parser.add_argument('--beer', type=float, default=22.0, help='starting beer temperature')
+    parser.add_argument('--ambient', type=float, default=22.0, help='mean room temperature')
+    parser.add_argument('--ambient-swing', type=float, default=3.0,
+                        help='day/night swing of the room temperature, up and down')
+    parser.add_argument('--fermentation', type=float, default=10.0,
+                        help='heat of the fermentation at its height, in W')
+    parser.add_argument('--door', action='append', default=[],
+                        help='door opening as start:duration in seconds (repeatable)')
+    parser.add_argument('--filter', default='integer', help='filter backend of the sensors')
+    parser.add_argument('--estimator', choices=('filter', 'kalman'), default='filter',
+                        help='estimator of the sensor temperatures')
+    parser.add_argument('--warmup', type=float, default=12,
+                        help='hours before the error is measured')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the sensor noise')
+    args = parser.parse_args()
+
+    model = thermalModel(beer=args.beer, fridge=args.ambient,
+                         ambient=lambda t: args.ambient + args.ambient_swing * math.sin(2 * math.pi * t / 86400),
+                         fermentationPower=args.fermentation)
+    doorEvents = [tuple(float(x) for x in door.split(':')) for door in args.door]
+    sim = simulation(model, args.mode, parseSettings(args.setting), doorEvents,
+                     filterBackend=args.filter, warmup=args.warmup * 3600, seed=args.seed,
+                     estimator=args.estimator)
+
+    start = time.perf_counter()
+    sim.run(args.days * 86400)
+    elapsed = time.perf_counter() - start
+    sim.close()
+
+    for key, value in sim.results().items():
+        print("%-18s %s" % (key, value))
+    print("Simulated %.1f days in %.1f seconds" % (args.days, elapsed))
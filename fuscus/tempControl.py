@@ -23,11 +23,14 @@
 
 import logging
 import pickle
+import time
 
 import ticks
 
 import tempSensor
 import mqttTempSensor
+import fusedTempSensor
+import FilterBank
 
 import os.path
 
@@ -51,6 +54,20 @@ MIN_SWITCH_TIME = 120
 # Time allowed for peak detection
 COOL_PEAK_DETECT_TIME = 60
 HEAT_PEAK_DETECT_TIME = 60
+# Seconds to wait at startup for the first sensor readings
+SENSOR_READY_TIMEOUT = 5
+
+# Restore the warm restart snapshot only if it is younger than this.
+SNAPSHOT_MAX_AGE = 300
+# Bump when the layout of the snapshot changes, so older ones are discarded
+SNAPSHOT_VERSION = 2
+
+# The settings, constants and snapshot are kept in this directory, unless
+# the controller is given another (one per chamber)
+STATE_DIR = './config'
+CONSTANTS_FILE = 'EEPROM.cc'
+SETTINGS_FILE = 'EEPROM.cs'
+SNAPSHOT_FILE = 'snapshot.pickle'
 
 MODES = {'MODE_FRIDGE_CONSTANT': 'f',
          'MODE_BEER_CONSTANT': 'b',
@@ -127,9 +144,15 @@ class ControlConstants:
 
 
 class tempController:
-    def __init__(self, ID_fridge=None, ID_beer=None, ID_ambient=None, MQTT_broker=None, MQTT_fridge=None, MQTT_beer=None, MQTT_ambient=None, cooler=None, heater=None, door=None):
+    def __init__(self, ID_fridge=None, ID_beer=None, ID_ambient=None, MQTT_broker=None, MQTT_fridge=None, MQTT_beer=None, MQTT_ambient=None, cooler=None, heater=None, door=None, filterBackend='decimal', filterBank=None,
+                 sensorOptions=None, estimator='filter', estimatorOptions=None,
+                 resolutions=None, samplePeriods=None, jsonSource=None, jsonPaths=None, stateDir=STATE_DIR):
         # We must have at least a fridge sensor
 
+        self.constantsFile = os.path.join(stateDir, CONSTANTS_FILE)
+        self.settingsFile = os.path.join(stateDir, SETTINGS_FILE)
+        self.snapshotFile = os.path.join(stateDir, SNAPSHOT_FILE)
+
         self.cs = ControlSettings()
         self.cv = ControlVariables()
         self.cc = ControlConstants()
@@ -154,27 +177,46 @@ class tempController:
 
         self.storedBeerSetting = None
 
-        # cameraLight.setActive(false);
+        # A traceRecorder, set by its attach()
+        self.recorder = None
 
-        # this is for cases where the device manager hasn't configured beer/fridge sensor.
-        # if (self.beerSensor==None):
-        self.beerSensor = tempSensor.sensor(ID_beer)
+        # Print the debug output of updatePID, updateState and detectPeaks.
+        # The simulator turns it off, as it is most of a tick's output.
+        self.verbose = True
 
-        # if (self.fridgeSensor==None):
-        if ID_fridge is not None:
-            self.fridgeSensor = tempSensor.sensor(ID_fridge)
-        else:
-            self.fridgeSensor = mqttTempSensor.sensor(MQTT_broker, MQTT_fridge)
-
-        if ID_beer is not None:
-            self.beerSensor = tempSensor.sensor(ID_beer)
-        else:
-            self.beerSensor = mqttTempSensor.sensor(MQTT_broker, MQTT_beer)
+        # cameraLight.setActive(false);
 
-        if ID_ambient is not None:
-            self.ambientSensor = tempSensor.sensor(ID_ambient)
-        else:
-            self.ambientSensor = mqttTempSensor.sensor(MQTT_broker, MQTT_ambient)
+        # With the 'bank' backend all sensor filters live in one FilterBank
+        # and are updated together in updateTemperatures().
+        if filterBackend == 'bank' and filterBank is None:
+            filterBank = FilterBank.FilterBank()
+        self.filterBank = filterBank
+        self.filterBackend = filterBackend  # The filter state in a snapshot is only valid for the same backend
+
+        # Keyword arguments for the sensor constructors
+        sensorOptions = dict(sensorOptions or {}, filterBackend=filterBackend, filterBank=filterBank)
+        # Kept so that a trace can rebuild the same sensors for a replay
+        self.sensorOptions = sensorOptions
+        self.estimator = estimator
+        self.estimatorOptions = estimatorOptions or {}
+        # Resolution in bits of the one-wire sensors, by device ID
+        self.resolutions = resolutions or {}
+        # (samplePeriod, idleSamplePeriod) of the one-wire sensors, by device ID
+        self.samplePeriods = samplePeriods or {}
+        self.sensorsActive = True  # Sensors start at their samplePeriod
+        # An mqttJsonSource, and the JSON path of each role's reading in it
+        self.jsonSource = jsonSource
+        jsonPaths = jsonPaths or {}
+
+        self.fridgeSensor = self.makeSensor('fridge', ID_fridge, MQTT_broker, MQTT_fridge, sensorOptions, estimator,
+                                            estimatorOptions, jsonPaths.get('fridge'))
+        self.beerSensor = self.makeSensor('beer', ID_beer, MQTT_broker, MQTT_beer, sensorOptions, estimator,
+                                          estimatorOptions, jsonPaths.get('beer'))
+        self.ambientSensor = self.makeSensor('ambient', ID_ambient, MQTT_broker, MQTT_ambient, sensorOptions, estimator,
+                                             estimatorOptions, jsonPaths.get('ambient'))
+
+        # The sensors get their first readings in parallel, so wait once
+        self.waitForSensors()
 
         self.beerSensor.init()
         self.fridgeSensor.init()
@@ -195,29 +237,146 @@ class tempController:
 
     # piLink will insert a reference to itself as self.piLink here
 
+    def makeSensor(self, role, deviceID, broker, topic, sensorOptions, estimator, estimatorOptions, path=None):
+        """Return the sensor for one role ('fridge', 'beer' or 'ambient').
+
+        The sensor reads a one-wire deviceID, else the value at a JSON path
+        in the messages of jsonSource, else an MQTT topic.  Each may list
+        several probes separated by commas.  Their readings are fused by a Kalman filter,
+        which is also used for a single probe if estimator is 'kalman'.
+        estimatorOptions maps a role to options for its Kalman filter, which
+        otherwise uses the noise settings tuned for the role."""
+        if deviceID is not None:
+            names = deviceID.split(',')
+        elif path is not None and self.jsonSource is not None:
+            names = path.split(',')
+        elif topic is not None:
+            names = topic.split(',')
+        else:
+            return mqttTempSensor.sensor(broker, None, **sensorOptions)
+        names = [name.strip() for name in names]
+
+        fused = len(names) > 1 or estimator == 'kalman'
+        if fused:
+            # The Kalman filter only reads the raw readings of the probes, so
+            # they get no filters, history or bank channel of their own
+            probeOptions = {'filters': False}
+            for key in ('poller', 'stats'):
+                if key in sensorOptions:
+                    probeOptions[key] = sensorOptions[key]
+        else:
+            probeOptions = sensorOptions
+
+        if deviceID is not None:
+            probes = []
+            for probeID in names:
+                samplePeriod, idleSamplePeriod = self.samplePeriods.get(probeID, (None, None))
+                probes.append(tempSensor.sensor(probeID, resolution=self.resolutions.get(probeID),
+                                                samplePeriod=samplePeriod,
+                                                idleSamplePeriod=idleSamplePeriod,
+                                                **probeOptions))
+        elif path is not None and self.jsonSource is not None:
+            probeOptions = {key: val for key, val in probeOptions.items() if key != 'poller'}
+            probes = [mqttTempSensor.sensor(broker, None, source=self.jsonSource, path=probePath,
+                                            **probeOptions)
+                      for probePath in names]
+        else:
+            probeOptions = {key: val for key, val in probeOptions.items() if key != 'poller'}
+            probes = [mqttTempSensor.sensor(broker, probeTopic, **probeOptions)
+                      for probeTopic in names]
+
+        if not fused:
+            return probes[0]
+        return fusedTempSensor.sensor(probes, role,
+                                      peakLookback=sensorOptions.get('peakLookback'),
+                                      peakProminence=sensorOptions.get('peakProminence', 0.1),
+                                      historySize=sensorOptions.get('historySize'),
+                                      stats=sensorOptions.get('stats', True),
+                                      **(estimatorOptions or {}).get(role, {}))
 
     def reset(self):
         self.doPosPeakDetect = False
         self.doNegPeakDetect = False
 
+    def rebindSensor(self, role, deviceID, calibrationOffset=None):
+        """Point the sensor of a role ('fridge', 'beer' or 'ambient') at
+        another one-wire device.  Fused sensors are left alone."""
+        sensor = getattr(self, role + 'Sensor')
+        if not hasattr(sensor, 'setDeviceID'):
+            return False
+        sensor.setDeviceID(deviceID)
+        if calibrationOffset is not None:
+            sensor.calibrationOffset = calibrationOffset
+        return True
+
+    def waitForSensors(self, timeout=SENSOR_READY_TIMEOUT):
+        """Wait until every sensor has been read once, or the timeout has
+        passed.  Returns True if they are all ready.
+
+        A sensor is ready once a read has finished, even if it failed.  A
+        sensor whose first read failed has no temperature yet, and its
+        filters are initialised from its first good reading, as after a
+        disconnect."""
+        deadline = time.monotonic() + timeout
+        ready = True
+        for sensor in (self.fridgeSensor, self.beerSensor, self.ambientSensor):
+            for probe in getattr(sensor, 'sensors', (sensor,)):
+                if not probe.ready.wait(max(0.0, deadline - time.monotonic())):
+                    logging.warning("Sensor %s not ready after %s seconds", probe.deviceID, timeout)
+                    ready = False
+        return ready
+
     def updateSensor(self, sensor):
+        # Initialise the filters of a sensor which had no reading yet, or
+        # has been disconnected for a while
+        if sensor.failedReadCount > 60:
+            sensor.init()
         sensor.update()
 
     # if not (sensor.isConnected()):
     #	sensor.init();
 
+    def updateSampleRates(self):
+        """Read the sensors at their full rate while heating, cooling or
+        waiting for a peak, and at their idle rate (if configured) while
+        idle or off.  The filters still get one input per tick."""
+        active = (self.state not in (STATES['IDLE'], STATES['STATE_OFF'])
+                  or self.doPosPeakDetect or self.doNegPeakDetect)
+        if active == self.sensorsActive:
+            return
+        self.sensorsActive = active
+        logging.debug("Sensors at %s sample rate", "full" if active else "idle")
+        for sensor in (self.fridgeSensor, self.beerSensor, self.ambientSensor):
+            sensor.setActive(active)
+
 
     def updateTemperatures(self):
-        self.updateSensor(self.beerSensor)
-        self.updateSensor(self.fridgeSensor)
-
         # Read ambient sensor to keep the value up to date.
         # If no sensor is connected, this does nothing.
         # This prevents a delay in serial response because
         # the value is not up to date.
         # if(ambientSensor->read() == TEMP_SENSOR_DISCONNECTED){
         # ambientSensor->init(); # try to reconnect a disconnected, but installed sensor
-        self.updateSensor(self.ambientSensor)
+        sensors = (self.beerSensor, self.fridgeSensor, self.ambientSensor)
+
+        if self.filterBank is None:
+            for sensor in sensors:
+                self.updateSensor(sensor)
+            return
+
+        # With a filter bank, step the fast and slow filters of all sensors
+        # before the sensors read their outputs, then step the slope
+        # filters they fed from them.
+        added = []
+        for sensor in sensors:
+            if sensor.failedReadCount > 60:
+                sensor.init()
+            added.append(sensor.addSample())
+        self.filterBank.step()
+        for sensor, wasAdded in zip(sensors, added):
+            if wasAdded:
+                sensor.updateDerived()
+        self.filterBank.step()
 
     def modeIsBeer(self):
         return self.cs.mode in (MODES['MODE_BEER_CONSTANT'],
@@ -226,10 +385,12 @@ class tempController:
     def updatePID(self):
         # static unsigned char integralUpdateCounter = 0;
         if (self.modeIsBeer()):
-            print("Mode is beer")
+            if self.verbose:
+                print("Mode is beer")
             # if(isDisabledOrInvalid(cs.beerSetting)){
             if (self.cs.beerSetting is None):
-                print("beerSetting is None")
+                if self.verbose:
+                    print("beerSetting is None")
                 # beer setting is not updated yet
                 # set fridge to unknown too
                 self.cs.fridgeSetting = None
@@ -243,7 +404,8 @@ class tempController:
 
             self.integralUpdateCounter += 1
 
-            print("integralUpdateCounter %s" % self.integralUpdateCounter)
+            if self.verbose:
+                print("integralUpdateCounter %s" % self.integralUpdateCounter)
 
             if (self.integralUpdateCounter == 60):
                 self.integralUpdateCounter = 0
@@ -288,8 +450,9 @@ class tempController:
                 self.cv.diffIntegral += integratorUpdate
 
             # calculate PID parts.
-            print(vars(self.cc))
-            print(vars(self.cv))
+            if self.verbose:
+                print(vars(self.cc))
+                print(vars(self.cv))
             self.cv.p = self.cc.Kp * self.cv.beerDiff
             self.cv.i = self.cc.Ki * self.cv.diffIntegral
             self.cv.d = self.cc.Kd * self.cv.beerSlope
@@ -312,9 +475,10 @@ class tempController:
 
     def updateState(self):
 
-        print("Update state. Mode %s, state %s" %
-              ({v: k for k, v in MODES.items()}[self.cs.mode],
-               {v: k for k, v in STATES.items()}[self.state]))
+        if self.verbose:
+            print("Update state. Mode %s, state %s" %
+                  ({v: k for k, v in MODES.items()}[self.cs.mode],
+                   {v: k for k, v in STATES.items()}[self.state]))
 
         stayIdle = False
         newDoorOpen = self.door.isOpen
@@ -408,6 +572,8 @@ class tempController:
                     self.state = STATES['WAITING_FOR_PEAK_DETECT']
 
         elif self.state in (STATES['COOLING'], STATES['COOLING_MIN_TIME']):
+            if not self.doNegPeakDetect:
+                self.fridgeSensor.resetPeakDetection()  # Only look for the peak after this cycle
             self.doNegPeakDetect = True
             self.lastCoolTime = secs
             self.updateEstimatedPeak(self.cc.maxCoolTimeForEstimate, self.cs.coolEstimator, sinceIdle)
@@ -425,6 +591,8 @@ class tempController:
                 # break
 
         elif self.state in (STATES['HEATING'], STATES['HEATING_MIN_TIME']):
+            if not self.doPosPeakDetect:
+                self.fridgeSensor.resetPeakDetection()  # Only look for the peak after this cycle
             self.doPosPeakDetect = True
             self.lastHeatTime = secs
             self.updateEstimatedPeak(self.cc.maxHeatTimeForEstimate, self.cs.heatEstimator, sinceIdle)
@@ -481,7 +649,8 @@ class tempController:
 
             peak = self.fridgeSensor.detectPosPeak()
             estimate = self.cv.posPeakEstimate
-            print("peak %s : estimate %s" % (peak, estimate))
+            if self.verbose:
+                print("peak %s : estimate %s" % (peak, estimate))
             # if peak is not None:	# FIXME: This could be moved into if statement below
             #	error = peak - estimate
             oldEstimator = self.cs.heatEstimator
@@ -525,7 +694,8 @@ class tempController:
             # FIXME: Either of these could be None.  Used to be INVALID_TEMP, so the maths would work.
             peak = self.fridgeSensor.detectNegPeak()
             estimate = self.cv.negPeakEstimate
-            print("peak %s : estimate %s" % (peak, estimate))
+            if self.verbose:
+                print("peak %s : estimate %s" % (peak, estimate))
             # if peak is not None:	# FIXME: This could be moved into if statement below
             #	error = peak - estimate	# FIXME: Crash if estimate is None
             oldEstimator = self.cs.coolEstimator
@@ -611,12 +781,12 @@ class tempController:
 
     def storeConstants(self):
         """Write variables in cc class to EEPROM (file)."""
-        with open('./config/EEPROM.cc', 'wb') as f:
+        with open(self.constantsFile, 'wb') as f:
             pickle.dump(vars(self.cc), f, pickle.HIGHEST_PROTOCOL)
 
     def loadConstants(self):
         """Read variables in cc class from EEPROM (file)."""
-        with open('./config/EEPROM.cc', 'rb') as f:
+        with open(self.constantsFile, 'rb') as f:
             data = pickle.load(f)
 
         self.cc.__dict__.update(data)
@@ -626,9 +796,9 @@ class tempController:
     def hasStoredSettings(self):
         # This is a departure from the Arduino implementation - This is designed to circumvent the hack that is used
         # in eepromManager to determine if we have settings to load.
-        if not os.path.isfile('./config/EEPROM.cc'):
+        if not os.path.isfile(self.constantsFile):
             return False
-        elif not os.path.isfile('./config/EEPROM.cs'):
+        elif not os.path.isfile(self.settingsFile):
             return False
         else:
             return True
@@ -636,20 +806,20 @@ class tempController:
     def zapStoredSettings(self):
         # Again - this is a departure from the Arduino implementation. Only moving this here (rather than in the
         # eepromManager class) because the definition of the file names is here
-        if os.path.isfile('./config/EEPROM.cc'):
-            os.remove('./config/EEPROM.cc')
-        if os.path.isfile('./config/EEPROM.cs'):
-            os.remove('./config/EEPROM.cs')
+        if os.path.isfile(self.constantsFile):
+            os.remove(self.constantsFile)
+        if os.path.isfile(self.settingsFile):
+            os.remove(self.settingsFile)
 
     def storeSettings(self):
         """Write variables in cs class to EEPROM (file)."""
-        with open('./config/EEPROM.cs', 'wb') as f:
+        with open(self.settingsFile, 'wb') as f:
             pickle.dump(vars(self.cs), f, pickle.HIGHEST_PROTOCOL)
         self.storedBeerSetting = self.cs.beerSetting
 
     def loadSettings(self):
         """Read variables in cs class from EEPROM (file)."""
-        with open('./config/EEPROM.cs', 'rb') as f:
+        with open(self.settingsFile, 'rb') as f:
             data = pickle.load(f)
 
         self.cs.__dict__.update(data)
@@ -658,6 +828,89 @@ class tempController:
         self.storedBeerSetting = self.cs.beerSetting
         self.setMode(self.cs.mode, True)  # Force the mode update
 
+    def storeSnapshot(self):
+        """Write filter and controller state to file for a warm restart.
+
+        Unlike the EEPROM files this is written often, so write a new
+        file and rename it, to never leave a partial snapshot behind."""
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'backend': self.filterBackend,
+                    'time': ticks.seconds(),
+                    'cv': vars(self.cv),
+                    'lastHeatTime': self.lastHeatTime,
+                    'lastCoolTime': self.lastCoolTime,
+                    'doPosPeakDetect': self.doPosPeakDetect,
+                    'doNegPeakDetect': self.doNegPeakDetect,
+                    'integralUpdateCounter': self.integralUpdateCounter,
+                    'fridgeSensor': self.fridgeSensor.getState(),
+                    'beerSensor': self.beerSensor.getState(),
+                    'ambientSensor': self.ambientSensor.getState(),
+                    }
+        with open(self.snapshotFile + '.new', 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.snapshotFile + '.new', self.snapshotFile)
+
+    def loadSnapshot(self):
+        """Restore the state saved by storeSnapshot(), if it is recent enough.
+
+        The controller state itself is not restored: the outputs were
+        switched off when we stopped, so we start from IDLE.  The heat
+        and cool times are, so the minimum off times are still honoured
+        but not restarted.
+
+        A snapshot that can't be read, or was written by another version
+        or with another filter backend, is discarded and we start cold,
+        as a warm restart must never stop the controller from starting."""
+        if not os.path.isfile(self.snapshotFile):
+            return False
+
+        sensors = ('fridgeSensor', 'beerSensor', 'ambientSensor')
+        # failedReadCount too, as a sensor which was not ready yet still
+        # has to initialise its filters
+        coldState = {name: (getattr(self, name).getState(), getattr(self, name).failedReadCount)
+                     for name in sensors}
+        try:
+            with open(self.snapshotFile, 'rb') as f:
+                snapshot = pickle.load(f)
+
+            if snapshot.get('version') != SNAPSHOT_VERSION:
+                logging.warning("Snapshot has version %s, not %s, not restoring it",
+                                snapshot.get('version'), SNAPSHOT_VERSION)
+                return False
+            if snapshot['backend'] != self.filterBackend:
+                logging.warning("Snapshot is of the %s filter backend, not %s, not restoring it",
+                                snapshot['backend'], self.filterBackend)
+                return False
+
+            age = ticks.timeSince(snapshot['time'])
+            if not (0 <= age <= SNAPSHOT_MAX_AGE):
+                logging.info("Snapshot is %d seconds old, not restoring it", age)
+                return False
+
+            # Look everything up before changing anything
+            cv = dict(snapshot['cv'])
+            timers = [snapshot[key] for key in ('lastHeatTime', 'lastCoolTime', 'doPosPeakDetect',
+                                                'doNegPeakDetect', 'integralUpdateCounter')]
+
+            for name in sensors:
+                if not getattr(self, name).setState(snapshot[name]):
+                    logging.info("%s has changed, not restoring its filters", name)
+        except (OSError, EOFError, AttributeError, pickle.UnpicklingError, KeyError, TypeError,
+                ValueError) as e:
+            logging.warning("Could not restore snapshot %s, starting cold: %r", self.snapshotFile, e)
+            for name, (state, failedReadCount) in coldState.items():
+                sensor = getattr(self, name)
+                sensor.setState(state)
+                sensor.failedReadCount = failedReadCount  # setState() takes the filters to be valid
+            return False
+
+        self.cv.__dict__.update(cv)
+        (self.lastHeatTime, self.lastCoolTime, self.doPosPeakDetect, self.doNegPeakDetect,
+         self.integralUpdateCounter) = timers
+
+        logging.info("Restored snapshot from %d seconds ago", age)
+        return True
+
     def loadDefaultConstants(self):
         # See ControlConstants class definition for descriptions
         self.cc.tempFormat = 'C'
@@ -20,28 +20,43 @@
 # along with BrewPi.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from DS18B20 import DS18B20
+import w1Poller
 
 import FilterCascaded
-
-import time
+import FilterOutlier
+import FilterBank
+import FilterSlope
+import PeakDetector
+import SampleHistory
+import sensorStats
+import ticks
+
+import threading
 import logging
 
 
 # tempSensor class for BrewPi
-# Subclassed from DS18B20, which is a general purpose threaded class
-# for reading DS18B20 one-wire temperature sensors.
-
-# This class adds filtering and other functions to the sensor.
-
-class sensor(DS18B20):
-    def __init__(self, deviceID, calibrationOffset=0.0):
+# The DS18B20 one-wire sensors are read by a w1Poller, which reads every
+# sensor on the bus from one thread.  This class picks up the latest
+# reading from the poller, and adds filtering and other functions to it.
 
-        super().__init__(deviceID, samplePeriod=1, calibrationOffset=calibrationOffset)
+class sensor():
+    def __init__(self, deviceID, calibrationOffset=0.0, filterBackend='decimal', filterBank=None,
+                 slopeWindow=None, peakLookback=None, peakProminence=0.1,
+                 outlierWindow=None, outlierThreshold=1.0, historySize=None, poller=None,
+                 resolution=None, samplePeriod=None, idleSamplePeriod=None, filters=True, stats=True):
 
         self.deviceID = deviceID
+        self.calibrationOffset = float(calibrationOffset)
 
-        self.start()
+        self.resolution = resolution
+        # Seconds between reads while the controller is active, and while
+        # it is idle.  None reads at the poller's samplePeriod.
+        self.samplePeriod = samplePeriod
+        self.idleSamplePeriod = idleSamplePeriod
+        self.period = samplePeriod
+        self.poller = poller if poller is not None else w1Poller.getPoller()
+        self.addToPoller()
 
         # An indication of how stale the data is in the filters
         # Each time a read fails, this value is incremented.
@@ -51,12 +66,132 @@ class sensor(DS18B20):
         self.failedReadCount = 255
         self.updateCounter = 255
 
-        self.fastFilter = FilterCascaded.CascadedFilter()
-        self.slowFilter = FilterCascaded.CascadedFilter()
-        self.slopeFilter = FilterCascaded.CascadedFilter()
+        self.stats = sensorStats.sensorStats()
+        # Count every read and its age for getStats(), unless turned off as
+        # by the simulator, which has no use for them
+        self.collectStats = stats
+
+        if not filters:
+            # A probe of a fused sensor only supplies raw readings
+            self.fastFilter = self.slowFilter = self.slopeFilter = None
+        elif filterBank is not None:
+            # The filters are views into a shared bank, which is stepped
+            # once per tick for all sensors.  Filter outputs only change
+            # when the bank is stepped, so the slope stage sees the slow
+            # filter output of the previous tick.
+            channel = filterBank.register()
+            self.fastFilter = filterBank.view(channel, FilterBank.FAST_FILTER)
+            self.slowFilter = filterBank.view(channel, FilterBank.SLOW_FILTER)
+            self.slopeFilter = filterBank.view(channel, FilterBank.SLOPE_FILTER)
+        else:
+            self.fastFilter = FilterCascaded.CascadedFilter(backend=filterBackend)
+            self.slowFilter = FilterCascaded.CascadedFilter(backend=filterBackend)
+            self.slopeFilter = FilterCascaded.CascadedFilter(backend=filterBackend)
         self.prevOutputForSlope = None
+        self.rawSample = None  # The latest reading given to the filters, before outlier rejection
+
+        # Optionally replace single bad readings by the median of the last
+        # outlierWindow readings before they reach the filters.
+        self.outlierFilter = None
+        if outlierWindow:
+            self.outlierFilter = FilterOutlier.MedianOutlierFilter(outlierWindow, outlierThreshold)
+
+        # Optionally estimate the slope with a least squares fit over the
+        # last slopeWindow samples, instead of the slope filter.
+        self.slopeEstimator = None
+        if slopeWindow:
+            self.slopeEstimator = FilterSlope.RegressionSlope(slopeWindow)
+
+        # Optionally find peaks of the slow filter over the last
+        # peakLookback samples, instead of only the last three outputs.
+        self.peakDetector = None
+        if peakLookback:
+            self.peakDetector = PeakDetector.PeakDetector(peakLookback, peakProminence)
+
+        # Optionally keep the last historySize raw and filtered samples
+        self.history = None
+        if historySize:
+            self.history = SampleHistory.SampleHistory(historySize)
+
+    @property
+    def temperature(self):
+        """Return the latest reading in degrees C, or None if the sensor can
+        not be read."""
+        temperature = self.poller.read(self.deviceID)
+        if temperature is None:
+            return None
+        return temperature + self.calibrationOffset
+
+    def readSample(self):
+        """Return (temperature, fresh), the input for the filters this tick.
+        If the sensor was read since the last tick, temperature is the mean
+        of those readings and fresh is True.  Otherwise it is the latest
+        reading and fresh is False.  temperature is None if the sensor can
+        not be read."""
+        if self.deviceID is None:
+            return None, False
+        temperature, fresh = self.poller.readAverage(self.deviceID)
+        if temperature is None:
+            return None, False
+        return temperature + self.calibrationOffset, fresh
+
+    def sampleAge(self):
+        """Return the seconds since the latest reading was taken, or None."""
+        if self.deviceID is None:
+            return None
+        return self.poller.sampleAge(self.deviceID)
+
+    def addToPoller(self):
+        if self.deviceID is not None:
+            self.poller.add(self.deviceID, self.resolution, self.period)
+            # Set once the first reading is ready
+            self.ready = self.poller.readyEvent(self.deviceID)
+        else:
+            self.ready = threading.Event()
+            self.ready.set()
+
+    def setDeviceID(self, deviceID):
+        """Read another device, e.g. after the probe was replaced.  The
+        filters start again from the first reading of the new device."""
+        if deviceID == self.deviceID:
+            return
+        if self.deviceID is not None:
+            self.poller.remove(self.deviceID)
+        self.deviceID = deviceID
+        self.addToPoller()
+        self.failedReadCount = 255
+
+    def getStats(self):
+        """Return the statistics of this sensor, with the duration of its
+        reads from the poller."""
+        stats = self.stats.asDict()
+        readStats = self.poller.stats.get(self.deviceID)
+        if readStats is not None:
+            stats['readDuration'] = readStats.readDuration.asDict()
+        return stats
+
+    def setActive(self, active):
+        """Read at samplePeriod while the controller is active, and at
+        idleSamplePeriod (if set) while it is idle."""
+        period = self.samplePeriod if active or self.idleSamplePeriod is None else self.idleSamplePeriod
+        if period is None:
+            period = self.poller.samplePeriod
+        if period == self.period:
+            return
+        self.period = period
+        if self.deviceID is not None:
+            self.poller.setPeriod(self.deviceID, period)
+
+    def stop(self):
+        """Stop polling this sensor.  The poller stops with its last sensor."""
+        if self.deviceID is not None:
+            self.poller.remove(self.deviceID)
+        if not self.poller.devices:
+            self.poller.stop()
 
-        time.sleep(1)  # Wait for at least one reading to be ready.
+    def join(self):
+        if not self.poller.running and self.poller.is_alive():
+            self.poller.join()
 
     def isConnected(self):
         return self.deviceID is not None
@@ -72,18 +207,60 @@ class sensor(DS18B20):
                 self.slowFilter.init(temp)
                 self.slopeFilter.init(0)
                 self.prevOutputForSlope = self.slowFilter.readOutput()
+                if self.outlierFilter is not None:
+                    self.outlierFilter.init()
+                if self.slopeEstimator is not None:
+                    self.slopeEstimator.init()
                 self.failedReadCount = 0
 
     def update(self):
+        if self.addSample():
+            self.updateDerived()
+
+    def addSample(self):
+        """Give the latest reading to the fast and slow filters.  Returns
+        False if there was none to give.
+
+        With a filter bank the filter outputs only change when the bank is
+        stepped, which tempController does before calling updateDerived()."""
         # if (!_sensor || (temp=_sensor->read())==TEMP_SENSOR_DISCONNECTED) {
-        temp = self.temperature
+        temp, fresh = self.readSample()
         if (temp is None):
+            self.stats.failures += 1
             if (self.failedReadCount < 255):  # limit
                 self.failedReadCount += 1
-            return
+            if self.history is not None:
+                self.history.add(ticks.monotonic(), None, None)
+            return False
+
+        # A sensor read every tick (or more often) feeds each reading to
+        # the filters once.  If this tick's reading is late, it is used next
+        # tick rather than the old one twice.  A sensor read less often
+        # holds its reading, so the filters still get one input per tick.
+        if not fresh and (self.period or self.poller.samplePeriod) <= w1Poller.TICK:
+            return False
+        if self.collectStats:
+            self.stats.reads += 1
+            self.stats.sampleAge.add(self.sampleAge())
+
+        raw = temp
+        if self.outlierFilter is not None:
+            temp = self.outlierFilter.add(temp)
 
         self.fastFilter.add(temp)
         self.slowFilter.add(temp)
+        if self.slopeEstimator is not None:
+            self.slopeEstimator.add(temp)
+        self.rawSample = raw
+        return True
+
+    def updateDerived(self):
+        """Update the history, peak detector and slope filter from the
+        outputs of the fast and slow filters."""
+        if self.history is not None:
+            self.history.add(ticks.monotonic(), self.rawSample, self.fastFilter.readOutput())
+        if self.peakDetector is not None:
+            self.peakDetector.add(self.slowFilter.readOutput())
         # update slope filter every 3 samples.
         # averaged differences will give the slope. Use the slow filter as input
         self.updateCounter -= 1
@@ -104,7 +281,7 @@ class sensor(DS18B20):
             #	diff = (-27l << 16);
             # }
 
-            self.slopeFilter.add(1200 * diff)  # Multiply by 1200 (1h/4s), shift to single precision
+            self.slopeFilter.addDoublePrecision(1200 * diff)  # Multiply by 1200 (1h/4s), shift to single precision
             self.prevOutputForSlope = slowFilterOutput
             self.updateCounter = 3
 
@@ -116,14 +293,31 @@ class sensor(DS18B20):
 
     def readSlope(self):
         """Return slope per hour."""
+        if self.slopeEstimator is not None:
+            return self.slopeEstimator.readSlope()
         return self.slopeFilter.readOutput()
 
     def detectPosPeak(self):
+        if self.peakDetector is not None:
+            return self.peakDetector.detectPosPeak()
         return self.slowFilter.detectPosPeak()
 
     def detectNegPeak(self):
+        if self.peakDetector is not None:
+            return self.peakDetector.detectNegPeak()
         return self.slowFilter.detectNegPeak()
 
+    def resetPeakDetection(self):
+        """Forget peaks so far, when the controller starts waiting for a new one."""
+        if self.peakDetector is not None:
+            self.peakDetector.reset()
+
+    def rejectedCount(self):
+        """Return the number of readings rejected as outliers."""
+        if self.outlierFilter is None:
+            return 0
+        return self.outlierFilter.rejectedCount
+
     def setFastFilterCoefficients(self, b):
         self.fastFilter.setCoefficients(b)
 
@@ -133,6 +327,35 @@ class sensor(DS18B20):
     def setSlopeFilterCoefficients(self, b):
         self.slopeFilter.setCoefficients(b)
 
+    def getState(self):
+        """Return the filter state, for a warm restart snapshot."""
+        filters = self.fastFilter is not None  # A probe of a fused sensor has none
+        return {'id': self.deviceID,
+                'fastFilter': self.fastFilter.getState() if filters else None,
+                'slowFilter': self.slowFilter.getState() if filters else None,
+                'slopeFilter': self.slopeFilter.getState() if filters else None,
+                'prevOutputForSlope': self.prevOutputForSlope,
+                'updateCounter': self.updateCounter,
+                'slopeEstimator': self.slopeEstimator.getState() if self.slopeEstimator else None,
+                }
+
+    def setState(self, state):
+        """Restore the filter state saved by getState().
+
+        Returns False if the state belongs to a different sensor."""
+        if state['id'] != self.deviceID:
+            return False
+        if self.fastFilter is not None:
+            self.fastFilter.setState(state['fastFilter'])
+            self.slowFilter.setState(state['slowFilter'])
+            self.slopeFilter.setState(state['slopeFilter'])
+        self.prevOutputForSlope = state['prevOutputForSlope']
+        self.updateCounter = state['updateCounter']
+        if self.slopeEstimator is not None and state.get('slopeEstimator') is not None:
+            self.slopeEstimator.setState(state['slopeEstimator'])
+        self.failedReadCount = 0  # The filters are valid, so don't re-initialise them
+        return True
+
     def hasSlowFilter():
         return True
 
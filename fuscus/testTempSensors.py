@@ -6,11 +6,14 @@ import os
 import datetime
 
 # Get a list of temperature sensors and report their values every second.
-# The W1 driver must be working.
+# The W1 driver must be working, or give the directory of a w1Simulator.
+
+if len(sys.argv) > 1:
+    DS18B20.W1_ROOT = sys.argv[1]
 
 sensors = []
 
-devices = os.listdir("/sys/bus/w1/devices/")
+devices = os.listdir(DS18B20.W1_ROOT)
 
 for device in devices:
     if device[:2] == "28":
@@ -18,7 +21,7 @@ for device in devices:
         sensors.append(DS18B20.DS18B20(device))
 
 if not sensors:
-    print("No sensors found in /sys/bus/w1/devices")
+    print("No sensors found in %s" % DS18B20.W1_ROOT)
     sys.exit()
 else:
     print("Found %s temperature sensors." % len(sensors))
@@ -23,12 +23,31 @@
 
 import time
 
+# The clocks.  simulator.py replaces them with a virtual clock, to run the
+# controller faster than real time.
+_clock = time.time
+_monotonicClock = time.monotonic
+
+
+def setClock(clock=None, monotonicClock=None):
+    """Take the time from other functions, which return seconds like
+    time.time() and time.monotonic().  With no arguments, go back to the
+    system clocks."""
+    global _clock, _monotonicClock
+    _clock = clock or time.time
+    _monotonicClock = monotonicClock or time.monotonic
+
 
 def timeSince(t):
     """Return number of seconds since time t."""
-    return time.time() - t
+    return _clock() - t
 
 
 def seconds():
     """Return current time in seconds."""
-    return time.time()
+    return _clock()
+
+
+def monotonic():
+    """Return seconds from an arbitrary start, which never goes backwards."""
+    return _monotonicClock()
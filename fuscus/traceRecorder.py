@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""Record what the controller sees, and replay it to find regressions.
+
+The recorder appends to a binary file, tick by tick, the inputs the
+controller used and what it did with them:
+
+- every sample a probe gave the filters (readSample()), and the latest
+  reading when that differs, which is what the filters start from after
+  an outage
+- settings received from the web interface (piLink.applySettings())
+- the door, when it opens or closes
+- the relays, when they switch
+- the controller state, mode and settings at the end of the tick
+
+Samples are taken where the controller reads them, not where the poller
+or MQTT produce them, so a replay sees exactly what the controller saw
+regardless of thread timing.  Samples, door and relay records belong to
+the tick whose state record follows them, and share its timestamp.
+
+Each run starts with a header record holding the construction options,
+settings and constants, and the filter and controller state at the time
+recording started, like a warm restart snapshot.  The outlier filter and
+peak detector windows are not in it, so a replay starts them empty, and
+replays are only exact from when those windows have filled.
+
+A replay rebuilds the controller with its probes fed from the recording
+by a poller which is never started, runs it on a virtual clock with
+the same tick sequence as the main loop, and compares each tick's state
+and relays against the recording.  A trace replayed by the code which
+recorded it gives no differences; a change in the control code shows up
+as the first tick where they differ.
+
+Settings changed from the menu, or by the 'C', 'S' and 'E' commands, are
+not recorded.
+
+Usage: traceRecorder.py dump FILE, or traceRecorder.py replay FILE.
+"""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import pickle
+import struct
+import time
+
+import piLink
+import simulator
+import ticks
+import tempControl
+import tempSensor
+import w1Poller
+
+VERSION = 1
+
+# Record types, the first byte of every record
+HEADER = 0
+SAMPLE = 1
+LATEST = 2
+SETTINGS = 3
+DOOR = 4
+RELAY = 5
+STATE = 6
+
+# The rest of each record.  Temperatures are doubles, so that a replay
+# gets exactly the values that were recorded; None is stored as NaN.
+FORMATS = {HEADER: struct.Struct('<I'),  # Length of the pickled header which follows
+           SAMPLE: struct.Struct('<BBd'),  # Probe, fresh, temperature
+           LATEST: struct.Struct('<Bd'),  # Probe, temperature
+           SETTINGS: struct.Struct('<dH'),  # Time, length of the JSON which follows
+           DOOR: struct.Struct('<B'),  # Open
+           RELAY: struct.Struct('<BB'),  # Relay, on
+           STATE: struct.Struct('<dBcdd'),  # Time, state, mode, beer setting, fridge setting
+           }
+
+ROLES = ('fridge', 'beer', 'ambient')
+RELAYS = ('cooler', 'heater')
+
+# Controller attributes saved in the header, beyond those of a snapshot
+CONTROLLER_ATTRIBUTES = ('state', 'doorOpen', 'lastIdleTime', 'lastHeatTime', 'lastCoolTime', 'waitTime',
+                         'doPosPeakDetect', 'doNegPeakDetect', 'integralUpdateCounter', 'storedBeerSetting',
+                         'sensorsActive')
+
+
+def toDouble(value):
+    return math.nan if value is None else float(value)
+
+
+def fromDouble(value):
+    return None if math.isnan(value) else value
+
+
+def probes(controller):
+    """Yield (role, probe) for every probe of the controller's sensors,
+    in a fixed order."""
+    for role in ROLES:
+        sensor = getattr(controller, role + 'Sensor')
+        for probe in getattr(sensor, 'sensors', (sensor,)):
+            yield role, probe
+
+
+class traceRecorder:
+    """Append a trace of the controller to a file.
+
+    Call attach() once the controller has its settings, then beginTick()
+    and endTick() around each tick of the main loop.  Everything is
+    recorded from the main loop's thread.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.controller = None
+        self.tickTime = None
+        self.doorOpen = None
+        self.relays = None
+
+    def write(self, recordType, *fields, payload=b''):
+        self.file.write(bytes((recordType,)) + FORMATS[recordType].pack(*fields) + payload)
+
+    def attach(self, controller):
+        """Start a new run in the trace, and record the samples controller
+        reads from now on."""
+        self.controller = controller
+        controller.recorder = self
+        self.file = open(self.filename, 'ab')
+
+        probeList = []
+        for slot, (role, probe) in enumerate(probes(controller)):
+            probeID = getattr(probe, 'topic', probe.deviceID)  # MQTT probes are identified by their topic
+            isW1 = isinstance(probe, tempSensor.sensor)
+            probeList.append({'role': role,
+                              'id': probeID,
+                              'w1': isW1,
+                              'samplePeriod': probe.samplePeriod if isW1 else None,
+                              'idleSamplePeriod': probe.idleSamplePeriod if isW1 else None,
+                              'pollerPeriod': probe.poller.samplePeriod if isW1 else None,
+                              })
+            if probeID is not None:
+                probe.readSample = self.recordingReadSample(slot, probe, probe.readSample)
+
+        self.doorOpen = controller.doorOpen
+        self.relays = tuple(bool(getattr(controller, name).state) for name in RELAYS)
+        header = {'version': VERSION,
+                  'time': ticks.seconds(),
+                  'probes': probeList,
+                  # Only plain values; the poller and filter bank are rebuilt
+                  'sensorOptions': {key: value for key, value in controller.sensorOptions.items()
+                                    if isinstance(value, (int, float, str, bool, type(None)))},
+                  'estimator': controller.estimator,
+                  'estimatorOptions': controller.estimatorOptions,
+                  'cs': vars(controller.cs),
+                  'cc': vars(controller.cc),
+                  'cv': vars(controller.cv),
+                  'controller': {name: getattr(controller, name) for name in CONTROLLER_ATTRIBUTES},
+                  'sensors': {role: getattr(controller, role + 'Sensor').getState() for role in ROLES},
+                  'relays': self.relays,
+                  }
+        data = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+        self.write(HEADER, len(data), payload=data)
+        self.file.flush()
+
+    def recordingReadSample(self, slot, probe, readSample):
+        """Wrap a probe's readSample() to record what it returns."""
+        def recordedReadSample():
+            temperature, fresh = readSample()
+            self.write(SAMPLE, slot, fresh, toDouble(temperature))
+            latest = probe.temperature
+            if latest != temperature:
+                self.write(LATEST, slot, toDouble(latest))
+            return temperature, fresh
+        return recordedReadSample
+
+    def settings(self, newSettings):
+        """Record settings about to be applied by piLink."""
+        if self.file is None:
+            return
+        data = json.dumps(newSettings, default=str).encode('utf-8')
+        self.write(SETTINGS, ticks.seconds(), len(data), payload=data)
+
+    def beginTick(self):
+        self.tickTime = ticks.seconds()
+
+    def endTick(self):
+        """Record the door and relays if they changed, and the state."""
+        controller = self.controller
+        if controller.doorOpen != self.doorOpen:
+            self.doorOpen = controller.doorOpen
+            self.write(DOOR, bool(self.doorOpen))
+        relays = tuple(bool(getattr(controller, name).state) for name in RELAYS)
+        for i, (old, new) in enumerate(zip(self.relays, relays)):
+            if old != new:
+                self.write(RELAY, i, new)
+        self.relays = relays
+        self.write(STATE, self.tickTime, controller.state, controller.cs.mode.encode('ascii'),
+                   toDouble(controller.cs.beerSetting), toDouble(controller.cs.fridgeSetting))
+        # At most one tick is lost if we stop without close()
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def readRecords(filename):
+    """Yield (recordType, fields) for each record of a trace.  HEADER
+    gives the header dict, and SETTINGS (time, settings dict)."""
+    with open(filename, 'rb') as f:
+        while True:
+            recordType = f.read(1)
+            if not recordType:
+                return
+            recordType = recordType[0]
+            recordFormat = FORMATS[recordType]
+            data = f.read(recordFormat.size)
+            if len(data) < recordFormat.size:
+                return  # The last record was cut short
+            fields = recordFormat.unpack(data)
+            if recordType == HEADER:
+                data = f.read(fields[0])
+                if len(data) < fields[0]:
+                    return
+                fields = pickle.loads(data)
+            elif recordType == SETTINGS:
+                data = f.read(fields[1])
+                if len(data) < fields[1]:
+                    return
+                fields = (fields[0], json.loads(data.decode('utf-8')))
+            yield recordType, fields
+
+
+class replayPoller(w1Poller.w1Poller):
+    """A poller which is never started, and returns the recorded samples."""
+
+    def __init__(self, samplePeriod=1):
+        w1Poller.w1Poller.__init__(self, samplePeriod)
+        self.samples = {}  # deviceID -> (temperature, fresh) for this tick
+
+    def add(self, deviceID, resolution=None, period=None):
+        w1Poller.w1Poller.add(self, deviceID, None, period)
+        self.ready[deviceID].set()
+
+    def feed(self, deviceID, temperature, fresh, latest):
+        self.samples[deviceID] = (temperature, fresh)
+        self.readings[deviceID] = latest
+        if fresh or deviceID not in self.captured:
+            self.captured[deviceID] = ticks.monotonic()
+
+    def readAverage(self, deviceID):
+        return self.samples.pop(deviceID, (self.readings.get(deviceID), False))
+
+
+class replayDoor:
+    def __init__(self, isOpen):
+        self.isOpen = isOpen
+
+
+class replay:
+    """Run one recorded run of the controller again, from its header."""
+
+    def __init__(self, header, clock):
+        if header['version'] != VERSION:
+            raise ValueError("Trace version %s, not %s" % (header['version'], VERSION))
+        self.clock = clock
+        self.setTime(header['time'])
+
+        probeList = header['probes']
+        self.poller = replayPoller(next((p['pollerPeriod'] for p in probeList if p['w1']), 1))
+
+        # Every probe is replayed as a one-wire probe.  MQTT probes hold
+        # their last reading, as a one-wire probe read less often than
+        # every tick does.
+        samplePeriods = {p['id']: ((p['samplePeriod'], p['idleSamplePeriod']) if p['w1'] else (math.inf, None))
+                         for p in probeList if p['id'] is not None}
+        roleIDs = {role: ",".join(str(p['id']) for p in probeList if p['role'] == role and p['id'] is not None)
+                   or None
+                   for role in ROLES}
+        self.slots = [p['id'] for p in probeList]
+
+        self.cooler = simulator.simulatedRelay()
+        self.heater = simulator.simulatedRelay()
+        self.cooler.set_output(header['relays'][0])
+        self.heater.set_output(header['relays'][1])
+        self.door = replayDoor(header['controller']['doorOpen'])
+        self.expectedRelays = list(header['relays'])
+
+        controller = tempControl.tempController(
+            roleIDs['fridge'], roleIDs['beer'], roleIDs['ambient'],
+            cooler=self.cooler, heater=self.heater, door=self.door,
+            filterBackend=header['sensorOptions'].get('filterBackend', 'decimal'),
+            sensorOptions=dict(header['sensorOptions'], poller=self.poller),
+            estimator=header['estimator'], estimatorOptions=header['estimatorOptions'],
+            samplePeriods=samplePeriods)
+        simulator.nullEepromManager(controller)
+        self.piLink = piLink.piLink(controller, None, controller.eepromManager, None)
+        self.controller = controller
+
+        controller.cs.__dict__.update(header['cs'])
+        controller.cc.__dict__.update(header['cc'])
+        controller.cv.__dict__.update(header['cv'])
+        controller.initFilters()
+        for role in ROLES:
+            getattr(controller, role + 'Sensor').setState(header['sensors'][role])
+        for name, value in header['controller'].items():
+            setattr(controller, name, value)
+        for role in ROLES:
+            getattr(controller, role + 'Sensor').setActive(controller.sensorsActive)
+
+        self.latest = {}  # slot -> latest reading, for the LATEST records
+        self.pending = {}  # slot -> (temperature, fresh) for this tick
+        self.ticks = 0
+
+    def setTime(self, t):
+        self.clock.advance(t - self.clock.time())
+
+    def sample(self, slot, fresh, temperature):
+        self.pending[slot] = (fromDouble(temperature), bool(fresh))
+
+    def tick(self, fields):
+        """Run one tick with the pending samples, and return a list of
+        (time, what, recorded, replayed) for anything that differs from
+        the recorded state."""
+        t, state, mode, beerSetting, fridgeSetting = fields
+        self.setTime(t)
+        for slot, (temperature, fresh) in self.pending.items():
+            latest = self.latest.pop(slot, temperature)
+            self.poller.feed(self.slots[slot], temperature, fresh, latest)
+        self.pending.clear()
+
+        controller = self.controller
+        controller.updateTemperatures()
+        controller.detectPeaks()
+        controller.updatePID()
+        controller.updateState()
+        controller.updateSampleRates()
+        controller.updateOutputs()
+        self.ticks += 1
+
+        recorded = (state, mode.decode('ascii'), fromDouble(beerSetting), fromDouble(fridgeSetting),
+                    self.expectedRelays[0], self.expectedRelays[1])
+        replayed = (controller.state, controller.cs.mode, controller.cs.beerSetting, controller.cs.fridgeSetting,
+                    self.cooler.state, self.heater.state)
+        names = ('state', 'mode', 'beerSetting', 'fridgeSetting') + RELAYS
+        return [(t, name, old, new) for name, old, new in zip(names, recorded, replayed) if old != new]
+
+
+def replayTrace(filename, stopAfter=None):
+    """Replay every run in a trace.  Returns (ticks, differences), where
+    differences is a list of (time, what, recorded, replayed).  Stops
+    after stopAfter differences, if given."""
+    clock = None
+    current = None
+    tickCount = 0
+    differences = []
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for recordType, fields in readRecords(filename):
+                if recordType == HEADER:
+                    if current is not None:
+                        tickCount += current.ticks
+                    clock = simulator.virtualClock(fields['time'])
+                    ticks.setClock(clock.time, clock.monotonic)
+                    current = replay(fields, clock)
+                elif current is None:
+                    raise ValueError("Trace does not start with a header")
+                elif recordType == SAMPLE:
+                    current.sample(*fields)
+                elif recordType == LATEST:
+                    current.latest[fields[0]] = fromDouble(fields[1])
+                elif recordType == SETTINGS:
+                    current.setTime(fields[0])
+                    current.piLink.applySettings(fields[1])
+                elif recordType == DOOR:
+                    current.door.isOpen = bool(fields[0])
+                elif recordType == RELAY:
+                    current.expectedRelays[fields[0]] = bool(fields[1])
+                elif recordType == STATE:
+                    differences.extend(current.tick(fields))
+                    if stopAfter is not None and len(differences) >= stopAfter:
+                        break
+    finally:
+        ticks.setClock()
+    if current is not None:
+        tickCount += current.ticks
+    return tickCount, differences
+
+
+def dump(filename):
+    """Print a trace as text."""
+    for recordType, fields in readRecords(filename):
+        if recordType == HEADER:
+            print("HEADER %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(fields['time'])))
+            for slot, probe in enumerate(fields['probes']):
+                print("  probe %d: %s %s" % (slot, probe['role'], probe['id']))
+        elif recordType == SAMPLE:
+            print("SAMPLE %d %s%s" % (fields[0], fromDouble(fields[2]), "" if fields[1] else " (held)"))
+        elif recordType == LATEST:
+            print("LATEST %d %s" % (fields[0], fromDouble(fields[1])))
+        elif recordType == SETTINGS:
+            print("SETTINGS %.3f %s" % fields)
+        elif recordType == DOOR:
+            print("DOOR %s" % ("open" if fields[0] else "closed"))
+        elif recordType == RELAY:
+            print("RELAY %s %s" % (RELAYS[fields[0]], "on" if fields[1] else "off"))
+        elif recordType == STATE:
+            t, state, mode, beerSetting, fridgeSetting = fields
+            print("STATE %.3f %d %s %s %s" % (t, state, mode.decode('ascii'),
+                                              fromDouble(beerSetting), fromDouble(fridgeSetting)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=('dump', 'replay'), help='print the trace, or replay it')
+    parser.add_argument('trace', help='trace file')
+    parser.add_argument('--stop', type=int, default=None, help='stop after this many differences')
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        dump(args.trace)
+    else:
+        start = time.perf_counter()
+        tickCount, differences = replayTrace(args.trace, args.stop)
+        elapsed = time.perf_counter() - start
+        for t, what, recorded, replayed in differences:
+            print("%s %-14s recorded %-8s replayed %s" % (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), what, recorded, replayed))
+        print("Replayed %d ticks in %.1f seconds, %d differences" % (tickCount, elapsed, len(differences)))
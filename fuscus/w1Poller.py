@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""Read every 1-wire temperature sensor from a single thread."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import glob
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+import DS18B20
+import sensorStats
+import ticks
+
+# Use bulk conversion on bus masters which support it
+BULK_READ = True
+
+# Give up waiting for a bulk conversion after this many seconds.  A 12 bit
+# conversion takes 750ms.
+BULK_TIMEOUT = 1.0
+BULK_POLL_INTERVAL = 0.05
+# When a bulk conversion can't be started on a master, its sensors are
+# read one by one, and bulk conversion is tried again after a backoff
+# from BULK_BACKOFF_BASE up to BULK_BACKOFF_MAX seconds
+BULK_BACKOFF_BASE = 10
+BULK_BACKOFF_MAX = 600
+
+# After a bad reading, read the sensor again after BACKOFF_BASE seconds,
+# doubling with each further failure up to BACKOFF_MAX, less a random
+# part of up to half, so retries of several sensors do not line up.
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 60
+
+# The last good reading is kept through this many bad readings in a row
+FAILURE_LIMIT = 5
+
+# The control loop ticks every TICK seconds, on whole seconds of the wall
+# clock.  Reads are timed to finish TICK_MARGIN seconds before a tick.
+TICK = 1
+TICK_MARGIN = 0.1
+
+
+class readStats:
+    """Counters of the reads of one sensor."""
+
+    def __init__(self):
+        self.reads = 0
+        self.crcErrors = 0
+        self.discarded85 = 0
+        self.openErrors = 0
+        self.readTime = 0.0  # Seconds spent reading, not counting bulk conversions
+        self.failures = 0  # Failed reads in a row
+        self.readDuration = sensorStats.histogram()
+
+    def count(self, error, seconds):
+        self.reads += 1
+        self.readTime += seconds
+        self.readDuration.add(seconds)
+        if error is None:
+            self.failures = 0
+            return
+        self.failures += 1
+        if error == DS18B20.CRC_ERROR:
+            self.crcErrors += 1
+        elif error == DS18B20.POWER_ON_RESET:
+            self.discarded85 += 1
+        else:
+            self.openErrors += 1
+
+    def asDict(self):
+        """Return the counters, without the histogram."""
+        return {'reads': self.reads,
+                'crcErrors': self.crcErrors,
+                'discarded85': self.discarded85,
+                'openErrors': self.openErrors,
+                'readTime': round(self.readTime, 3),
+                'failures': self.failures,
+                }
+
+
+def backoff(failures, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """Return the seconds to wait before reading a sensor again after a
+    number of failed reads in a row."""
+    delay = min(maximum, base * 2 ** (failures - 1))
+    return delay - random.uniform(0, delay / 2)
+
+
+class w1Poller(threading.Thread):
+    """Poll a set of DS18B20 sensors in turn, from one worker thread.
+
+    All the sensors share one bus, so reading them from separate threads
+    only makes them queue up in the driver.  Here each sensor is read in
+    turn, and the latest reading of each is kept for the sensor objects to
+    pick up.
+
+    Each sensor is read every samplePeriod seconds by default, or at its
+    own period, which may be changed while running (see setPeriod()).  A
+    sensor which barely changes can be read every minute, and one read
+    more often than the controller ticks is oversampled: readAverage()
+    returns the mean of the readings since it was last called.
+
+    Reads are scheduled on absolute deadlines, timed to finish just before
+    a multiple of the period on the wall clock.  The control loop ticks on
+    whole seconds, so each tick finds a reading less than TICK_MARGIN
+    seconds old, rather than one up to a period old which drifts against
+    the tick.  Each reading is stamped with its ticks.monotonic() capture
+    time.  Sensors are read as soon as the bus is free if the reads fall
+    behind.
+
+    Reading sensors one after another costs about 750ms each.  Where the
+    kernel driver offers therm_bulk_read on the bus master, one conversion
+    is started on every sensor of the bus at once, and the readings are
+    collected once it is finished.  Sensors on other masters are read one
+    by one as before, as are those of a master where a bulk conversion
+    could not be started, until it is tried again after a backoff.
+
+    A bad reading (a CRC failure or 85.0) is not retried at once, which
+    would cost another conversion while the other sensors wait.  Instead
+    the sensor is read again after a backoff which grows with each failure
+    in a row, and its last good reading is kept until FAILURE_LIMIT reads
+    have failed.  A sensor which can not be opened reads None at once.
+    The counters of each sensor are returned by getStats().
+
+    Readings are raw: the sensor objects add their calibration offset.
+    """
+
+    def __init__(self, samplePeriod=1, w1Root=None, bulkRead=None):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.samplePeriod = samplePeriod
+        self.w1Root = w1Root or DS18B20.W1_ROOT
+        self.bulkRead = BULK_READ if bulkRead is None else bulkRead
+
+        # Bus master directory -> deviceIDs on it, rebuilt when devices change
+        self.masters = None
+        self.bulkFailures = {}  # master -> failed bulk conversions in a row
+        self.bulkRetry = {}  # master -> time.monotonic() to try bulk conversion again
+
+        self.lock = threading.Lock()
+        self.devices = {}  # deviceID -> number of clients
+        self.readings = {}  # deviceID -> latest temperature, or None
+        self.pendingResolutions = {}  # deviceID -> bits, set by the worker
+        self.ready = {}  # deviceID -> Event, set once a read has been attempted
+        self.periods = {}  # deviceID -> seconds between reads
+        self.due = {}  # deviceID -> time.monotonic() of the next read
+        self.sums = {}  # deviceID -> [sum, count] of readings since readAverage()
+        self.stats = {}  # deviceID -> readStats
+        self.captured = {}  # deviceID -> ticks.monotonic() of the latest good reading
+        self.resolutions = {}  # deviceID -> bits, to time the reads
+
+        # Set to make the worker look at the schedule again
+        self.wake = threading.Event()
+
+        self.running = True  # Until stop() is called
+
+    def add(self, deviceID, resolution=None, period=None):
+        """Start polling a sensor.  A sensor can be added more than once.
+
+        If resolution is given (9 to 12 bits), it is set before the next
+        reading.  Lower resolution converts faster.  period is the time
+        between reads in seconds, samplePeriod if not given."""
+        if resolution is not None and resolution not in DS18B20.CONVERSION_TIME:
+            raise ValueError("Resolution must be 9 to 12 bits, not %s" % resolution)
+        if period is not None and period <= 0:
+            raise ValueError("Sample period must be positive, not %s" % period)
+        with self.lock:
+            self.devices[deviceID] = self.devices.get(deviceID, 0) + 1
+            self.readings.setdefault(deviceID, None)
+            self.ready.setdefault(deviceID, threading.Event())
+            self.sums.setdefault(deviceID, [0.0, 0])
+            self.stats.setdefault(deviceID, readStats())
+            if period is not None or deviceID not in self.periods:
+                self.periods[deviceID] = period or self.samplePeriod
+            self.due.setdefault(deviceID, time.monotonic())
+            if resolution is not None:
+                self.pendingResolutions[deviceID] = resolution
+                self.resolutions[deviceID] = resolution
+            self.masters = None
+        self.wake.set()
+
+    def remove(self, deviceID):
+        """Stop polling a sensor, once every client that added it has removed it."""
+        with self.lock:
+            self.devices[deviceID] -= 1
+            if self.devices[deviceID] == 0:
+                del self.devices[deviceID]
+                del self.readings[deviceID]
+                del self.ready[deviceID]
+                del self.periods[deviceID]
+                del self.due[deviceID]
+                del self.sums[deviceID]
+                del self.stats[deviceID]
+                self.captured.pop(deviceID, None)
+                self.resolutions.pop(deviceID, None)
+                self.masters = None
+
+    def setPeriod(self, deviceID, period):
+        """Change the time between reads of a sensor.  A shorter period
+        takes effect at once, a longer one after the next read."""
+        if period <= 0:
+            raise ValueError("Sample period must be positive, not %s" % period)
+        with self.lock:
+            if deviceID not in self.periods or self.periods[deviceID] == period:
+                return
+            self.periods[deviceID] = period
+            self.due[deviceID] = min(self.due[deviceID], self.nextDue(deviceID, time.monotonic()))
+        self.wake.set()
+
+    def nextDue(self, deviceID, now):
+        """Return when to start the next read of a sensor, so that it
+        finishes TICK_MARGIN seconds before a multiple of its period on
+        the wall clock.  Call with the lock held."""
+        period = self.periods[deviceID]
+        lead = DS18B20.CONVERSION_TIME[self.resolutions.get(deviceID, 12)] + TICK_MARGIN
+        wallOffset = time.time() - time.monotonic()
+        finish = math.ceil((now + wallOffset + lead) / period) * period
+        return finish - wallOffset - lead
+
+    def read(self, deviceID):
+        """Return the latest reading of a sensor, or None."""
+        return self.readings.get(deviceID)
+
+    def readAverage(self, deviceID):
+        """Return (temperature, fresh).  If the sensor was read since the
+        last call, temperature is the mean of those readings and fresh is
+        True.  Otherwise it is the latest reading (which may be None), and
+        fresh is False.
+
+        Called once per tick, this averages oversampled readings, and tells
+        the sensor whether it has a new reading for the filters."""
+        with self.lock:
+            total = self.sums.get(deviceID)
+            if not total or not total[1]:
+                return self.readings.get(deviceID), False
+            mean = total[0] / total[1]
+            total[0], total[1] = 0.0, 0
+            return mean, True
+
+    def sampleAge(self, deviceID):
+        """Return the seconds since the latest good reading of a sensor,
+        or None if it has not been read."""
+        captured = self.captured.get(deviceID)
+        if captured is None:
+            return None
+        return ticks.monotonic() - captured
+
+    def store(self, deviceID, temperature):
+        """Record a good reading, captured now."""
+        with self.lock:
+            if deviceID not in self.readings:
+                return  # Removed while being read
+            self.readings[deviceID] = temperature
+            self.captured[deviceID] = ticks.monotonic()
+            self.sums[deviceID][0] += temperature
+            self.sums[deviceID][1] += 1
+            ready = self.ready[deviceID]
+            if not ready.is_set():  # set() takes a lock even when set
+                ready.set()
+
+    def getStats(self):
+        """Return {deviceID: {counter: value}} for every sensor."""
+        with self.lock:
+            return {deviceID: stats.asDict() for deviceID, stats in self.stats.items()}
+
+    def readyEvent(self, deviceID):
+        """Return an Event which is set once the first read of the sensor
+        has finished, whether or not it succeeded.  After a CRC error or
+        an 85.0 reading the sensor still reads None until a read succeeds."""
+        return self.ready[deviceID]
+
+    def findMasters(self, deviceIDs):
+        """Return {master: [deviceIDs]} for the masters which support bulk
+        conversion.  A master lists its devices as subdirectories."""
+        masters = {}
+        if not self.bulkRead:
+            return masters
+        for master in sorted(glob.glob(os.path.join(self.w1Root, "w1_bus_master*"))):
+            if not os.path.exists(os.path.join(master, "therm_bulk_read")):
+                continue
+            onMaster = [deviceID for deviceID in deviceIDs
+                        if os.path.exists(os.path.join(master, deviceID))]
+            if onMaster:
+                masters[master] = onMaster
+        return masters
+
+    def bulkConvert(self, master):
+        """Start a conversion on every sensor of a master and wait for it.
+        Returns False if the conversion could not be started."""
+        filename = os.path.join(master, "therm_bulk_read")
+        try:
+            with open(filename, "w") as f:
+                f.write("trigger\n")
+        except OSError:
+            logging.warning("Could not start bulk conversion on '%s'", master)
+            return False
+
+        # Reads -1 while any sensor is still converting
+        deadline = time.time() + BULK_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(BULK_POLL_INTERVAL)
+            try:
+                with open(filename) as f:
+                    if f.read().strip() != "-1":
+                        return True
+            except OSError:
+                return False
+        logging.warning("Bulk conversion on '%s' timed out", master)
+        return True  # Read anyway; unfinished sensors convert on their own
+
+    def readOne(self, deviceID):
+        """Read a device once.  Returns (deviceID, temperature, error,
+        seconds taken), as for DS18B20.readOnce()."""
+        start = time.monotonic()
+        temperature, error = DS18B20.readOnce(deviceID, self.w1Root)
+        return deviceID, temperature, error, time.monotonic() - start
+
+    def readAll(self, deviceIDs):
+        """Read the devices once, using bulk conversion where possible.
+        Yields the results of readOne().
+
+        A bulk conversion converts every sensor on the master, but only
+        those in deviceIDs are read."""
+        masters = self.masters
+        if masters is None:
+            masters = self.masters = self.findMasters(sorted(set(self.devices) | set(deviceIDs)))
+
+        done = set()
+        for master, onMaster in masters.items():
+            onMaster = [deviceID for deviceID in onMaster if deviceID in deviceIDs]
+            if not onMaster or time.monotonic() < self.bulkRetry.get(master, 0):
+                continue
+            if not self.bulkConvert(master):
+                # Read these one by one for now, as the error may well pass
+                failures = self.bulkFailures[master] = self.bulkFailures.get(master, 0) + 1
+                self.bulkRetry[master] = time.monotonic() + backoff(failures, BULK_BACKOFF_BASE,
+                                                                    BULK_BACKOFF_MAX)
+                continue
+            self.bulkFailures.pop(master, None)
+            self.bulkRetry.pop(master, None)
+            for deviceID in onMaster:
+                done.add(deviceID)
+                yield self.readOne(deviceID)
+
+        for deviceID in deviceIDs:
+            if deviceID not in done:
+                yield self.readOne(deviceID)
+
+    def run(self):
+
+        while (self.running):
+            self.wake.clear()
+
+            with self.lock:
+                now = time.monotonic()
+                deviceIDs = [deviceID for deviceID, due in self.due.items() if due <= now]
+                resolutions = self.pendingResolutions
+                self.pendingResolutions = {}
+
+            # Only this thread uses the bus
+            for deviceID, bits in resolutions.items():
+                DS18B20.setResolution(deviceID, bits, self.w1Root)
+
+            retries = {}  # deviceID -> seconds to wait before reading it again
+            for deviceID, temperature, error, seconds in self.readAll(deviceIDs):
+                if not self.running:
+                    break
+                if error is None:
+                    self.store(deviceID, temperature)
+                with self.lock:
+                    if deviceID not in self.readings:
+                        continue  # Removed while being read
+                    stats = self.stats[deviceID]
+                    stats.count(error, seconds)
+                    if error is None:
+                        continue
+
+                    retries[deviceID] = backoff(stats.failures)
+                    if error == DS18B20.OPEN_ERROR or stats.failures >= FAILURE_LIMIT:
+                        self.readings[deviceID] = None
+                    # A good reading has set it in store()
+                    ready = self.ready[deviceID]
+                    if not ready.is_set():
+                        ready.set()
+                if stats.failures in (1, FAILURE_LIMIT):
+                    logging.warning("Bad reading from '%s' (%s), %d in a row",
+                                    deviceID, error, stats.failures)
+
+            with self.lock:
+                now = time.monotonic()
+                for deviceID in deviceIDs:
+                    if deviceID in retries and deviceID in self.due:
+                        self.due[deviceID] = now + retries[deviceID]
+                    elif deviceID in self.due:
+                        self.due[deviceID] = self.nextDue(deviceID, now)
+                wait = min(self.due.values(), default=now + self.samplePeriod) - now
+
+            self.wake.wait(max(0, wait))
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+
+# The poller shared by all sensors, started when the first one is added
+_poller = None
+_pollerLock = threading.Lock()
+
+
+def getPoller():
+    """Return the shared poller, starting it if need be."""
+    global _poller
+    with _pollerLock:
+        if _poller is None or not _poller.running:
+            _poller = w1Poller()
+            _poller.start()
+        return _poller
+
+
+def makeFakeTree(root, temperatures, bulk=True):
+    """Create a sysfs-like tree of sensors with fixed readings, for testing."""
+    master = os.path.join(root, "w1_bus_master1")
+    os.makedirs(master, exist_ok=True)
+    if bulk:
+        with open(os.path.join(master, "therm_bulk_read"), "w") as f:
+            f.write("0\n")
+    for deviceID, temperature in temperatures.items():
+        os.makedirs(os.path.join(master, deviceID), exist_ok=True)
+        os.makedirs(os.path.join(root, deviceID), exist_ok=True)
+        with open(os.path.join(root, deviceID, "w1_slave"), "w") as f:
+            f.write("72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n"
+                    "72 01 4b 46 7f ff 0e 10 57 t=%d\n" % round(temperature * 1000))
+
+
+if __name__ == "__main__":
+
+    # Read a fake sysfs tree, with and without bulk conversion
+    import tempfile
+
+    temperatures = {"28-000000000001": 20.5, "28-000000000002": 18.25}
+    for bulk in (True, False):
+        with tempfile.TemporaryDirectory() as root:
+            makeFakeTree(root, temperatures, bulk)
+            poller = w1Poller(w1Root=root)
+            readings = {deviceID: temperature
+                        for deviceID, temperature, error, seconds in poller.readAll(sorted(temperatures))}
+            print("Bulk %s: %s, masters %s" % (bulk, readings, list(poller.masters)))
+            assert readings == temperatures
+            assert bool(poller.masters) == bulk
+            if bulk:
+                with open(os.path.join(root, "w1_bus_master1", "therm_bulk_read")) as f:
+                    assert f.read() == "trigger\n"
+
+    # The temperature attribute is used when present, and resolution is set
+    with tempfile.TemporaryDirectory() as root:
+        makeFakeTree(root, {"28-000000000003": 20.0}, bulk=False)
+        with open(os.path.join(root, "28-000000000003", "temperature"), "w") as f:
+            f.write("21062\n")
+        assert DS18B20.read("28-000000000003", root) == 21.062
+        assert DS18B20.setResolution("28-000000000003", 10, root)
+        with open(os.path.join(root, "28-000000000003", "resolution")) as f:
+            assert f.read() == "10\n"
+
+    # Each sensor is read at its own period, and oversampled readings are
+    # averaged
+    with tempfile.TemporaryDirectory() as root:
+        makeFakeTree(root, temperatures, bulk=False)
+        poller = w1Poller(w1Root=root)
+        poller.add("28-000000000001", period=0.1)
+        poller.add("28-000000000002", period=3600)
+        poller.start()
+        time.sleep(1.05)
+        counts = {deviceID: total[1] for deviceID, total in poller.sums.items()}
+        print("Reads in one second: %s" % counts)
+        assert counts["28-000000000001"] >= 8 and counts["28-000000000002"] == 1
+        assert poller.readAverage("28-000000000001") == (20.5, True)
+        assert poller.sums["28-000000000001"][1] == 0
+        assert poller.readAverage("28-000000000002") == (18.25, True)
+        assert poller.readAverage("28-000000000002") == (18.25, False)  # Held
+        assert poller.sampleAge("28-000000000001") < 0.2
+        poller.setPeriod("28-000000000002", 0.1)
+        time.sleep(0.3)
+        assert poller.sums["28-000000000002"][1] >= 1
+        poller.stop()
+        poller.join(1)
+        assert not poller.is_alive()
+
+    # A bad reading is retried after a growing backoff, and the last good
+    # reading is kept until FAILURE_LIMIT reads have failed
+    with tempfile.TemporaryDirectory() as root:
+        makeFakeTree(root, {"28-000000000004": 19.0}, bulk=False)
+        poller = w1Poller(w1Root=root)
+        poller.add("28-000000000004")
+        poller.start()
+        assert poller.readyEvent("28-000000000004").wait(1)
+        with open(os.path.join(root, "28-000000000004", "w1_slave"), "w") as f:
+            f.write("72 01 4b 46 7f ff 0e 10 57 : crc=57 NO\n"
+                    "72 01 4b 46 7f ff 0e 10 57 t=19000\n")
+        while not poller.getStats()["28-000000000004"]["crcErrors"]:
+            time.sleep(0.01)
+        assert poller.read("28-000000000004") == 19.0
+        time.sleep(3)
+        stats = poller.getStats()["28-000000000004"]
+        print("Stats after CRC failures: %s" % stats)
+        assert FAILURE_LIMIT <= stats["crcErrors"] < 10
+        assert poller.read("28-000000000004") is None
+        poller.stop()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Keep track of the 1-wire temperature sensors and which role each has."""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import pickle
+
+import DS18B20
+
+# DS18B20 devices are in family 28
+FAMILY_PREFIX = "28-"
+
+ROLES = ('fridge', 'beer', 'ambient')
+
+MAPPING_FILE = './config/devices.pickle'
+
+
+class w1Registry:
+    """Index the DS18B20 sensors on the bus, and bind them to roles.
+
+    scan() lists the devices directory and compares it with the previous
+    listing, which is cheap enough to do every few seconds.  When the
+    sensor of a role has gone and exactly one new, unused sensor has
+    appeared, the new sensor takes over the role: this is a probe being
+    replaced.  Anything less clear cut is left for the user to sort out.
+
+    The roles are saved to MAPPING_FILE, so a replaced probe stays bound
+    after a restart.  Functions in listeners are called with (role,
+    deviceID) when a role is bound to another device.
+    """
+
+    def __init__(self, w1Root=None, mappingFile=MAPPING_FILE):
+        self.w1Root = w1Root or DS18B20.W1_ROOT
+        self.mappingFile = mappingFile
+
+        self.devices = set()
+        self.roles = {}  # role -> deviceID
+        self.configured = {}  # role -> deviceID in the config file when it was bound
+        self.listed = set()  # Probes of fused sensors, which have no role of their own
+        self.listeners = []
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.mappingFile, 'rb') as f:
+                mapping = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        self.roles = mapping['roles']
+        self.configured = mapping['configured']
+
+    def save(self):
+        """Write the roles atomically, so a crash can't leave half a file."""
+        filename = self.mappingFile + '.new'
+        try:
+            with open(filename, 'wb') as f:
+                pickle.dump({'roles': self.roles, 'configured': self.configured}, f)
+            os.replace(filename, self.mappingFile)
+        except OSError as e:
+            logging.warning("Could not save device roles: %s", e)
+
+    def configure(self, role, deviceID):
+        """Return the device to use for a role, given the one in the config file.
+
+        If the config file still names the device it did when the role was
+        last bound, the saved binding is used, as the probe may have been
+        replaced since.  Lists of several probes are used as they are."""
+        if deviceID is None:
+            return deviceID
+        if ',' in deviceID:
+            self.listed.update(probe.strip() for probe in deviceID.split(','))
+            return deviceID
+        if self.configured.get(role) != deviceID or role not in self.roles:
+            self.configured[role] = deviceID
+            self.roles[role] = deviceID
+            self.save()
+        return self.roles[role]
+
+    def listDevices(self):
+        try:
+            return {name for name in os.listdir(self.w1Root) if name.startswith(FAMILY_PREFIX)}
+        except OSError:
+            return set()
+
+    def scan(self):
+        """Look for sensors added or removed since the last scan.
+        Returns (added, removed)."""
+        current = self.listDevices()
+        added = current - self.devices
+        removed = self.devices - current
+        self.devices = current
+
+        for deviceID in sorted(added):
+            logging.info("Found sensor %s", deviceID)
+        for deviceID in sorted(removed):
+            logging.info("Lost sensor %s", deviceID)
+
+        if added:
+            self.rebind(added)
+        return added, removed
+
+    def rebind(self, added):
+        """Give a role whose sensor has gone to a new sensor, if there is
+        only one way to do it."""
+        missing = [role for role, deviceID in self.roles.items() if deviceID not in self.devices]
+        unused = [deviceID for deviceID in sorted(added)
+                  if deviceID not in self.roles.values() and deviceID not in self.listed]
+        if len(missing) == 1 and len(unused) == 1:
+            logging.info("Sensor %s replaces %s as the %s sensor",
+                         unused[0], self.roles[missing[0]], missing[0])
+            self.assign(missing[0], unused[0])
+
+    def assign(self, role, deviceID):
+        """Bind a role to a device."""
+        self.roles[role] = deviceID
+        self.save()
+        for listener in self.listeners:
+            listener(role, deviceID)
+
+    def roleOf(self, deviceID):
+        """Return the role of a device, or None."""
+        for role, boundID in self.roles.items():
+            if boundID == deviceID:
+                return role
+        return None
+
+
+if __name__ == "__main__":
+
+    # Replace a probe in a fake devices directory
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as root:
+        for deviceID in ("28-000000000001", "28-000000000002", "w1_bus_master1"):
+            os.makedirs(os.path.join(root, deviceID))
+
+        registry = w1Registry(root, os.path.join(root, "devices.pickle"))
+        assert registry.configure('fridge', "28-000000000001") == "28-000000000001"
+        assert registry.configure('beer', "28-000000000002") == "28-000000000002"
+        rebound = []
+        registry.listeners.append(lambda role, deviceID: rebound.append((role, deviceID)))
+
+        assert registry.scan() == ({"28-000000000001", "28-000000000002"}, set())
+        os.rmdir(os.path.join(root, "28-000000000002"))
+        assert registry.scan() == (set(), {"28-000000000002"})
+        os.makedirs(os.path.join(root, "28-000000000003"))
+        registry.scan()
+        print(rebound)
+        assert rebound == [('beer', "28-000000000003")]
+
+        # The new probe is still the beer sensor after a restart
+        registry = w1Registry(root, os.path.join(root, "devices.pickle"))
+        assert registry.configure('beer', "28-000000000002") == "28-000000000003"
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""Simulate DS18B20 sensors in a fake 1-wire sysfs tree.
+
+The simulator writes the files the kernel driver offers under
+/sys/bus/w1/devices (w1_slave, temperature, resolution, and
+therm_bulk_read on the bus masters) into a directory of your choice.
+Point Fuscus at it with w1_root in the [sensors] section, and the real
+acquisition code (DS18B20, w1Poller, w1Registry) runs unchanged, with as
+many probes as you like.
+
+Each probe follows a trajectory, a function of the time in seconds since
+the simulator started, plus optional noise.  Readings are rounded to the
+resolution set in the probe's resolution file.  Probes can be made to
+return 85.0 (the power-on value of a sensor whose conversion failed) or
+a scratchpad with a bad CRC now and then.
+
+Masters with bulk conversion follow the driver: writing "trigger" to
+therm_bulk_read reads "-1" until the conversion time has passed, and the
+probes on the master only get new readings then.  Probes on other masters
+get a new reading every conversion time.
+
+Every file is written to a temporary name and renamed, so a reader never
+sees half a file.
+"""
+
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import bisect
+import csv
+import math
+import os
+import random
+import shutil
+import threading
+import time
+
+import DS18B20
+
+# How often the simulator looks for bulk conversion triggers.  This must
+# be well under w1Poller.BULK_POLL_INTERVAL, or the poller may read the
+# trigger back before it is seen, and take the conversion as finished.
+POLL_INTERVAL = 0.01
+
+# Configuration register of the scratchpad for each resolution
+CONFIG_REGISTER = {9: 0x1f, 10: 0x3f, 11: 0x5f, 12: 0x7f}
+
+
+# Trajectories
+
+def constant(temperature):
+    return lambda t: temperature
+
+
+def ramp(start, ratePerHour):
+    return lambda t: start + ratePerHour * t / 3600
+
+
+def sine(mean, amplitude, period):
+    return lambda t: mean + amplitude * math.sin(2 * math.pi * t / period)
+
+
+def profile(points):
+    """Interpolate linearly between (seconds, temperature) points, and
+    hold the first and last temperatures outside them."""
+    points = sorted(points)
+    times = [t for t, temperature in points]
+
+    def trajectory(t):
+        i = bisect.bisect_right(times, t)
+        if i == 0:
+            return points[0][1]
+        if i == len(points):
+            return points[-1][1]
+        (t0, temp0), (t1, temp1) = points[i - 1], points[i]
+        return temp0 + (temp1 - temp0) * (t - t0) / (t1 - t0)
+
+    return trajectory
+
+
+def loadProfile(filename):
+    """Read a profile from a CSV file of seconds,temperature lines."""
+    with open(filename, newline='') as f:
+        return profile([(float(row[0]), float(row[1])) for row in csv.reader(f)
+                        if row and not row[0].startswith('#')])
+
+
+# Scratchpad encoding
+
+def crc8(data):
+    """Dallas/Maxim CRC-8, as checked by the driver."""
+    crc = 0
+    for byte in data:
+        for bit in range(8):
+            mix = (crc ^ byte) & 1
+            crc >>= 1
+            if mix:
+                crc ^= 0x8c
+            byte >>= 1
+    return crc
+
+
+def scratchpad(temperature, bits=12):
+    """Return the 9 scratchpad bytes for a temperature."""
+    raw = round(temperature * 16) & 0xffff
+    data = [raw & 0xff, raw >> 8, 0x4b, 0x46, CONFIG_REGISTER[bits], 0xff, 0x0c, 0x10]
+    return data + [crc8(data)]
+
+
+def w1Slave(temperature, bits=12, crcError=False):
+    """Return the contents of w1_slave for a reading."""
+    data = scratchpad(temperature, bits)
+    if crcError:
+        data[3] ^= 0x40  # A flipped bit, which the CRC catches
+    hexBytes = " ".join("%02x" % byte for byte in data)
+    return "%s : crc=%02x %s\n%s t=%d\n" % (hexBytes, data[8], "NO" if crcError else "YES",
+                                              hexBytes, round(temperature * 1000))
+
+
+def writeAtomic(filename, text):
+    newName = filename + ".new"
+    with open(newName, "w") as f:
+        f.write(text)
+    os.replace(newName, filename)
+
+
+class probe:
+    """A simulated DS18B20 and what it should read."""
+
+    def __init__(self, deviceID, trajectory, master, noise=0.0, glitch85=0.0, crcError=0.0,
+                 temperatureAttribute=True):
+        self.deviceID = deviceID
+        self.trajectory = trajectory
+        self.master = master
+        self.noise = noise  # Standard deviation in degrees
+        self.glitch85 = glitch85  # Probability that a reading is 85.0
+        self.crcError = crcError  # Probability that a reading fails its CRC
+        self.temperatureAttribute = temperatureAttribute  # False for older kernels
+        self.conversions = 0
+
+
+class w1Simulator(threading.Thread):
+    """Keep a fake 1-wire devices directory up to date.
+
+    Call addProbe() for each probe, then start() the thread, or call
+    convert() yourself for full control over the timing.  conversionTime
+    overrides the conversion time of the probes' resolution, in seconds.
+    """
+
+    def __init__(self, root, masters=1, bulk=True, conversionTime=None, seed=None):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.root = root
+        self.bulk = bulk
+        self.conversionTime = conversionTime
+        self.random = random.Random(seed)
+
+        self.masters = [os.path.join(root, "w1_bus_master%d" % (i + 1)) for i in range(masters)]
+        for master in self.masters:
+            os.makedirs(master, exist_ok=True)
+            if bulk:
+                writeAtomic(os.path.join(master, "therm_bulk_read"), "0\n")
+
+        self.lock = threading.Lock()
+        self.probes = {}  # deviceID -> probe
+        self.converting = {}  # master -> time.monotonic() the bulk conversion ends
+        self.startTime = time.monotonic()
+
+        self.running = True  # Until stop() is called
+
+    def addProbe(self, trajectory, deviceID=None, master=0, **options):
+        """Add a probe, with the options of the probe class.  Returns its
+        deviceID, made up from the number of probes if not given."""
+        with self.lock:
+            if deviceID is None:
+                deviceID = "28-%012x" % (len(self.probes) + 1)
+            newProbe = probe(deviceID, trajectory, self.masters[master], **options)
+            os.makedirs(os.path.join(self.root, deviceID), exist_ok=True)
+            os.makedirs(os.path.join(newProbe.master, deviceID), exist_ok=True)
+            writeAtomic(os.path.join(self.root, deviceID, "resolution"), "12\n")
+            self.write(newProbe, 0.0)
+            self.probes[deviceID] = newProbe
+        return deviceID
+
+    def removeProbe(self, deviceID):
+        """Unplug a probe."""
+        with self.lock:
+            removed = self.probes.pop(deviceID)
+            shutil.rmtree(os.path.join(self.root, deviceID), ignore_errors=True)
+            shutil.rmtree(os.path.join(removed.master, deviceID), ignore_errors=True)
+
+    def resolution(self, deviceID):
+        """Return the resolution last written to a probe's resolution file."""
+        try:
+            with open(os.path.join(self.root, deviceID, "resolution")) as f:
+                bits = int(f.read())
+        except (OSError, ValueError):
+            return 12
+        return bits if bits in CONFIG_REGISTER else 12
+
+    def write(self, simulated, t):
+        """Write a new reading of a probe, for time t."""
+        bits = self.resolution(simulated.deviceID)
+        draw = self.random.random()
+        crcError = draw < simulated.crcError
+        if simulated.crcError <= draw < simulated.crcError + simulated.glitch85:
+            temperature = 85.0
+        else:
+            temperature = simulated.trajectory(t)
+            if simulated.noise:
+                temperature += self.random.gauss(0, simulated.noise)
+            # Only the top bits of the reading are valid at lower resolution
+            lsb = 0.5 / 2 ** (bits - 9)
+            temperature = math.floor(temperature / lsb) * lsb
+
+        directory = os.path.join(self.root, simulated.deviceID)
+        writeAtomic(os.path.join(directory, "w1_slave"), w1Slave(temperature, bits, crcError))
+        if simulated.temperatureAttribute:
+            # The driver returns an error on a CRC failure; an empty file
+            # makes the same reading fail
+            writeAtomic(os.path.join(directory, "temperature"),
+                        "" if crcError else "%d\n" % round(temperature * 1000))
+        simulated.conversions += 1
+
+    def convert(self, master=None, t=None):
+        """Give the probes (on one master, or all) a new reading for time t,
+        in seconds since the start."""
+        if t is None:
+            t = time.monotonic() - self.startTime
+        with self.lock:
+            for simulated in list(self.probes.values()):
+                if master is None or simulated.master == master:
+                    self.write(simulated, t)
+
+    def conversionDelay(self, master=None):
+        """Return how long a conversion takes on a master: that of its
+        slowest probe."""
+        if self.conversionTime is not None:
+            return self.conversionTime
+        bits = [self.resolution(p.deviceID) for p in list(self.probes.values())
+                if master is None or p.master == master]
+        return DS18B20.CONVERSION_TIME[max(bits, default=12)]
+
+    def pollBulk(self, now):
+        """Start and finish bulk conversions requested through therm_bulk_read."""
+        for master in self.masters:
+            filename = os.path.join(master, "therm_bulk_read")
+            if master in self.converting:
+                if now >= self.converting[master]:
+                    del self.converting[master]
+                    self.convert(master)
+                    writeAtomic(filename, "1\n")
+                continue
+            try:
+                with open(filename) as f:
+                    request = f.read().strip()
+            except OSError:
+                continue
+            if request == "trigger":
+                writeAtomic(filename, "-1\n")
+                self.converting[master] = now + self.conversionDelay(master)
+
+    def run(self):
+        nextConversion = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            if self.bulk:
+                self.pollBulk(now)
+            elif now >= nextConversion:
+                self.convert()
+                nextConversion = max(nextConversion + self.conversionDelay(), now)
+            time.sleep(POLL_INTERVAL)
+
+    def stop(self):
+        self.running = False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='directory to simulate /sys/bus/w1/devices in')
+    parser.add_argument('--probes', type=int, default=3, help='number of probes')
+    parser.add_argument('--masters', type=int, default=1, help='number of bus masters')
+    parser.add_argument('--no-bulk', action='store_true', help='no bulk conversion on the masters')
+    parser.add_argument('--conversion', type=float, default=None,
+                        help='conversion time in seconds (default: from the resolution)')
+    parser.add_argument('--profile', default=None,
+                        help='CSV file of seconds,temperature lines for every probe '
+                             '(default: slow sine waves)')
+    parser.add_argument('--noise', type=float, default=0.02, help='noise in degrees')
+    parser.add_argument('--glitch85', type=float, default=0.0,
+                        help='probability that a reading is 85.0')
+    parser.add_argument('--crc', type=float, default=0.0,
+                        help='probability that a reading fails its CRC check')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random numbers')
+    args = parser.parse_args()
+
+    simulator = w1Simulator(args.root, args.masters, not args.no_bulk, args.conversion, args.seed)
+    shared = loadProfile(args.profile) if args.profile else None
+    for i in range(args.probes):
+        trajectory = shared or sine(18 + i % 5, 1.0, 3600 + 60 * i)
+        deviceID = simulator.addProbe(trajectory, master=i % args.masters, noise=args.noise,
+                                      glitch85=args.glitch85, crcError=args.crc)
+        print(deviceID)
+
+    print("Simulating %d probes in '%s'.  Ctrl-C to stop." % (args.probes, args.root))
+    simulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,69 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+import DS18B20
+
+DEVICE = "28-0000000000aa"
+W1_SLAVE = ("72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n"
+            "72 01 4b 46 7f ff 0e 10 57 t=23125\n")
+
+
+@pytest.fixture(autouse=True)
+def forget():
+    DS18B20._noTemperatureAttribute.clear()
+    yield
+    DS18B20._noTemperatureAttribute.clear()
+
+
+def plug(root, temperature=True, w1Slave=True):
+    device = root / DEVICE
+    device.mkdir()
+    if temperature:
+        (device / "temperature").write_text("19500\n")
+    if w1Slave:
+        (device / "w1_slave").write_text(W1_SLAVE)
+
+
+def test_reads_temperature_attribute(tmp_path):
+    plug(tmp_path)
+    assert DS18B20.readOnce(DEVICE, str(tmp_path)) == (19.5, None)
+
+
+def test_older_kernel_reads_w1_slave(tmp_path):
+    plug(tmp_path, temperature=False)
+    assert DS18B20.readOnce(DEVICE, str(tmp_path)) == (23.125, None)
+    assert DEVICE in DS18B20._noTemperatureAttribute
+
+
+def test_unplugged_probe_keeps_temperature_attribute(tmp_path):
+    assert DS18B20.readOnce(DEVICE, str(tmp_path)) == (None, DS18B20.OPEN_ERROR)
+    assert DEVICE not in DS18B20._noTemperatureAttribute
+
+    # Plugged back in on a kernel with the attribute
+    plug(tmp_path)
+    (tmp_path / DEVICE / "w1_slave").write_text("garbage")
+    assert DS18B20.readOnce(DEVICE, str(tmp_path)) == (19.5, None)
+
+
+def test_crc_error(tmp_path):
+    plug(tmp_path, temperature=False)
+    (tmp_path / DEVICE / "w1_slave").write_text(W1_SLAVE.replace("YES", "NO"))
+    assert DS18B20.readOnce(DEVICE, str(tmp_path)) == (None, DS18B20.CRC_ERROR)
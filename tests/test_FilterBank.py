@@ -0,0 +1,125 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import FilterBank
+import FilterCascaded
+import tempSensor
+import w1Poller
+
+
+def test_views_match_cascaded_filters_every_step():
+    random.seed(1)
+    bank = FilterBank.FilterBank(capacity=2)  # Grows on the way
+    pairs = []
+    for channel in range(10):
+        assert bank.register() == channel
+        for filterIndex in range(FilterBank.NUM_FILTERS):
+            b = random.randint(0, 6)
+            cascaded = FilterCascaded.CascadedFilter()
+            cascaded.setCoefficients(b)
+            cascaded.init(20.0)
+            view = bank.view(channel, filterIndex)
+            view.setCoefficients(b)
+            view.init(20.0)
+            pairs.append((cascaded, view))
+
+    for i in range(500):
+        # Not every filter gets an input every step
+        updated = [pair for pair in pairs if random.random() < 0.7]
+        for cascaded, view in updated:
+            val = 20.0 + random.uniform(-1, 1)
+            cascaded.add(val)
+            view.add(val)
+        assert bank.step() == len(updated)
+        for cascaded, view in pairs:
+            assert view.readOutput() == pytest.approx(cascaded.readOutput(), abs=1e-9)
+            assert view.readPrevOutput() == pytest.approx(cascaded.readPrevOutput(), abs=1e-9)
+
+
+def test_init_drops_a_staged_input():
+    bank = FilterBank.FilterBank()
+    view = bank.view(bank.register(), FilterBank.FAST_FILTER)
+    view.add(30.0)
+    view.init(20.0)
+    assert bank.step() == 0
+    assert view.readOutput() == 20.0
+
+
+def test_state_round_trip():
+    bank = FilterBank.FilterBank()
+    view = bank.view(bank.register(), FilterBank.SLOW_FILTER)
+    view.init(20.0)
+    for val in (20.5, 21.0, 21.5):
+        view.add(val)
+        bank.step()
+    state = view.getState()
+    other = FilterBank.FilterBank()
+    otherView = other.view(other.register(), FilterBank.SLOW_FILTER)
+    otherView.setState(state)
+    assert otherView.getState() == state
+    assert otherView.readOutput() == view.readOutput()
+
+
+def makeSensors(filterBank):
+    poller = w1Poller.w1Poller()
+    sensors = [tempSensor.sensor('28-%012d' % i, filterBank=filterBank, poller=poller) for i in range(3)]
+    for sensor in sensors:
+        poller.store(sensor.deviceID, 20.0)
+        sensor.init()
+    return poller, sensors
+
+
+def test_sensors_read_this_ticks_outputs():
+    """Stepped as tempController.updateTemperatures() does, sensors on a
+    bank give the same outputs as sensors with their own filters, in the
+    same tick, slope included."""
+    bank = FilterBank.FilterBank()
+    bankPoller, bankSensors = makeSensors(bank)
+    ownPoller, ownSensors = makeSensors(None)
+    random.seed(2)
+    try:
+        for i in range(600):
+            for channel in range(3):
+                val = round((20.0 + channel + random.uniform(-0.5, 0.5)) * 16) / 16
+                bankPoller.store(bankSensors[channel].deviceID, val)
+                ownPoller.store(ownSensors[channel].deviceID, val)
+
+            added = [sensor.addSample() for sensor in bankSensors]
+            bank.step()
+            for sensor, wasAdded in zip(bankSensors, added):
+                if wasAdded:
+                    sensor.updateDerived()
+            bank.step()
+            for sensor in ownSensors:
+                sensor.update()
+
+            for bankSensor, ownSensor in zip(bankSensors, ownSensors):
+                assert bankSensor.readFastFiltered() == pytest.approx(ownSensor.readFastFiltered(), abs=1e-9)
+                assert bankSensor.readSlowFiltered() == pytest.approx(ownSensor.readSlowFiltered(), abs=1e-9)
+                assert bankSensor.readSlope() == pytest.approx(ownSensor.readSlope(), abs=1e-6)
+    finally:
+        for sensor in bankSensors + ownSensors:
+            sensor.stop()
@@ -0,0 +1,76 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random
+
+import pytest
+
+import FilterCascaded
+import FilterFixed
+
+
+@pytest.fixture
+def samples():
+    random.seed(1)
+    samples = [20.0]
+    for i in range(5000):
+        samples.append(round((samples[-1] + random.uniform(-0.1, 0.1)) * 16) / 16)
+    return samples
+
+
+def streamed(backend, b, samples):
+    streaming = FilterCascaded.CascadedFilter(backend=backend)
+    streaming.setCoefficients(b)
+    streaming.init(samples[0])
+    return [streaming.add(val) for val in samples], streaming.getState()
+
+
+def batched(backend, b, samples, exact=False):
+    """Filter in two halves, to check the state carries over."""
+    batch = FilterCascaded.CascadedFilter(backend=backend)
+    batch.setCoefficients(b)
+    half = len(samples) // 2
+    first, state = batch.filter_array(samples[:half], exact=exact)
+    second, state = batch.filter_array(samples[half:], state, exact=exact)
+    return list(first) + list(second), state
+
+
+@pytest.mark.parametrize('b', [0, 2, 4, 6])
+def test_decimal_matches_add(samples, b):
+    expected, expectedState = streamed('decimal', b, samples)
+    outputs, state = batched('decimal', b, samples)
+    assert max(abs(x - y) for x, y in zip(expected, outputs)) < 1e-9
+
+
+@pytest.mark.parametrize('b', [0, 2, 4, 6])
+def test_integer_exact_matches_add(samples, b):
+    expected, expectedState = streamed('integer', b, samples)
+    outputs, state = batched('integer', b, samples, exact=True)
+    assert outputs == expected
+    assert state == expectedState
+
+
+@pytest.mark.parametrize('b', [0, 2, 4, 6])
+def test_integer_fft_within_tolerance(samples, b):
+    expected, expectedState = streamed('integer', b, samples)
+    outputs, state = batched('integer', b, samples)
+    tolerance = FilterFixed.fromFixed(3 * 2 ** (b * 2 + 3))
+    assert max(abs(x - y) for x, y in zip(expected, outputs)) <= tolerance
+    # The state is in the integer format, so streaming can carry on from it
+    assert all(isinstance(val, int) for section in state for taps in section for val in taps)
@@ -0,0 +1,138 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import ctypes
+import random
+
+import pytest
+
+import FilterFixed
+
+
+def int16(val):
+    return ctypes.c_int16(val).value
+
+
+def int32(val):
+    return ctypes.c_int32(val).value
+
+
+class firmwareFilter:
+    """FixedFilter of the BrewPi firmware, transcribed with every int16_t
+    and int32_t operation wrapped as on the AVR."""
+
+    def __init__(self, b):
+        self.a = b * 2 + 4
+        self.b = b
+
+    def init(self, val):  # val is a fixed7_9 temperature
+        self.xv = [int32(int16(val) << 16)] * 3
+        self.yv = list(self.xv)
+
+    def addDoublePrecision(self, val):
+        xv, yv, a, b = self.xv, self.yv, self.a, self.b
+        xv[2] = xv[1]
+        xv[1] = xv[0]
+        xv[0] = int32(val)
+        yv[2] = yv[1]
+        yv[1] = yv[0]
+        y = int32(yv[1] - yv[2])
+        y = int32(y + yv[1])
+        y = int32(y - (yv[1] >> b))
+        y = int32(y + (yv[2] >> b))
+        y = int32(y + (xv[0] >> a))
+        y = int32(y + (xv[1] >> (a - 1)))
+        y = int32(y + (xv[2] >> a))
+        y = int32(y - (yv[2] >> (a - 2)))
+        yv[0] = y
+        return y
+
+    def add(self, val):
+        return self.addDoublePrecision(int32(int16(val) << 16))
+
+
+def test_step_response_by_hand():
+    # b=0, a=4, settled at 20.0 and stepped to 21.0:
+    # y0 = y2 + x0/16 + x1/8 + x2/16 - y2/4 = (320 + 21 + 40 + 20 - 80) * 2^21
+    integerFilter = FilterFixed.IntegerFixedFilter(0)
+    integerFilter.init(20.0)
+    assert integerFilter.addFixed(FilterFixed.toFixed(21.0)) == 321 << 21
+    assert integerFilter.readOutput() == 20.0625
+
+
+@pytest.mark.parametrize('b', range(7))
+def test_matches_firmware_transcription(b):
+    random.seed(b)
+    firmware = firmwareFilter(b)
+    integerFilter = FilterFixed.IntegerFixedFilter(b)
+    temp = 20 * 512
+    firmware.init(temp)
+    integerFilter.init(temp / 512)
+    for i in range(3000):
+        temp += random.randint(-40, 40)  # fixed7_9
+        assert integerFilter.addFixed(FilterFixed.toFixed(temp / 512)) == firmware.add(temp)
+        assert integerFilter.getState() == (firmware.xv, firmware.yv)
+
+
+def test_overflow_wraps_like_int32():
+    # Rising fast near +64 degrees, the extrapolation 2*y1 - y2 overshoots
+    firmware = firmwareFilter(0)
+    integerFilter = FilterFixed.IntegerFixedFilter(0)
+    top = FilterFixed.INT32_MAX
+    firmware.xv = [top, top, top]
+    firmware.yv = [top, top - (1 << 28), top - (2 << 28)]
+    integerFilter.setState((list(firmware.xv), list(firmware.yv)))
+    output = integerFilter.addFixed(top)
+    assert output == firmware.addDoublePrecision(top)
+    assert output < 0  # Wrapped around
+    assert integerFilter.getState() == (firmware.xv, firmware.yv)
+
+
+def test_input_is_quantized_to_fixed7_9():
+    assert FilterFixed.toTemperature(20.3) == round(20.3 * 512)
+    assert FilterFixed.toFixed(20.3) == round(20.3 * 512) << 16
+    assert FilterFixed.toTemperature(100.0) == FilterFixed.INT16_MAX
+    assert FilterFixed.toTemperature(-100.0) == FilterFixed.INT16_MIN
+    assert FilterFixed.preciseToRegular(FilterFixed.toFixed(20.3)) == round(20.3 * 512)
+
+
+def test_filter_array_fixed_matches_add():
+    samples = [FilterFixed.toFixed(20 + (i % 7) / 16) for i in range(500)]
+    streaming = FilterFixed.IntegerFixedFilter(3)
+    streaming.initFixed(samples[0])
+    expected = [streaming.addFixed(val) for val in samples]
+
+    outputs, state = FilterFixed.IntegerFixedFilter(3).filter_array_fixed(samples)
+    assert outputs == expected
+    assert state == streaming.getState()
+
+
+@pytest.mark.parametrize('b', range(7))
+def test_close_to_decimal(b):
+    # Truncating shifts bias the integer output low by up to 2^(a-1) LSB
+    random.seed(1)
+    decimalFilter = FilterFixed.FixedFilter(b)
+    integerFilter = FilterFixed.IntegerFixedFilter(b)
+    decimalFilter.init(20.0)
+    integerFilter.init(20.0)
+    tolerance = FilterFixed.fromFixed(2 ** (integerFilter.a - 1))
+    temp = 20.0
+    for i in range(2000):
+        temp = round((temp + random.uniform(-0.1, 0.1)) * 16) / 16
+        assert abs(decimalFilter.add(temp) - integerFilter.add(temp)) <= tolerance
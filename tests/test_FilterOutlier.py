@@ -0,0 +1,107 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import random
+import statistics
+import types
+
+import pytest
+
+import FilterOutlier
+
+
+def test_spikes_replaced_by_median():
+    outlierFilter = FilterOutlier.MedianOutlierFilter(window=5, threshold=0.5)
+    samples = [20.0, 20.1, 20.0, 20.1, 85.0, 20.0, 20.1, -127.0, 20.0]
+    output = [outlierFilter.add(val) for val in samples]
+    assert output[4] == 20.1
+    assert output[7] == 20.1
+    assert outlierFilter.rejectedCount == 2
+    assert [val for i, val in enumerate(output) if i not in (4, 7)] == \
+        [val for i, val in enumerate(samples) if i not in (4, 7)]
+
+
+def test_step_passes_once_it_fills_half_the_window():
+    outlierFilter = FilterOutlier.MedianOutlierFilter(window=5, threshold=0.5)
+    output = [outlierFilter.add(val) for val in [20.0] * 5 + [25.0] * 4]
+    assert output[5:] == [20.0, 20.0, 25.0, 25.0]
+    assert outlierFilter.rejectedCount == 2
+
+
+def test_first_samples_pass_unchecked():
+    outlierFilter = FilterOutlier.MedianOutlierFilter(window=5, threshold=0.5)
+    assert outlierFilter.add(20.0) == 20.0
+    assert outlierFilter.add(85.0) == 85.0
+    assert outlierFilter.rejectedCount == 0
+
+
+def test_window_matches_a_plain_median():
+    random.seed(1)
+    for window in range(1, 10):
+        outlierFilter = FilterOutlier.MedianOutlierFilter(window=window, threshold=1000)
+        # Quantized like a DS18B20, so there are plenty of equal samples
+        samples = [round(random.gauss(20, 0.5) * 16) / 16 for i in range(500)]
+        for i, val in enumerate(samples):
+            outlierFilter.add(val)
+            assert outlierFilter.median() == statistics.median(samples[max(0, i - window + 1):i + 1])
+
+
+def test_heaps_stay_bounded_on_a_ramp():
+    # Samples leaving the window sink to the bottom of the lower heap and
+    # are never at its top, so only the rebuild drops them
+    outlierFilter = FilterOutlier.MedianOutlierFilter(window=5, threshold=1000)
+    for i in range(10000):
+        outlierFilter.add(20 + i / 1000)
+        assert len(outlierFilter.low) + len(outlierFilter.high) <= 2 * outlierFilter.window
+    assert outlierFilter.median() == 20 + 9997 / 1000
+
+
+def test_init_forgets_the_window():
+    outlierFilter = FilterOutlier.MedianOutlierFilter(window=3, threshold=0.5)
+    for val in (20.0, 20.0, 20.0):
+        outlierFilter.add(val)
+    outlierFilter.init()
+    assert outlierFilter.median() is None
+    assert outlierFilter.add(30.0) == 30.0
+
+
+@pytest.mark.parametrize("payload", [b"nan", b"inf", b"-Infinity", b"warm", b"\xff"])
+def test_mqtt_bad_payloads_are_rejected(payload):
+    pytest.importorskip("paho.mqtt.client")
+    import mqttTempSensor
+    sensor = mqttTempSensor.sensor(None, None)
+    sensor.topicUpdate(None, None, types.SimpleNamespace(payload=b"19.5"))
+    sensor.topicUpdate(None, None, types.SimpleNamespace(payload=payload))
+    assert sensor.temperature == 19.5
+    assert sensor.badPayloadCount == 1
+
+
+def test_mqtt_json_bad_values_are_rejected():
+    pytest.importorskip("paho.mqtt.client")
+    import mqttJsonSource
+    source = mqttJsonSource.mqttJsonSource.__new__(mqttJsonSource.mqttJsonSource)
+    source.topic = "tele/probe"
+    sensor = types.SimpleNamespace(topic="tele/probe:t", badPayloadCount=0, readings=[])
+    sensor.setReading = sensor.readings.append
+    source.sensors = [(mqttJsonSource.compilePath("t"), sensor)]
+    for value in (19.5, float('nan'), float('inf'), True, "20", None):
+        source.dispatch({"t": value})
+    assert sensor.readings == [19.5, 20.0]
+    assert sensor.badPayloadCount == 4
@@ -0,0 +1,49 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import math
+
+import pytest
+
+pytest.importorskip("paho.mqtt.client")  # tempControl has MQTT sensors
+
+import simulator
+
+
+def simulate(mode, setting, estimator, seed=1):
+    """Simulate a day of fermentation, from a beer 3 degrees warmer than
+    the beer setting."""
+    model = simulator.thermalModel(beer=22.0, fridge=22.0,
+                                   ambient=lambda t: 22.0 + 3.0 * math.sin(2 * math.pi * t / 86400),
+                                   fermentationPower=10.0)
+    sim = simulator.simulation(model, mode, [(0, setting)], warmup=12 * 3600, seed=seed, estimator=estimator)
+    try:
+        sim.run(86400)
+    finally:
+        sim.close()
+    return sim.results()
+
+
+@pytest.mark.parametrize("mode, setting", [('beer', 19.0), ('fridge', 18.0)])
+def test_kalman_controls_at_least_as_well_as_the_filters(mode, setting):
+    filtered = simulate(mode, setting, 'filter')
+    kalman = simulate(mode, setting, 'kalman')
+    for key in ('compressorCycles', 'heaterCycles', 'rmsError', 'maxError'):
+        assert kalman[key] <= filtered[key], key
@@ -0,0 +1,163 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import pickle
+
+import pytest
+
+pytest.importorskip("paho.mqtt.client")  # tempControl has MQTT sensors
+
+import simulator
+import tempControl
+
+SENSORS = ('fridgeSensor', 'beerSensor', 'ambientSensor')
+
+
+@pytest.fixture
+def simulations(tmp_path):
+    """Return a function making simulations which share a snapshot file."""
+    made = []
+
+    def make(filterBackend='integer'):
+        sim = simulator.simulation(filterBackend=filterBackend, seed=1)
+        sim.controller.snapshotFile = str(tmp_path / tempControl.SNAPSHOT_FILE)
+        made.append(sim)
+        return sim
+
+    yield make
+    made[-1].close()
+
+
+def sensorStates(controller):
+    return {name: getattr(controller, name).getState() for name in SENSORS}
+
+
+def restart(make, saved, seconds=60, filterBackend='integer'):
+    """Start a new controller, seconds after saved stored its snapshot."""
+    sim = make(filterBackend)
+    sim.clock.advance(saved.clock.monotonic() + seconds)
+    return sim
+
+
+@pytest.mark.parametrize("filterBackend", ['integer', 'decimal'])
+def test_round_trip(simulations, filterBackend):
+    saved = simulations(filterBackend)
+    saved.run(2000)
+    saved.controller.storeSnapshot()
+
+    sim = restart(simulations, saved, filterBackend=filterBackend)
+    assert sim.controller.loadSnapshot()
+    assert sensorStates(sim.controller) == sensorStates(saved.controller)
+    assert vars(sim.controller.cv) == vars(saved.controller.cv)
+    for name in ('lastHeatTime', 'lastCoolTime', 'doPosPeakDetect', 'doNegPeakDetect', 'integralUpdateCounter'):
+        assert getattr(sim.controller, name) == getattr(saved.controller, name)
+    for name in SENSORS:
+        restored, original = getattr(sim.controller, name), getattr(saved.controller, name)
+        assert restored.readSlowFiltered() == original.readSlowFiltered()
+        assert restored.readSlope() == original.readSlope()
+        assert restored.failedReadCount == 0  # Not initialised again on the first update
+
+
+def test_no_snapshot(simulations):
+    assert not simulations().controller.loadSnapshot()
+
+
+def test_too_old(simulations):
+    saved = simulations()
+    saved.run(100)
+    saved.controller.storeSnapshot()
+    sim = restart(simulations, saved, seconds=tempControl.SNAPSHOT_MAX_AGE + 1)
+    cold = sensorStates(sim.controller)
+    assert not sim.controller.loadSnapshot()
+    assert sensorStates(sim.controller) == cold
+
+
+def test_other_backend(simulations):
+    saved = simulations('decimal')
+    saved.run(100)
+    saved.controller.storeSnapshot()
+    sim = restart(simulations, saved, filterBackend='integer')
+    cold = sensorStates(sim.controller)
+    assert not sim.controller.loadSnapshot()
+    assert sensorStates(sim.controller) == cold
+
+
+def rewrite(sim, change):
+    with open(sim.controller.snapshotFile, 'rb') as f:
+        snapshot = pickle.load(f)
+    change(snapshot)
+    with open(sim.controller.snapshotFile, 'wb') as f:
+        pickle.dump(snapshot, f)
+
+
+def test_other_version(simulations):
+    saved = simulations()
+    saved.run(100)
+    saved.controller.storeSnapshot()
+    rewrite(saved, lambda snapshot: snapshot.update(version=tempControl.SNAPSHOT_VERSION - 1))
+    sim = restart(simulations, saved)
+    assert not sim.controller.loadSnapshot()
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda path: open(path, 'wb').write(b'not a pickle'),
+    lambda path: open(path, 'wb').close(),
+])
+def test_unreadable(simulations, corrupt):
+    saved = simulations()
+    saved.run(100)
+    saved.controller.storeSnapshot()
+    corrupt(saved.controller.snapshotFile)
+    sim = restart(simulations, saved)
+    cold = sensorStates(sim.controller)
+    assert not sim.controller.loadSnapshot()
+    assert sensorStates(sim.controller) == cold
+
+
+def test_half_applied_state_is_rolled_back(simulations):
+    saved = simulations()
+    saved.run(2000)
+    saved.controller.storeSnapshot()
+    # The fridge sensor is restored before the beer sensor fails
+    rewrite(saved, lambda snapshot: snapshot['beerSensor'].pop('slowFilter'))
+    sim = restart(simulations, saved)
+    cold = sensorStates(sim.controller)
+    cv = dict(vars(sim.controller.cv))
+    assert not sim.controller.loadSnapshot()
+    assert sensorStates(sim.controller) == cold
+    assert vars(sim.controller.cv) == cv
+
+
+def test_sensor_not_ready_is_initialised_after_a_failed_restore(simulations):
+    saved = simulations()
+    saved.run(2000)
+    saved.controller.storeSnapshot()
+    rewrite(saved, lambda snapshot: snapshot['ambientSensor'].pop('slowFilter'))
+    sim = restart(simulations, saved)
+    # As if the beer sensor gave no reading within SENSOR_READY_TIMEOUT
+    beerSensor = sim.controller.beerSensor
+    for sensorFilter in (beerSensor.fastFilter, beerSensor.slowFilter, beerSensor.slopeFilter):
+        sensorFilter.init(0)
+    beerSensor.failedReadCount = 255
+    assert not sim.controller.loadSnapshot()
+    assert beerSensor.failedReadCount == 255
+    sim.run(1)
+    assert beerSensor.failedReadCount == 0
+    assert abs(beerSensor.readSlowFiltered() - sim.model.beer) < 0.5
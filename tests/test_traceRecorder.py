@@ -0,0 +1,131 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import contextlib
+import os
+
+import pytest
+
+pytest.importorskip("paho.mqtt.client")  # tempControl has MQTT sensors
+
+import piLink
+import simulator
+import tempControl
+import traceRecorder
+
+TICKS = 6000
+
+
+def record(filename, ticks=TICKS, settingsAt=3000, estimator='filter'):
+    """Record a simulated run, with a door opening and a new beer setting
+    from piLink part way."""
+    sim = simulator.simulation(simulator.thermalModel(beer=22.0), settings=((0, 19.0),),
+                               doorEvents=((2000, 300),), seed=3, estimator=estimator)
+    link = piLink.piLink(sim.controller, None, sim.controller.eepromManager, None)
+    recorder = traceRecorder.traceRecorder(filename)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            sim.run(300)  # Start recording from a warm controller
+            recorder.attach(sim.controller)
+            for i in range(ticks):
+                if i == settingsAt:
+                    link.applySettings({'beerSet': 17.5})
+                # simulation.tick(), with the controller's part recorded
+                sim.applySettings()
+                sim.clock.advance(1)
+                sim.model.step(sim.clock.monotonic(), 1, sim.heater.state, sim.cooler.state, sim.door.isOpen)
+                sim.poller.sample()
+                recorder.beginTick()
+                controller = sim.controller
+                controller.updateTemperatures()
+                controller.detectPeaks()
+                controller.updatePID()
+                controller.updateState()
+                controller.updateSampleRates()
+                controller.updateOutputs()
+                recorder.endTick()
+    finally:
+        recorder.close()
+        sim.close()
+    return sim
+
+
+@pytest.fixture(scope='module')
+def trace(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('trace') / 'trace.bin')
+    sim = record(filename)
+    return filename, sim
+
+
+def test_replay_has_no_differences(trace):
+    filename, sim = trace
+    assert sim.cooler.cycles + sim.heater.cycles > 0  # Something to compare
+    tickCount, differences = traceRecorder.replayTrace(filename)
+    assert tickCount == TICKS
+    assert differences == []
+
+
+def test_fused_sensors(tmp_path):
+    filename = str(tmp_path / 'fused.bin')
+    record(filename, estimator='kalman')
+    header = next(fields for recordType, fields in traceRecorder.readRecords(filename)
+                  if recordType == traceRecorder.HEADER)
+    assert [probe['id'] for probe in header['probes']] == [
+        simulator.FRIDGE_ID, simulator.BEER_ID, simulator.AMBIENT_ID]
+    assert header['estimator'] == 'kalman'
+    tickCount, differences = traceRecorder.replayTrace(filename)
+    assert tickCount == TICKS
+    assert differences == []
+
+
+def test_records(trace):
+    filename, sim = trace
+    counts = {}
+    for recordType, fields in traceRecorder.readRecords(filename):
+        counts[recordType] = counts.get(recordType, 0) + 1
+        if recordType == traceRecorder.SETTINGS:
+            assert fields[1] == {'beerSet': 17.5}
+    assert counts[traceRecorder.HEADER] == 1
+    assert counts[traceRecorder.STATE] == TICKS
+    assert counts[traceRecorder.SETTINGS] == 1
+    assert counts[traceRecorder.DOOR] == 2
+    assert counts[traceRecorder.RELAY] >= 2
+
+
+def test_replay_finds_a_change(trace, monkeypatch):
+    filename, sim = trace
+    monkeypatch.setattr(tempControl, 'MIN_COOL_OFF_TIME', tempControl.MIN_COOL_OFF_TIME * 2)
+    tickCount, differences = traceRecorder.replayTrace(filename, stopAfter=1)
+    # Stops at the first tick which differs
+    assert differences
+    assert len({t for t, what, recorded, replayed in differences}) == 1
+    assert tickCount < TICKS
+
+
+def test_cut_short(trace, tmp_path):
+    filename, sim = trace
+    with open(filename, 'rb') as f:
+        data = f.read()
+    cut = str(tmp_path / 'cut.bin')
+    with open(cut, 'wb') as f:
+        f.write(data[:-3])  # As if we stopped while writing a record
+    tickCount, differences = traceRecorder.replayTrace(cut)
+    assert tickCount == TICKS - 1
+    assert differences == []
@@ -0,0 +1,126 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+
+import pytest
+
+import DS18B20
+import w1Poller
+
+TEMPERATURES = {"28-000000000001": 20.5, "28-000000000002": 18.25}
+
+
+@pytest.fixture
+def root(tmp_path):
+    w1Poller.makeFakeTree(str(tmp_path), TEMPERATURES)
+    return tmp_path
+
+
+def readAll(poller, deviceIDs=sorted(TEMPERATURES)):
+    return {deviceID: temperature for deviceID, temperature, error, seconds in poller.readAll(deviceIDs)}
+
+
+def test_bulk_conversion(root):
+    poller = w1Poller.w1Poller(w1Root=str(root))
+    assert readAll(poller) == TEMPERATURES
+    assert list(poller.masters) == [str(root / "w1_bus_master1")]
+    assert (root / "w1_bus_master1" / "therm_bulk_read").read_text() == "trigger\n"
+
+
+def test_failed_bulk_conversion_backs_off_per_master(root):
+    # A second master whose therm_bulk_read can't be written
+    other = root / "w1_bus_master2"
+    (other / "therm_bulk_read").mkdir(parents=True)
+    w1Poller.makeFakeTree(str(root), {"28-000000000003": 4.0}, bulk=False)
+    os.rename(root / "w1_bus_master1" / "28-000000000003", other / "28-000000000003")
+    deviceIDs = sorted(TEMPERATURES) + ["28-000000000003"]
+
+    poller = w1Poller.w1Poller(w1Root=str(root))
+    assert readAll(poller, deviceIDs) == dict(TEMPERATURES, **{"28-000000000003": 4.0})
+    assert poller.bulkFailures == {str(other): 1}
+    assert poller.bulkRetry[str(other)] > time.monotonic() + w1Poller.BULK_BACKOFF_BASE / 2 - 1
+
+    # The first master still converts in bulk, and the second is not tried
+    # again until its backoff has passed
+    (root / "w1_bus_master1" / "therm_bulk_read").write_text("0\n")
+    readAll(poller, deviceIDs)
+    assert (root / "w1_bus_master1" / "therm_bulk_read").read_text() == "trigger\n"
+    assert poller.bulkFailures == {str(other): 1}
+
+    # Once the master works again, so does bulk conversion
+    (other / "therm_bulk_read").rmdir()
+    (other / "therm_bulk_read").write_text("0\n")
+    poller.bulkRetry[str(other)] = 0
+    readAll(poller, deviceIDs)
+    assert (other / "therm_bulk_read").read_text() == "trigger\n"
+    assert poller.bulkFailures == {} and poller.bulkRetry == {}
+
+
+def test_backoff_grows_to_limit():
+    for failures in range(1, 20):
+        delay = min(w1Poller.BACKOFF_MAX, w1Poller.BACKOFF_BASE * 2 ** (failures - 1))
+        assert delay / 2 <= w1Poller.backoff(failures) <= delay
+    assert w1Poller.backoff(100) <= w1Poller.BACKOFF_MAX
+
+
+def test_ready_after_a_failed_first_read(root):
+    deviceID = "28-000000000001"
+    (root / "w1_bus_master1" / "therm_bulk_read").unlink()
+    (root / deviceID / "w1_slave").write_text("72 01 4b 46 7f ff 0e 10 57 : crc=57 NO\n"
+                                              "72 01 4b 46 7f ff 0e 10 57 t=19000\n")
+    poller = w1Poller.w1Poller(w1Root=str(root))
+    poller.add(deviceID)
+    poller.start()
+    try:
+        # Set after the first failure, not after FAILURE_LIMIT of them
+        assert poller.readyEvent(deviceID).wait(1)
+        assert poller.getStats()[deviceID]["crcErrors"] < w1Poller.FAILURE_LIMIT
+        assert poller.read(deviceID) is None
+    finally:
+        poller.stop()
+        poller.join(1)
+
+
+def test_bad_readings_are_retried_and_held(root, monkeypatch):
+    monkeypatch.setattr(w1Poller, 'BACKOFF_BASE', 0.01)
+    deviceID = "28-000000000001"
+    (root / "w1_bus_master1" / "therm_bulk_read").unlink()
+    poller = w1Poller.w1Poller(w1Root=str(root))
+    poller.add(deviceID)
+    poller.start()
+    try:
+        assert poller.readyEvent(deviceID).wait(1)
+        (root / deviceID / "w1_slave").write_text("72 01 4b 46 7f ff 0e 10 57 : crc=57 NO\n"
+                                                  "72 01 4b 46 7f ff 0e 10 57 t=19000\n")
+        while not poller.getStats()[deviceID]["crcErrors"]:
+            time.sleep(0.01)
+        assert poller.read(deviceID) == 20.5  # The last good reading is held
+
+        deadline = time.monotonic() + 5
+        while poller.getStats()[deviceID]["crcErrors"] < w1Poller.FAILURE_LIMIT:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        time.sleep(0.05)
+        assert poller.read(deviceID) is None
+    finally:
+        poller.stop()
+        poller.join(1)
+    assert not poller.is_alive()
@@ -0,0 +1,103 @@
+#
+# Copyright 2020 Henrik Halvorsen
+#
+# This file is part of Fuscus.
+#
+# Fuscus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fuscus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fuscus.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+
+import w1Registry
+
+FRIDGE = "28-000000000001"
+BEER = "28-000000000002"
+NEW = "28-000000000003"
+OTHER = "28-000000000004"
+
+
+def plug(root, deviceID):
+    os.makedirs(os.path.join(root, deviceID))
+
+
+def unplug(root, deviceID):
+    os.rmdir(os.path.join(root, deviceID))
+
+
+def makeRegistry(root):
+    registry = w1Registry.w1Registry(str(root), str(root / "devices.pickle"))
+    rebound = []
+    registry.listeners.append(lambda role, deviceID: rebound.append((role, deviceID)))
+    return registry, rebound
+
+
+def test_replaced_probe_takes_over_role(tmp_path):
+    for deviceID in (FRIDGE, BEER, "w1_bus_master1"):
+        plug(tmp_path, deviceID)
+    registry, rebound = makeRegistry(tmp_path)
+    assert registry.configure('fridge', FRIDGE) == FRIDGE
+    assert registry.configure('beer', BEER) == BEER
+
+    assert registry.scan() == ({FRIDGE, BEER}, set())
+    unplug(tmp_path, BEER)
+    assert registry.scan() == (set(), {BEER})
+    plug(tmp_path, NEW)
+    registry.scan()
+    assert rebound == [('beer', NEW)]
+    assert registry.roleOf(NEW) == 'beer'
+
+    # The new probe is still the beer sensor after a restart, as long as
+    # the config file still names the old one
+    registry, rebound = makeRegistry(tmp_path)
+    assert registry.configure('beer', BEER) == NEW
+    # A new probe in the config file wins
+    assert registry.configure('beer', OTHER) == OTHER
+
+
+def test_two_new_probes_are_left_alone(tmp_path):
+    plug(tmp_path, FRIDGE)
+    registry, rebound = makeRegistry(tmp_path)
+    registry.configure('fridge', FRIDGE)
+    registry.configure('beer', BEER)
+    registry.scan()
+    plug(tmp_path, NEW)
+    plug(tmp_path, OTHER)
+    registry.scan()
+    assert rebound == []
+
+
+def test_other_chambers_probes_are_not_taken(tmp_path):
+    # The beer probe of the main chamber is missing at startup, and the
+    # only other probe belongs to a second chamber
+    plug(tmp_path, FRIDGE)
+    plug(tmp_path, OTHER)
+    registry, rebound = makeRegistry(tmp_path)
+    registry.configure('fridge', FRIDGE)
+    registry.configure('beer', BEER)
+    registry.configure('vessel2.fridge', OTHER)
+    registry.scan()
+    assert rebound == []
+    assert registry.roleOf(OTHER) == 'vessel2.fridge'
+
+
+def test_fused_probes_are_not_taken(tmp_path):
+    plug(tmp_path, FRIDGE)
+    plug(tmp_path, NEW)
+    plug(tmp_path, OTHER)
+    registry, rebound = makeRegistry(tmp_path)
+    registry.configure('fridge', FRIDGE)
+    registry.configure('beer', BEER)
+    assert registry.configure('ambient', "%s, %s" % (NEW, OTHER)) == "%s, %s" % (NEW, OTHER)
+    registry.scan()
+    assert rebound == []